@@ -0,0 +1,137 @@
+import csv
+import json
+import snapshot
+import sketches
+import stats_engine
+import storage
+from functions import read_medical_tests, read_medical_records, export_medical_records
+from patient import Patient, PatientStore
+from query import Query
+from record import Record
+from timeutil import parse_minutes, format_minutes
+
+VALID_STATUSES = ("pending", "completed", "reviewed")
+RECORD_FIELDS = ("patient_id", "test", "test_date", "result_value", "unit", "status", "result_date")
+
+
+def record_to_dict(patient_id, record):
+    return {
+        "patient_id": patient_id,
+        "test": record['test'].abbr_name,
+        "test_date": format_minutes(record['test_date']),
+        "result_value": record['result_value'],
+        "unit": record['unit'],
+        "status": record['status'],
+        "result_date": format_minutes(record['result_date']) if record['result_date'] is not None else None,
+    }
+
+
+def iter_batch_file(file_path):
+    # JSON (a list of objects with RECORD_FIELDS keys) or an export_medical_records-style CSV
+    if file_path.endswith(".json"):
+        with open(file_path, 'r') as file:
+            rows = json.load(file)
+        if not isinstance(rows, list):
+            raise ValueError(f"{file_path}: expected a JSON list of records")
+        yield from rows
+        return
+
+    with open(file_path, 'r', newline='') as file:
+        reader = csv.reader(file)
+        next(reader, None)
+        for row in reader:
+            if row:
+                yield dict(zip(RECORD_FIELDS, (field.strip() for field in row)))
+
+
+class BatchSession:
+    # non-interactive counterpart of main(): edits stay in memory and are persisted by one flush()
+    def __init__(self, test_file="medicalTest.txt", record_target="medicalRecord.txt", workers=1):
+        # workers: processes that parse the record file when there is no fresh snapshot (0 for one per CPU)
+        self.test_file = test_file
+        self.storage = storage.open_storage(record_target)
+        self.patients = PatientStore()
+        if isinstance(self.storage, storage.TextStorage):
+            self.tests = snapshot.load_medical_data(test_file, self.storage.file_path, self.patients, workers)
+        else:
+            self.tests = read_medical_tests(test_file)
+            read_medical_records(self.storage, self.tests, self.patients, workers)
+        self.added = []  # (patient_id, record_number, record) not yet persisted
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(flush=exc_type is None)
+
+    def add_record(self, patient_id, test, test_date, result_value, unit=None, status="pending", result_date=None):
+        patient_id = int(patient_id)
+        if test not in self.tests:
+            raise ValueError(f"Test '{test}' not found in the list of valid medical tests.")
+        medical_test = self.tests[test]
+        if not isinstance(status, str):
+            raise ValueError(f"Invalid status {status!r}. Expected one of: {', '.join(VALID_STATUSES)}.")
+        status = status.strip().lower()
+        if status not in VALID_STATUSES:
+            raise ValueError(f"Invalid status '{status}'. Expected one of: {', '.join(VALID_STATUSES)}.")
+
+        test_date = parse_minutes(test_date) if isinstance(test_date, str) else test_date
+        if not isinstance(test_date, int) or isinstance(test_date, bool):
+            raise ValueError(f"Missing or invalid test date {test_date!r}.")
+        if isinstance(result_date, str):
+            result_date = parse_minutes(result_date) if result_date.strip() else None
+        if result_date is not None and result_date < test_date:
+            raise ValueError(f"Result date {format_minutes(result_date)} is before the test date.")
+
+        record = Record(medical_test, test_date, float(result_value), unit or medical_test.unit, status, result_date)
+        if patient_id not in self.patients:
+            self.patients[patient_id] = Patient(patient_id)
+        patient = self.patients[patient_id]
+        patient.add_record(record)
+        self.added.append((patient_id, len(patient.records) - 1, record))
+        return record
+
+    def ingest(self, rows):
+        # returns (added, rejected); rejected holds (position, row, message) for rows that failed validation
+        added = 0
+        rejected = []
+        for position, row in enumerate(rows, 1):
+            try:
+                self.add_record(**{field: row[field] for field in RECORD_FIELDS if field in row})
+            except (KeyError, TypeError, ValueError) as e:
+                rejected.append((position, row, str(e)))
+            else:
+                added += 1
+        return added, rejected
+
+    def query(self, criteria=(), combine="all"):
+        query = Query.any(criteria) if combine == "any" else Query.all(criteria)
+        if self.storage.supports_query and not self.added:
+            return self.storage.query(query)
+        return query.execute(self.patients)
+
+    def stats(self, criteria=(), group_by=None, combine="all", approximate=False):
+        patients = self.query(criteria, combine)
+        if approximate:
+            return sketches.SketchSet(group_by or "test").add_patients(patients).summary(grouped=bool(group_by))
+        return stats_engine.summarize_patients(patients, group_by=group_by)
+
+    def export(self, file_path, criteria=(), combine="all"):
+        patients = self.query(criteria, combine) if criteria else self.patients
+        export_medical_records(patients, file_path)
+        return sum(len(patient.records) for patient in patients.values())
+
+    def flush(self):
+        added, self.added = self.added, []
+        if added:
+            self.storage.append_records(added)
+        return len(added)
+
+    def close(self, flush=True):
+        if flush:
+            self.flush()
+        # without a flush the in-memory adds must not reach the record file through a compaction either
+        compacted = self.storage.close(self.patients if flush else None)
+        if isinstance(self.storage, storage.TextStorage) and (flush or compacted):
+            snapshot.refresh_snapshot(self.test_file, self.storage.file_path, self.tests, self.patients,
+                                      self.storage.shared)
@@ -0,0 +1,40 @@
+# Throughput of the sequential and parallel medicalRecord.txt loaders.
+# Run from the repository root: python -m benchmarks.bench_parallel_load [num_lines] [workers ...]
+import os
+import sys
+import tempfile
+import time
+
+import functions as f
+from benchmarks.bench_record_layout import synthetic_rows
+from record import Record
+from record_format import format_record_line
+
+
+def write_record_file(path, tests, num_lines):
+    with open(path, 'w') as file:
+        for pid, test, test_date, value, unit, status, result_date in synthetic_rows(tests, num_lines):
+            file.write(format_record_line(pid, Record(test, test_date, value, unit, status, result_date)) + "\n")
+
+
+def main():
+    num_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 500_000
+    worker_counts = [int(arg) for arg in sys.argv[2:]] or [1, 2, 4, os.cpu_count() or 1]
+    tests = f.read_medical_tests("medicalTest.txt")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "medicalRecord.txt")
+        write_record_file(path, tests, num_lines)
+        size_mb = os.path.getsize(path) / 2 ** 20
+        print(f"{num_lines} lines, {size_mb:.1f} MiB")
+
+        for workers in sorted(set(worker_counts)):
+            patients = {}
+            started = time.perf_counter()
+            f.read_medical_records(path, tests, patients, workers=workers)
+            elapsed = time.perf_counter() - started
+            print(f"workers={workers:<3} {elapsed:7.2f} s  {num_lines / elapsed:12,.0f} lines/s  {size_mb / elapsed:7.1f} MiB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# Compares memory/build time of the dict, slotted Record and columnar RecordStore layouts.
+# Run from the repository root: python -m benchmarks.bench_record_layout [num_records]
+import gc
+import random
+import sys
+import time
+import tracemalloc
+from itertools import groupby
+from operator import itemgetter
+
+import functions as f
+from patient import Patient
+from record import Record
+from record_store import RecordStore, STATUSES
+
+
+def synthetic_rows(tests, num_records, seed=0):
+    rng = random.Random(seed)
+    abbr_names = list(tests)
+    rows = []
+    for i in range(num_records):
+        test = tests[rng.choice(abbr_names)]
+        test_date = 27_000_000 + rng.randrange(2_000_000)
+        status = rng.choice(STATUSES)
+        result_date = test_date + rng.randrange(30, 1440) if status == "completed" else None
+        rows.append((1_300_000 + i // 8, test, test_date, round(rng.uniform(1, 200), 1), test.unit, status, result_date))
+    return rows
+
+
+def build_dicts(rows):
+    patients = {}
+    for pid, test, test_date, value, unit, status, result_date in rows:
+        if pid not in patients:
+            patients[pid] = Patient(pid)
+        patients[pid].add_record({"test": test, "test_date": test_date, "result_value": value, "unit": unit,
+                                  "status": status, "result_date": result_date})
+    return patients
+
+
+def build_records(rows):
+    patients = {}
+    for pid, test, test_date, value, unit, status, result_date in rows:
+        if pid not in patients:
+            patients[pid] = Patient(pid)
+        patients[pid].add_record(Record(test, test_date, value, unit, status, result_date))
+    return patients
+
+
+def build_store(rows, tests):
+    store = RecordStore(tests)
+    for pid, patient_rows in groupby(rows, key=itemgetter(0)):
+        store.add_patient_rows(pid, ((test.abbr_name, test_date, value, unit, status, result_date)
+                                     for _, test, test_date, value, unit, status, result_date in patient_rows))
+    return store
+
+
+def measure(name, build, num_records):
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<12} {elapsed:8.3f} s  {current / 2 ** 20:9.1f} MiB  {current / num_records:7.1f} B/record  "
+          f"(peak {peak / 2 ** 20:.1f} MiB)")
+    return result
+
+
+def main():
+    num_records = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    tests = f.read_medical_tests("medicalTest.txt")
+    rows = synthetic_rows(tests, num_records)
+    print(f"{num_records} records")
+    measure("dict", lambda: build_dicts(rows), num_records)
+    measure("Record", lambda: build_records(rows), num_records)
+    store = measure("RecordStore", lambda: build_store(rows, tests), num_records)
+    print(f"RecordStore.memory_footprint(): {store.memory_footprint()['total'] / 2 ** 20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+# Benchmark harness over the functions.py entry points, on a synthetic dataset.
+# Run from the repository root:
+#   python -m benchmarks.harness [--records N] [--repeat R] [--only NAME ...] [--save-baseline] [--compare]
+# Each benchmark reports latency percentiles over R timed runs, throughput in records/s and the peak traced memory
+# of one extra run. --save-baseline writes the results to the baseline file; --compare checks them against it and
+# exits non-zero when a benchmark got slower or bigger than the tolerance allows.
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import functions as f
+from benchmarks.synthetic_data import write_dataset
+from patient import PatientStore
+from query import Query
+from sharded_store import ShardedPatientStore
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+DEFAULT_TOLERANCE = 0.25
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    # registers fn(context) -> number of records it processed; the context loads shared data outside the timing
+    def register(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return register
+
+
+class BenchContext:
+    def __init__(self, data_dir, num_records):
+        self.data_dir = data_dir
+        self.num_records = num_records
+        self.paths = write_dataset(data_dir, num_records)
+        self.tests = f.read_medical_tests(self.paths["tests"])
+        self._patients = None
+        self._sharded = None
+
+    @property
+    def patients(self):
+        if self._patients is None:
+            self._patients = PatientStore()
+            f.read_medical_records(self.paths["records"], self.tests, self._patients)
+            self._patients.index.prepare()
+        return self._patients
+
+    @property
+    def sharded(self):
+        # one shard per core; its result cache is cleared by each benchmark so every run does the work
+        if self._sharded is None:
+            self._sharded = ShardedPatientStore.from_patients(self.patients, os.cpu_count() or 1)
+        self._sharded.cache.clear()
+        return self._sharded
+
+    def close(self):
+        if self._sharded is not None:
+            self._sharded.close()
+
+    def output_path(self, name):
+        return os.path.join(self.data_dir, name)
+
+
+def _count(patients):
+    return sum(len(patient.records) for patient in patients.values())
+
+
+@benchmark("read_medical_records")
+def bench_read(context):
+    patients = PatientStore()
+    f.read_medical_records(context.paths["records"], context.tests, patients)
+    patients.index.prepare()
+    return _count(patients)
+
+
+@benchmark("import_medical_records")
+def bench_import(context):
+    patients = f.import_medical_records(context.paths["csv"], context.tests, PatientStore(),
+                                        reject_path=context.output_path("import_rejects.csv"))
+    return _count(patients)
+
+
+@benchmark("filter_by_patient_id")
+def bench_filter_patient(context):
+    patients = context.patients
+    patient_id = next(iter(patients))
+    f.filter_by_patient_id(patients, patient_id)
+    return 1
+
+
+@benchmark("filter_by_test_name")
+def bench_filter_test(context):
+    return _count(f.filter_by_test_name(context.patients, "Hgb"))
+
+
+@benchmark("filter_by_abnormal_tests")
+def bench_filter_abnormal(context):
+    return _count(f.filter_by_abnormal_tests(context.patients))
+
+
+@benchmark("filter_by_date_range")
+def bench_filter_dates(context):
+    return _count(f.filter_by_date_range(context.patients, datetime(2022, 1, 1), datetime(2022, 3, 31, 23, 59)))
+
+
+@benchmark("filter_by_status")
+def bench_filter_status(context):
+    return _count(f.filter_by_status(context.patients, "pending"))
+
+
+@benchmark("filter_by_turnaround_time")
+def bench_filter_turnaround(context):
+    return _count(f.filter_by_turnaround_time(context.patients, "00-03-00", "00-11-00"))
+
+
+@benchmark("calculate_summary_statistics")
+def bench_summary(context):
+    f.calculate_summary_statistics(context.patients)
+    return context.num_records
+
+
+@benchmark("calculate_summary_statistics[group_by=test]")
+def bench_summary_grouped(context):
+    f.calculate_summary_statistics(context.patients, group_by="test")
+    return context.num_records
+
+
+@benchmark("query_summary_statistics[rollups]")
+def bench_rollup_summary(context):
+    # whole days of one status: answered from the (test, status, day) rollups
+    query = Query.all([("status", "completed"), ("date_range", datetime(2022, 1, 1), datetime(2022, 6, 30, 23, 59))])
+    f.query_summary_statistics(context.patients, query)
+    return context.num_records
+
+
+@benchmark("filter_by_test_name[sharded]")
+def bench_sharded_filter_test(context):
+    return _count(f.filter_by_test_name(context.sharded, "Hgb"))
+
+
+@benchmark("calculate_summary_statistics[sharded]")
+def bench_sharded_summary(context):
+    f.calculate_summary_statistics(context.sharded)
+    return context.num_records
+
+
+@benchmark("calculate_summary_statistics[sharded, group_by=test]")
+def bench_sharded_summary_grouped(context):
+    f.calculate_summary_statistics(context.sharded, group_by="test")
+    return context.num_records
+
+
+@benchmark("export_medical_records")
+def bench_export(context):
+    f.export_medical_records(context.patients, context.output_path("export.csv"))
+    return context.num_records
+
+
+def percentile(sorted_values, q):
+    position = (len(sorted_values) - 1) * q / 100
+    lower = math.floor(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def run_benchmark(fn, context, repeat, trace_memory=True):
+    # the functions under test print progress messages; keep them out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        return _run_benchmark(fn, context, repeat, trace_memory)
+
+
+def _run_benchmark(fn, context, repeat, trace_memory):
+    fn(context)  # warm-up: shared data, caches, imports
+    latencies = []
+    processed = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        processed = fn(context)
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+
+    peak = None
+    if trace_memory:
+        tracemalloc.start()
+        fn(context)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    p50 = percentile(latencies, 50)
+    return {
+        "records": processed,
+        "p50": p50,
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "throughput": processed / p50 if p50 else 0.0,
+        "peak_bytes": peak,
+    }
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            continue
+        if result["p50"] > previous["p50"] * (1 + tolerance):
+            regressions.append(f"{name}: p50 {previous['p50'] * 1000:.2f} ms -> {result['p50'] * 1000:.2f} ms")
+        if result["peak_bytes"] and previous.get("peak_bytes") and \
+                result["peak_bytes"] > previous["peak_bytes"] * (1 + tolerance):
+            regressions.append(f"{name}: peak memory {previous['peak_bytes'] / 2 ** 20:.1f} MiB -> "
+                               f"{result['peak_bytes'] / 2 ** 20:.1f} MiB")
+    return regressions
+
+
+def print_results(results):
+    print(f"{'benchmark':<54} {'p50 ms':>10} {'p90 ms':>10} {'p99 ms':>10} {'records/s':>14} {'peak MiB':>9}")
+    for name, result in results.items():
+        peak = f"{result['peak_bytes'] / 2 ** 20:9.1f}" if result["peak_bytes"] is not None else f"{'-':>9}"
+        print(f"{name:<54} {result['p50'] * 1000:10.2f} {result['p90'] * 1000:10.2f} {result['p99'] * 1000:10.2f} "
+              f"{result['throughput']:14,.0f} {peak}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the medical records operations on synthetic data.")
+    parser.add_argument("--records", type=float, default=1e5)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), metavar="NAME")
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced-memory run")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    num_records = int(args.records)
+    results = {}
+    with tempfile.TemporaryDirectory() as data_dir:
+        context = BenchContext(data_dir, num_records)
+        print(f"{num_records:,} synthetic records, {args.repeat} runs each")
+        try:
+            for name in args.only or BENCHMARKS:
+                results[name] = run_benchmark(BENCHMARKS[name], context, args.repeat, not args.no_memory)
+        finally:
+            context.close()
+    print_results(results)
+
+    status = 0
+    if args.compare:
+        try:
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+        except FileNotFoundError:
+            print(f"No baseline at {args.baseline}; run with --save-baseline first.")
+            return 2
+        if baseline.get("records") != num_records:
+            print(f"Warning: baseline was recorded with {baseline.get('records'):,} records, not {num_records:,}.")
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if not regressions:
+            print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%}).")
+        status = 1 if regressions else 0
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump({"records": num_records, "python": platform.python_version(), "results": results}, file, indent=2)
+        print(f"Baseline written to {args.baseline}")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
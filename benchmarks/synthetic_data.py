@@ -0,0 +1,143 @@
+# Writes medicalTest.txt / medicalRecord.txt / medical_records.csv style files at any scale.
+# Run from the repository root: python -m benchmarks.synthetic_data OUT_DIR [--records N] [--seed S]
+# Records are generated and written one at a time, so 10^8 records need disk space, not memory.
+import argparse
+import csv
+import math
+import os
+import random
+
+from medical_test import MedicalTest
+from record import Record
+from record_format import CSV_COLUMNS, format_csv_row, format_record_line
+from timeutil import MINUTES_PER_DAY, parse_minutes
+
+# (name, abbreviation, lower, upper, unit, turnaround, relative frequency in lab orders)
+TEST_CATALOGUE = (
+    ("Hemoglobin", "Hgb", 13.8, 17.2, "g/dL", "00-03-04", 18),
+    ("Blood Glucose Test", "BGT", 70.0, 99.0, "mg/dL", "00-12-06", 16),
+    ("LDL Cholesterol Low-Density Lipoprotein", "LDL", None, 100.0, "mg/dL", "00-17-06", 8),
+    ("Systolic Blood Pressure", "systole", None, 120.0, "mm Hg", "00-08-04", 12),
+    ("Diastolic Blood Pressure", "diastole", None, 80.0, "mm Hg", "00-10-00", 12),
+    ("Alanine Aminotransferase", "ALT", 7.0, 56.0, "U/L", "00-04-00", 6),
+    ("White Blood Cell Count", "WBC", 4.5, 11.0, "10^3/uL", "00-02-30", 10),
+    ("Platelet Count", "PLT", 150.0, 400.0, "10^3/uL", "00-02-30", 6),
+    ("Sodium", "Na", 135.0, 145.0, "mmol/L", "00-06-00", 5),
+    ("Potassium", "K", 3.5, 5.1, "mmol/L", "00-06-00", 5),
+    ("Creatinine", "Cr", 0.7, 1.3, "mg/dL", "00-08-00", 4),
+    ("Thyroid Stimulating Hormone", "TSH", 0.4, 4.0, "mIU/L", "01-00-00", 3),
+    ("Glycated Hemoglobin", "HbA1c", None, 5.7, "%", "02-00-00", 3),
+    ("C-Reactive Protein", "CRP", None, 10.0, "mg/L", "00-12-00", 2),
+)
+STATUS_WEIGHTS = (("completed", 65), ("reviewed", 20), ("pending", 15))
+FIRST_PATIENT_ID = 1_000_000
+MEAN_RECORDS_PER_PATIENT = 8
+ABNORMAL_SHARE = 0.15
+START_DATE = "2020-01-01 00:00"
+DAYS = 5 * 365
+
+
+def synthetic_tests():
+    return {abbr_name: MedicalTest(name, abbr_name, lower, upper, unit, turnaround)
+            for name, abbr_name, lower, upper, unit, turnaround, _ in TEST_CATALOGUE}
+
+
+def write_tests(path, tests):
+    with open(path, 'w') as file:
+        file.write("\n".join(test.to_file_string().lstrip("\n") for test in tests.values()))
+
+
+def _result_value(rng, test):
+    # tests with only an upper limit still cluster below it rather than near zero
+    lower = test.lower_range if test.lower_range is not None else test.upper_range * 0.6
+    upper = test.upper_range
+    spread = (upper - lower) / 4
+    if rng.random() < ABNORMAL_SHARE:
+        # out of range on either side, by up to half the normal range
+        if test.lower_range is not None and rng.random() < 0.5:
+            value = lower - rng.uniform(0.01, 2) * spread
+        else:
+            value = upper + rng.uniform(0.01, 2) * spread
+    else:
+        value = min(max(rng.gauss((lower + upper) / 2, spread / 2), lower), upper)
+    return round(max(value, 0.1), 1)
+
+
+def _test_date(rng, start_minutes):
+    # weekdays are five times busier than weekends, and most samples are taken in the morning
+    while True:
+        day = rng.randrange(DAYS)
+        if (day + 2) % 7 < 5 or rng.random() < 0.2:
+            break
+    hour = min(6 + int(abs(rng.gauss(0, 3))), 23)
+    return start_minutes + day * MINUTES_PER_DAY + hour * 60 + rng.randrange(12) * 5
+
+
+def iter_synthetic_records(tests, num_records, seed=0):
+    # yields (patient_id, Record); each patient gets a geometric number of records, in date order
+    rng = random.Random(seed)
+    test_list = list(tests.values())
+    frequencies = {abbr_name: weight for _, abbr_name, *_, weight in TEST_CATALOGUE}
+    test_weights = [frequencies.get(test.abbr_name, 1) for test in test_list]
+    statuses = [status for status, _ in STATUS_WEIGHTS]
+    status_weights = [weight for _, weight in STATUS_WEIGHTS]
+    start_minutes = parse_minutes(START_DATE)
+    log_keep = math.log(1 - 1 / MEAN_RECORDS_PER_PATIENT)
+
+    patient_id = FIRST_PATIENT_ID
+    produced = 0
+    while produced < num_records:
+        count = min(1 + int(math.log(1 - rng.random()) / log_keep), num_records - produced)
+        picked = rng.choices(test_list, test_weights, k=count)
+        for test, test_date in zip(picked, sorted(_test_date(rng, start_minutes) for _ in range(count))):
+            status = rng.choices(statuses, status_weights)[0]
+            result_date = None
+            if status == "completed":
+                result_date = test_date + test.turnaround_minutes + int(rng.expovariate(1 / 30))
+            yield patient_id, Record(test, test_date, _result_value(rng, test), test.unit, status, result_date)
+        produced += count
+        patient_id += 1
+
+
+def write_dataset(out_dir, num_records, seed=0, formats=("txt", "csv")):
+    os.makedirs(out_dir, exist_ok=True)
+    tests = synthetic_tests()
+    paths = {"tests": os.path.join(out_dir, "medicalTest.txt")}
+    write_tests(paths["tests"], tests)
+
+    record_file = csv_file = writer = None
+    try:
+        if "txt" in formats:
+            paths["records"] = os.path.join(out_dir, "medicalRecord.txt")
+            record_file = open(paths["records"], 'w')
+        if "csv" in formats:
+            paths["csv"] = os.path.join(out_dir, "medical_records.csv")
+            csv_file = open(paths["csv"], 'w', newline='')
+            writer = csv.writer(csv_file)
+            writer.writerow(CSV_COLUMNS)
+        for patient_id, record in iter_synthetic_records(tests, num_records, seed):
+            if record_file is not None:
+                record_file.write(format_record_line(patient_id, record) + "\n")
+            if writer is not None:
+                writer.writerow(format_csv_row(patient_id, record))
+    finally:
+        for file in (record_file, csv_file):
+            if file is not None:
+                file.close()
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic medical test data.")
+    parser.add_argument("out_dir")
+    parser.add_argument("--records", type=float, default=1e5, help="number of records, e.g. 1e3 .. 1e8")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--formats", nargs="+", choices=("txt", "csv"), default=["txt", "csv"])
+    args = parser.parse_args()
+    paths = write_dataset(args.out_dir, int(args.records), args.seed, args.formats)
+    for kind, path in paths.items():
+        print(f"{kind:<8} {path} ({os.path.getsize(path) / 2 ** 20:.1f} MiB)")
+
+
+if __name__ == "__main__":
+    main()
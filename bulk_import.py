@@ -0,0 +1,233 @@
+import csv
+import os
+import time
+from contextlib import nullcontext
+from patient import Patient
+from record import Record
+from record_format import CSV_COLUMNS
+from record_store import STATUSES
+from timeutil import parse_minutes
+import metrics
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DEFAULT_BATCH_SIZE = 10000
+_BLANK_ROW = ("",) * len(CSV_COLUMNS)
+
+
+def reject_path_for(file_path):
+    return os.path.splitext(file_path)[0] + "_rejects.csv"
+
+
+class ImportReport:
+    def __init__(self, file_path, reject_path):
+        self.file_path = file_path
+        self.reject_path = reject_path
+        self.rows = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.batches = 0
+        self.seconds = 0.0
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        report = f"Imported {self.accepted} of {self.rows} records from {self.file_path} in {self.batches} batches " \
+                 f"({self.seconds:.2f} s, {self.rows_per_second:,.0f} rows/s)."
+        if self.rejected:
+            report += f"\n{self.rejected} rejected rows were written to {self.reject_path}."
+        return report
+
+
+def _parse_distinct(column, parse):
+    # each distinct value is parsed once; returns (value -> parsed, value -> reason for the bad ones)
+    parsed = {}
+    bad = {}
+    for value in set(column):
+        try:
+            parsed[value] = parse(value.strip())
+        except ValueError as e:
+            bad[value] = str(e)
+    return parsed, bad
+
+
+def _parse_patient_id(value):
+    if not value.isdigit():
+        raise ValueError(f"invalid patient id {value!r}")
+    return int(value)
+
+
+def _parse_test_date(value):
+    try:
+        return parse_minutes(value)
+    except ValueError as e:
+        raise ValueError(f"invalid test date: {e}")
+
+
+def _parse_result_date(value):
+    try:
+        return parse_minutes(value) if value else None
+    except ValueError as e:
+        raise ValueError(f"invalid result date: {e}")
+
+
+def _float_column(column):
+    # one numpy conversion for a clean column, per-value only when something in it is bad
+    if np is not None:
+        try:
+            values = np.array(column, dtype=np.float64)
+            if not np.isnan(values).any():
+                return values.tolist(), {}
+        except ValueError:
+            pass
+    values = []
+    errors = {}
+    for position, value in enumerate(column):
+        try:
+            number = float(value)
+        except ValueError:
+            number = None
+        if number is None or number != number:
+            errors[position] = f"invalid result value {value.strip()!r}"
+        values.append(number)
+    return values, errors
+
+
+def validate_batch(rows, tests):
+    # column-at-a-time validation of export-format rows; returns (accepted, rejects)
+    # accepted holds (patient_id, Record), rejects holds (position, reason)
+    # each distinct value of a column is checked once, so the per-row work is a few dict lookups
+    reasons = {}
+    fixed = []
+    for position, row in enumerate(rows):
+        if len(row) == 7:
+            fixed.append(row)
+        elif len(row) == 6:
+            fixed.append(row + [""])
+        else:
+            reasons[position] = f"expected 6 or 7 columns, got {len(row)}"
+            fixed.append(_BLANK_ROW)
+    patient_ids, abbr_names, test_dates, result_values, units, statuses, result_dates = zip(*fixed)
+
+    patient_id_of, bad_patient_ids = _parse_distinct(patient_ids, _parse_patient_id)
+    with metrics.timer("import.parse_dates"):
+        test_date_of, bad_test_dates = _parse_distinct(test_dates, _parse_test_date)
+        result_date_of, bad_result_dates = _parse_distinct(result_dates, _parse_result_date)
+    test_of = {}
+    bad_tests = {}
+    for abbr_name in set(abbr_names):
+        if abbr_name.strip() in tests:
+            test_of[abbr_name] = tests[abbr_name.strip()]
+        else:
+            bad_tests[abbr_name] = f"unknown test {abbr_name.strip()!r}"
+    status_of = {}
+    bad_statuses = {}
+    for status in set(statuses):
+        if status.strip().lower() in STATUSES:
+            status_of[status] = status.strip().lower()
+        else:
+            bad_statuses[status] = f"invalid status {status.strip()!r}"
+    unit_of = {unit: unit.strip() for unit in set(units)}
+    bad_units = {unit: "missing unit" for unit, stripped in unit_of.items() if not stripped}
+    values, bad_values = _float_column(result_values)
+
+    accepted = []
+    for position, (patient_id, abbr_name, test_date, unit, status, result_date) in enumerate(
+            zip(patient_ids, abbr_names, test_dates, units, statuses, result_dates)):
+        reason = (reasons.get(position) or bad_patient_ids.get(patient_id) or bad_tests.get(abbr_name)
+                  or bad_test_dates.get(test_date) or bad_values.get(position) or bad_units.get(unit)
+                  or bad_statuses.get(status) or bad_result_dates.get(result_date))
+        if reason is None:
+            test_minutes = test_date_of[test_date]
+            result_minutes = result_date_of[result_date]
+            if result_minutes is None or result_minutes >= test_minutes:
+                accepted.append((patient_id_of[patient_id], Record(test_of[abbr_name], test_minutes, values[position],
+                                                                   unit_of[unit], status_of[status], result_minutes)))
+                continue
+            reason = "result date is before the test date"
+        reasons[position] = reason
+    return accepted, sorted(reasons.items())
+
+
+def _commit(accepted, patients, storage_backend):
+    by_patient = {}
+    for patient_id, record in accepted:
+        records = by_patient.get(patient_id)
+        if records is None:
+            records = by_patient[patient_id] = []
+        records.append(record)
+
+    # with storage, under its write lock: the session first catches up, so the rows land after other sessions'
+    with nullcontext() if storage_backend is None else storage_backend.writing():
+        appended = []
+        for patient_id, records in by_patient.items():
+            if patient_id not in patients:
+                patients[patient_id] = Patient(patient_id)
+            patient = patients[patient_id]
+            first = len(patient.records)
+            patient.add_records(records)
+            appended.extend((patient_id, first + offset, record) for offset, record in enumerate(records))
+        if storage_backend is not None and appended:
+            storage_backend.append_records(appended)
+
+
+def bulk_import(file_path, tests, patients, storage_backend=None, batch_size=DEFAULT_BATCH_SIZE, reject_path=None):
+    # accepted rows are added to patients (and appended to storage_backend when given) one batch at a time;
+    # rejected rows go to reject_path with their line number and reason instead of the terminal
+    if reject_path is None:
+        reject_path = reject_path_for(file_path)
+    report = ImportReport(file_path, reject_path)
+    started = time.perf_counter()
+    # rejects of an earlier import must not read as this one's
+    if os.path.exists(reject_path):
+        os.remove(reject_path)
+    reject_file = None
+    reject_writer = None
+
+    metrics.count("io.bytes_read", os.path.getsize(file_path))
+    try:
+        with open(file_path, 'r', newline='') as file:
+            reader = csv.reader(file)
+            next(reader, None)
+            while True:
+                rows = []
+                line_numbers = []
+                with metrics.timer("import.read"):
+                    for row in reader:
+                        if not row:
+                            continue
+                        rows.append(row)
+                        line_numbers.append(reader.line_num)
+                        if len(rows) >= batch_size:
+                            break
+                if not rows:
+                    break
+
+                with metrics.timer("import.validate"):
+                    accepted, rejects = validate_batch(rows, tests)
+                with metrics.timer("import.commit"):
+                    _commit(accepted, patients, storage_backend)
+                metrics.count("import.rows", len(rows))
+                metrics.count("import.rows_rejected", len(rejects))
+                report.rows += len(rows)
+                report.accepted += len(accepted)
+                report.rejected += len(rejects)
+                report.batches += 1
+
+                if rejects and reject_writer is None:
+                    reject_file = open(reject_path, 'w', newline='')
+                    reject_writer = csv.writer(reject_file)
+                    reject_writer.writerow(("Line", "Reason") + CSV_COLUMNS)
+                for position, reason in rejects:
+                    reject_writer.writerow([line_numbers[position], reason] + rows[position])
+    finally:
+        if reject_file is not None:
+            reject_file.close()
+
+    report.seconds = time.perf_counter() - started
+    return report
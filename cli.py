@@ -0,0 +1,273 @@
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+from batch import BatchSession, iter_batch_file, record_to_dict
+from functions import read_medical_tests, validate_turnaround_time, patient_test_trend, patients_trending_abnormal
+from timeutil import DATE_FORMAT, format_minutes
+import metrics
+import mmap_query
+import parallel_loader
+import record_stream
+import sketches
+import stats_engine
+import trends
+
+
+def _date(value):
+    try:
+        return datetime.strptime(value, DATE_FORMAT)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a date in the format YYYY-MM-DD HH:MM, got {value!r}")
+
+
+def _turnaround(value):
+    if not validate_turnaround_time(value):
+        raise argparse.ArgumentTypeError(f"expected a turnaround time in the format DD-hh-mm, got {value!r}")
+    return value
+
+
+def add_criteria_arguments(parser):
+    parser.add_argument("--patient-id", type=int)
+    parser.add_argument("--test", help="test abbreviation")
+    parser.add_argument("--abnormal", action="store_true")
+    parser.add_argument("--start", type=_date, help="test date range start (YYYY-MM-DD HH:MM)")
+    parser.add_argument("--end", type=_date, help="test date range end (YYYY-MM-DD HH:MM)")
+    parser.add_argument("--status")
+    parser.add_argument("--turnaround", nargs=2, type=_turnaround, metavar=("MIN", "MAX"))
+    parser.add_argument("--any", action="store_true", help="match any criterion instead of all of them")
+
+
+def criteria_from_args(args):
+    criteria = []
+    if args.patient_id is not None:
+        criteria.append(("patient_id", args.patient_id))
+    if args.test:
+        criteria.append(("test_name", args.test))
+    if args.abnormal:
+        criteria.append(("abnormal",))
+    if args.start or args.end:
+        criteria.append(("date_range", args.start or datetime.min, args.end or datetime.max))
+    if args.status:
+        criteria.append(("status", args.status.lower()))
+    if args.turnaround:
+        criteria.append(("turnaround", *args.turnaround))
+    return criteria
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Batch operations on the medical records without the menu.")
+    parser.add_argument("--tests", default="medicalTest.txt", help="medical test definitions file")
+    parser.add_argument("--records", default=os.environ.get("MEDICAL_RECORDS_STORAGE", "medicalRecord.txt"),
+                        help="record file, or a .db/.sqlite file for the SQLite backend")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get(parallel_loader.WORKERS_ENV) or 1),
+                        help="processes that parse the record file when there is no fresh snapshot "
+                             f"(0 for one per CPU; default ${parallel_loader.WORKERS_ENV} or 1)")
+    parser.add_argument("--metrics", metavar="PATH", default=os.environ.get(metrics.METRICS_ENV),
+                        help="write timers and counters to PATH (.prom for Prometheus text, otherwise JSON)")
+    parser.add_argument("--profile", choices=metrics.PROFILE_MODES, default=os.environ.get(metrics.PROFILE_ENV),
+                        help="profile this command with cProfile or tracemalloc; the top entries go to stderr")
+    parser.add_argument("--profile-output", metavar="PATH",
+                        help="also save the profile (pstats data for cprofile, the text report for tracemalloc)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ingest = commands.add_parser("ingest", help="add records from JSON/CSV batch files or from arguments")
+    ingest.add_argument("files", nargs="*", help="JSON list of records or export-style CSV")
+    ingest.add_argument("--patient-id", type=int)
+    ingest.add_argument("--test")
+    ingest.add_argument("--test-date")
+    ingest.add_argument("--value", type=float)
+    ingest.add_argument("--unit")
+    ingest.add_argument("--status", default="pending")
+    ingest.add_argument("--result-date")
+
+    query = commands.add_parser("query", help="print the records matching the criteria")
+    add_criteria_arguments(query)
+    query.add_argument("--json", action="store_true")
+    query.add_argument("--mmap", action="store_true",
+                       help="answer from the memory-mapped snapshot without loading the records; falls back to "
+                            "loading them when the snapshot is older than the record files or --any is given")
+
+    stats = commands.add_parser("stats", help="summary statistics over the records matching the criteria")
+    add_criteria_arguments(stats)
+    stats.add_argument("--group-by", choices=tuple(stats_engine.GROUP_KEYS))
+    stats.add_argument("--approximate", action="store_true",
+                       help="bounded-memory sketches: estimated percentiles and distinct patient counts")
+    stats.add_argument("--json", action="store_true")
+
+    sketch = commands.add_parser("sketch", help="approximate summary of record files in constant memory; "
+                                                "the sketches of several files are merged")
+    sketch.add_argument("files", nargs="+",
+                        help="medicalRecord.txt-style files, export CSVs (.csv) or sketches saved with --save")
+    sketch.add_argument("--group-by", choices=tuple(stats_engine.GROUP_KEYS), default="test")
+    sketch.add_argument("--k", type=int, default=sketches.DEFAULT_K, help="KLL accuracy parameter")
+    sketch.add_argument("--precision", type=int, default=sketches.DEFAULT_PRECISION,
+                        help="HyperLogLog precision (2**precision registers)")
+    sketch.add_argument("--save", metavar="PATH", help="write the merged sketch, to merge again later")
+    sketch.add_argument("--json", action="store_true")
+
+    trend = commands.add_parser("trend", help="one patient's results for a test over time, or every series "
+                                              "trending out of its normal range")
+    trend.add_argument("--patient-id", type=int)
+    trend.add_argument("--test", help="test abbreviation")
+    trend.add_argument("--abnormal", action="store_true",
+                       help="list the (patient, test) series trending out of range instead")
+    trend.add_argument("--window", type=int, default=trends.DEFAULT_WINDOW, help="results per rolling window")
+    trend.add_argument("--horizon-days", type=float, default=trends.DEFAULT_HORIZON_DAYS,
+                       help="how far ahead a trend is projected for --abnormal")
+    trend.add_argument("--json", action="store_true")
+
+    export = commands.add_parser("export", help="write the records matching the criteria to a CSV file")
+    export.add_argument("output")
+    add_criteria_arguments(export)
+    return parser
+
+
+def run_ingest(session, args):
+    rows = []
+    for file_path in args.files:
+        rows.extend(iter_batch_file(file_path))
+    if args.test is not None:
+        rows.append({"patient_id": args.patient_id, "test": args.test, "test_date": args.test_date,
+                     "result_value": args.value, "unit": args.unit, "status": args.status,
+                     "result_date": args.result_date})
+    if not rows:
+        print("Nothing to ingest: pass batch files or --test/--patient-id/--test-date/--value.", file=sys.stderr)
+        return 2
+
+    added, rejected = session.ingest(rows)
+    for position, row, message in rejected:
+        print(f"Rejected row {position}: {message}", file=sys.stderr)
+    print(f"Ingested {added} records, rejected {len(rejected)}.")
+    return 1 if rejected else 0
+
+
+def _number(value):
+    return "-" if value is None else f"{value:.2f}"
+
+
+def run_trend(session, args):
+    if args.window < 1:
+        print("--window must be at least 1.", file=sys.stderr)
+        return 2
+    if args.abnormal:
+        rows = patients_trending_abnormal(session.patients, args.window, args.horizon_days)
+        if args.test:
+            rows = [row for row in rows if row["test"] == args.test]
+        if args.patient_id is not None:
+            rows = [row for row in rows if row["patient_id"] == args.patient_id]
+        if args.json:
+            print(json.dumps([dict(row, test_date=format_minutes(row["test_date"])) for row in rows], indent=2))
+            return 0
+        if not rows:
+            print("No series are trending out of range.")
+        for row in rows:
+            state = "abnormal" if row["abnormal"] else "normal"
+            print(f"{row['patient_id']} {row['test']}: {row['result_value']} ({state}) on "
+                  f"{format_minutes(row['test_date'])}, {row['direction']} {_number(row['rate_per_day'])}/day, "
+                  f"{_number(row['projected_value'])} in {args.horizon_days:g} days")
+        return 0
+
+    if args.patient_id is None or not args.test:
+        print("trend needs --patient-id and --test, or --abnormal.", file=sys.stderr)
+        return 2
+    rows = patient_test_trend(session.patients, args.patient_id, args.test, args.window)
+    if args.json:
+        print(json.dumps([dict(row, test_date=format_minutes(row["test_date"])) for row in rows], indent=2))
+    elif not rows:
+        print("No matching data found.")
+    else:
+        print(f"{'Test date':<17} {'Value':>9} {'Avg':>9} {'Delta':>9} {'Per day':>9}")
+        for row in rows:
+            print(f"{format_minutes(row['test_date']):<17} {row['result_value']:>9} "
+                  f"{_number(row['moving_average']):>9} {_number(row['delta']):>9} {_number(row['rate_per_day']):>9}")
+    return 0
+
+
+def run_sketch(args):
+    tests = None
+    merged = sketches.SketchSet(args.group_by, args.k, args.precision)
+    for file_path in args.files:
+        if file_path.endswith(sketches.SKETCH_SUFFIX):
+            merged.merge(sketches.SketchSet.load(file_path))
+            continue
+        if tests is None:
+            tests = read_medical_tests(args.tests)
+        if file_path.endswith(".csv"):
+            batches = record_stream.iter_csv_batches(file_path, tests)
+        else:
+            batches = record_stream.iter_record_batches(file_path, tests)
+        merged.add_batches(batches)
+    if args.save:
+        merged.save(args.save)
+
+    summary = merged.summary()
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print(sketches.render_approximate_report(summary, args.group_by.capitalize()))
+    return 0
+
+
+def print_records(patients, as_json):
+    if as_json:
+        print(json.dumps([record_to_dict(pid, record)
+                          for pid, patient in patients.items() for record in patient.records], indent=2))
+    elif patients:
+        for patient in patients.values():
+            print(patient)
+    else:
+        print("No matching data found.")
+    return 0
+
+
+def query_mapped(args):
+    # None when the snapshot cannot answer the query
+    if args.any:
+        return None
+    return mmap_query.query_current_snapshot(args.tests, args.records, criteria_from_args(args))
+
+
+def run(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.metrics:
+        metrics.enable(args.metrics)
+    with metrics.profiled(args.profile, args.profile_output):
+        return run_command(args)
+
+
+def run_command(args):
+    if args.command == "sketch":
+        return run_sketch(args)
+    if args.command == "query" and args.mmap:
+        patients = query_mapped(args)
+        if patients is not None:
+            return print_records(patients, args.json)
+    with BatchSession(args.tests, args.records, args.workers) as session:
+        if args.command == "ingest":
+            return run_ingest(session, args)
+        if args.command == "trend":
+            return run_trend(session, args)
+
+        criteria = criteria_from_args(args)
+        combine = "any" if args.any else "all"
+        if args.command == "query":
+            print_records(session.query(criteria, combine), args.json)
+        elif args.command == "stats":
+            summary = session.stats(criteria, args.group_by, combine, args.approximate)
+            if args.json:
+                print(json.dumps(summary, indent=2))
+            elif args.approximate:
+                print(sketches.render_approximate_report(summary, args.group_by.capitalize() if args.group_by else None))
+            elif args.group_by:
+                print(stats_engine.render_group_report(summary, args.group_by.capitalize()))
+            else:
+                print(stats_engine.render_summary_report(summary))
+        elif args.command == "export":
+            session.export(args.output, criteria, combine)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,55 @@
+from timeutil import minutes_from_datetime, turnaround_minutes
+
+# Filter criteria are tuples shared by the interactive menu, the index and the streaming paths:
+# ("patient_id", id), ("test_name", abbr), ("abnormal",), ("date_range", start, end),
+# ("status", status), ("turnaround", "DD-hh-mm", "DD-hh-mm")
+CRITERIA_KINDS = ("patient_id", "test_name", "abnormal", "date_range", "status", "turnaround")
+
+
+def criterion_predicate(criterion):
+    kind, args = criterion[0], criterion[1:]
+    if kind == "patient_id":
+        wanted_id = args[0]
+        return lambda patient_id, record: patient_id == wanted_id
+    if kind == "test_name":
+        abbr_name = args[0]
+        return lambda patient_id, record: record['test'].abbr_name == abbr_name
+    if kind == "abnormal":
+        checks = {}
+
+        def is_abnormal(patient_id, record):
+            test = record['test']
+            check = checks.get(test)
+            if check is None:
+                check = checks[test] = test.abnormal_check()
+            return check(record['result_value'])
+        return is_abnormal
+    if kind == "date_range":
+        start_minutes = minutes_from_datetime(args[0])
+        end_minutes = minutes_from_datetime(args[1])
+        return lambda patient_id, record: start_minutes <= record['test_date'] <= end_minutes
+    if kind == "status":
+        status = args[0].lower()
+        return lambda patient_id, record: record['status'].lower() == status
+    if kind == "turnaround":
+        in_range = test_predicate(criterion)
+        return lambda patient_id, record: in_range(record['test'])
+    raise ValueError(f"Unknown filter criterion: {kind}")
+
+
+def test_predicate(criterion):
+    # criteria that depend only on the MedicalTest, so they can be resolved per test instead of per record
+    kind, args = criterion[0], criterion[1:]
+    if kind == "test_name":
+        abbr_name = args[0]
+        return lambda test: test.abbr_name == abbr_name
+    if kind == "turnaround":
+        min_minutes = turnaround_minutes(args[0])
+        max_minutes = turnaround_minutes(args[1])
+        return lambda test: min_minutes <= test.turnaround_minutes <= max_minutes
+    raise ValueError(f"Not a per-test filter criterion: {kind}")
+
+
+def criteria_predicate(criteria):
+    predicates = [criterion_predicate(criterion) for criterion in criteria]
+    return lambda patient_id, record: all(predicate(patient_id, record) for predicate in predicates)
@@ -1,8 +1,20 @@
-from patient import Patient
+from patient import Patient, count_records
 from medical_test import MedicalTest
+from record import Record
+from timeutil import parse_minutes, format_minutes, minutes_from_datetime, turnaround_minutes
+import storage
+import locking
+import bulk_import
+import record_export
+import stats_engine
+import trends
+import sketches
+import rollups
+import metrics
+from query import Query
+from sharded_store import ShardedPatientStore
 from datetime import datetime, timedelta
-from statistics import mean
-import csv
+import functools
 
 
 def display_menu():
@@ -20,10 +32,14 @@ def display_menu():
     print("11. Exit")
 
 
+@metrics.timed("read_medical_tests")
 def read_medical_tests(file_path):
     tests = {}
     with open(file_path, 'r') as file:
         for line in file:
+            # tests are written with a leading newline (MedicalTest.to_file_string), so a rewritten file starts blank
+            if not line.strip():
+                continue
             parts = line.strip().split("; ")
 
             if len(parts) < 3:
@@ -55,46 +71,9 @@ def read_medical_tests(file_path):
     return tests
 
 
-def read_medical_records(file_path, tests, patients):
-    with open(file_path, 'r') as file:
-        for line in file:
-            try:
-                patient_id, record_data = line.split(":", 1)
-                patient_id = int(patient_id.strip())
-
-                record_parts = record_data.strip().split(", ")
-
-                abbr_name = record_parts[0].strip()
-                test_date = datetime.strptime(record_parts[1].strip(), "%Y-%m-%d %H:%M")
-                result_value = float(record_parts[2].strip())
-                unit = record_parts[3].strip()
-                status = record_parts[4].strip()
-                result_date = None
-                if len(record_parts) > 5:
-                    result_date = datetime.strptime(record_parts[5].strip(), "%Y-%m-%d %H:%M")
-
-                if abbr_name in tests:
-                    test = tests[abbr_name]
-
-                    record = {
-                        "test": test,
-                        "test_date": test_date.strftime("%Y-%m-%d %H:%M"),
-                        "result_value": result_value,
-                        "unit": unit,
-                        "status": status,
-                        "result_date": result_date.strftime("%Y-%m-%d %H:%M") if result_date else None
-                    }
-
-                    if patient_id not in patients:
-                        patients[patient_id] = Patient(patient_id)
-
-                    patients[patient_id].add_record(record)
-                else:
-                    print(f"Warning: Test '{abbr_name}' not found in the list of valid medical tests.")
-            except Exception as e:
-                print(f"Error processing line: {line}\nException: {e}")
-
-    return patients
+@metrics.timed("read_medical_records")
+def read_medical_records(file_path, tests, patients, workers=1):
+    return storage.open_storage(file_path).load(tests, patients, workers)
 
 
 def print_all_medical_tests(tests):
@@ -171,7 +150,8 @@ def add_new_medical_test(tests, file_path):
     test = MedicalTest(name, abbr_name, lower_range, upper_range, unit, turnaround_time)
     tests[abbr_name] = test
 
-    with open(file_path, 'a') as file:
+    test_file = locking.shared_file(file_path)
+    with test_file.writing(), open(test_file.path, 'a') as file:
         file.write(test.to_file_string())
 
     print(f"Medical test '{name}' successfully added.")
@@ -226,9 +206,7 @@ def add_new_medical_test_record(tests, patients, file_path):
     result_date_obj = None
 
     if status == "Completed":
-        turnaround_days, turnaround_hours, turnaround_minutes = map(int, test.turnaround_time.split('-'))
-        min_result_date = test_date_obj + timedelta(days=turnaround_days, hours=turnaround_hours,
-                                                    minutes=turnaround_minutes)
+        min_result_date = test_date_obj + timedelta(minutes=test.turnaround_minutes)
         while True:
             try:
                 result_date = input(
@@ -241,23 +219,16 @@ def add_new_medical_test_record(tests, patients, file_path):
             except ValueError:
                 print("Invalid date format. Please re-enter in the format YYYY-MM-DD HH:MM.")
 
-    record = {
-        "test": test,
-        "test_date": test_date_obj.strftime("%Y-%m-%d %H:%M"),
-        "result_value": result_value,
-        "unit": unit,
-        "status": status,
-        "result_date": result_date_obj.strftime("%Y-%m-%d %H:%M") if result_date_obj else None
-    }
-
-    if patient_id not in patients:
-        patients[patient_id] = Patient(patient_id)
-    patients[patient_id].add_record(record)
+    record = Record(test, minutes_from_datetime(test_date_obj), result_value, unit, status,
+                    minutes_from_datetime(result_date_obj) if result_date_obj else None)
 
-    with open(file_path, 'a') as file:
-        file.write(f"\n{patient_id}: {abbr_name}, {record['test_date']}, {result_value}, {unit}, {status}")
-        if status == "Completed":
-            file.write(f", {record['result_date']}")
+    records = storage.open_storage(file_path)
+    # under the write lock, after catching up, so the new record lands after the other sessions' records
+    with records.writing():
+        if patient_id not in patients:
+            patients[patient_id] = Patient(patient_id)
+        patients[patient_id].add_record(record)
+        records.append_record(patient_id, len(patients[patient_id].records) - 1, record)
 
     print("New medical test record successfully added.")
 
@@ -274,9 +245,9 @@ def update_patient_records(patients, tests, file_path):
 
     print("\nPatient Records:")
     for i, record in enumerate(patient.records, 1):
-        print(f"{i}. Test: {record['test'].abbr_name}, Date: {record['test_date']}, "
+        print(f"{i}. Test: {record['test'].abbr_name}, Date: {format_minutes(record['test_date'])}, "
               f"Result: {record['result_value']} {record['unit']}, Status: {record['status']}, "
-              f"Result Date: {record['result_date']}")
+              f"Result Date: {format_minutes(record['result_date']) if record['result_date'] is not None else None}")
 
     while True:
         record_number = input("Enter the number of the record you want to update: ").strip()
@@ -291,7 +262,7 @@ def update_patient_records(patients, tests, file_path):
         while True:
             abbr_name = input("Enter the new test abbreviation: ").strip()
             if abbr_name in tests:
-                selected_record['test'].abbr_name = abbr_name
+                selected_record['test'] = tests[abbr_name]
                 selected_record['unit'] = tests[abbr_name].unit
                 break
             else:
@@ -303,7 +274,7 @@ def update_patient_records(patients, tests, file_path):
                 new_test_date = input("Enter the new test date (format YYYY-MM-DD HH:MM): ").strip()
                 new_test_date_obj = datetime.strptime(new_test_date, "%Y-%m-%d %H:%M")
                 if datetime(2000, 1, 1) <= new_test_date_obj <= datetime.now():
-                    selected_record['test_date'] = new_test_date_obj.strftime("%Y-%m-%d %H:%M")
+                    selected_record['test_date'] = minutes_from_datetime(new_test_date_obj)
                     break
                 else:
                     print("Test date must be between 2000-01-01 and today. Please re-enter.")
@@ -334,22 +305,19 @@ def update_patient_records(patients, tests, file_path):
             while True:
                 try:
                     result_date = input(f"Enter the new result date (format YYYY-MM-DD HH:MM): ").strip()
-                    result_date_obj = datetime.strptime(result_date, "%Y-%m-%d %H:%M")
-                    if result_date_obj >= datetime.strptime(selected_record['test_date'], "%Y-%m-%d %H:%M"):
-                        selected_record['result_date'] = result_date_obj.strftime("%Y-%m-%d %H:%M")
+                    result_date_minutes = parse_minutes(result_date)
+                    if result_date_minutes >= selected_record['test_date']:
+                        selected_record['result_date'] = result_date_minutes
                         break
                     else:
                         print("Result date must be after the test date. Please re-enter.")
                 except ValueError:
                     print("Invalid date format. Please re-enter in the format YYYY-MM-DD HH:MM.")
-    patient.records[record_number] = selected_record
-    with open(file_path, 'w') as file:
-        for pid, patient in patients.items():
-            for record in patient.records:
-                line = f"{pid}: {record['test'].abbr_name}, {record['test_date']}, {record['result_value']}, {record['unit']}, {record['status']}"
-                if record['status'] == "completed":
-                    line += f", {record['result_date']}"
-                file.write(line + "\n")
+    records = storage.open_storage(file_path)
+    with records.writing():
+        # another session's edit of the same record, applied while catching up, is overwritten by this one
+        patients[patient_id].replace_record(record_number, selected_record)
+        records.update_record(patients, patient_id, record_number, selected_record)
 
     print("Record successfully updated.")
 
@@ -398,23 +366,96 @@ def update_medical_tests(tests, file_path):
         while True:
             try:
                 turnaround_time = input("Enter the new turnaround time (format DD-hh-mm): ").strip()
-                days, hours, minutes = map(int, turnaround_time.split('-'))
-                selected_test.turnaround_time = f"{days:02d}-{hours:02d}-{minutes:02d}"
+                selected_test.turnaround_time = turnaround_time
                 break
             except ValueError:
                 print("Invalid format. Please enter the turnaround time in the format DD-hh-mm.")
 
-    with open(file_path, 'w') as file:
-        for test in tests.values():
-            file.write(test.to_file_string())
+    test_file = locking.shared_file(file_path)
+    with test_file.writing():
+        # rewrites the tests as they are on disk now with only this one replaced, not this process's view of
+        # the others; other sessions' changes to them reach this one through refresh_medical_tests
+        saved_tests = read_medical_tests(test_file.path)
+        saved_tests[selected_test.abbr_name] = selected_test
+        with open(test_file.path, 'w') as file:
+            for test in saved_tests.values():
+                file.write(test.to_file_string())
     print("Medical test successfully updated.")
+    return selected_test
+
+
+def refresh_medical_tests(tests, file_path, patients=None):
+    # re-reads the test file when another process changed it; existing MedicalTest objects are updated in place,
+    # so the records pointing at them follow. Returns the abbreviations that were added or changed
+    test_file = locking.shared_file(file_path)
+    if not test_file.changed():
+        return []
+    with test_file.locked(exclusive=False) as lock:
+        generation = lock.generation()
+        saved_tests = read_medical_tests(test_file.path)
+    test_file.generation = generation
+
+    changed = []
+    for abbr_name, saved in saved_tests.items():
+        test = tests.get(abbr_name)
+        if test is None:
+            tests[abbr_name] = saved
+            changed.append(abbr_name)
+        elif str(test) != str(saved):
+            test.name, test.unit = saved.name, saved.unit
+            test.lower_range, test.upper_range = saved.lower_range, saved.upper_range
+            test.turnaround_minutes = saved.turnaround_minutes
+            changed.append(abbr_name)
+            if patients is not None:
+                patients.refresh_test(abbr_name)
+    return changed
+
+
+def refresh_shared_data(tests, test_file, patients, records):
+    # what other sessions wrote since the last refresh: tests first, since new records may use new tests;
+    # returns the number of tests and records that changed
+    changed_tests = refresh_medical_tests(tests, test_file, patients)
+    return len(changed_tests) + storage.open_storage(records).refresh()
+
+
+def _patients_from_rows(index, rows):
+    filtered_patients = {}
+    for pid, records in index.group_rows(rows).items():
+        filtered_patients[pid] = Patient(pid)
+        filtered_patients[pid].records = records
+    return filtered_patients
+
 
+def _instrumented_filter(name):
+    # timed, plus the filter's selectivity (records matched / records scanned) while metrics are enabled
+    def decorate(function):
+        timed_function = metrics.timed(name)(function)
 
+        @functools.wraps(function)
+        def wrapper(patients, *args, **kwargs):
+            result = timed_function(patients, *args, **kwargs)
+            if metrics.enabled():
+                metrics.selectivity(name, count_records(patients), count_records(result))
+            return result
+        return wrapper
+    return decorate
+
+
+@_instrumented_filter("filter_by_patient_id")
 def filter_by_patient_id(patients, patient_id):
-    return {pid: patient for pid, patient in patients.items() if pid == patient_id}
+    if patient_id in patients:
+        return {patient_id: patients[patient_id]}
+    return {}
 
 
+@_instrumented_filter("filter_by_test_name")
 def filter_by_test_name(patients, test_name):
+    if isinstance(patients, ShardedPatientStore):
+        return patients.query(Query.where(("test_name", test_name)))
+    index = getattr(patients, 'index', None)
+    if index is not None:
+        return _patients_from_rows(index, index.rows_for_test(test_name))
+
     filtered_patients = {}
     for pid, patient in patients.items():
         filtered_records = [record for record in patient.records if record['test'].abbr_name == test_name]
@@ -424,7 +465,14 @@ def filter_by_test_name(patients, test_name):
     return filtered_patients
 
 
+@_instrumented_filter("filter_by_abnormal_tests")
 def filter_by_abnormal_tests(patients):
+    if isinstance(patients, ShardedPatientStore):
+        return patients.query(Query.where(("abnormal",)))
+    index = getattr(patients, 'index', None)
+    if index is not None:
+        return _patients_from_rows(index, index.abnormal_rows())
+
     filtered_patients = {}
     for pid, patient in patients.items():
         filtered_records = [record for record in patient.records if
@@ -435,18 +483,34 @@ def filter_by_abnormal_tests(patients):
     return filtered_patients
 
 
+@_instrumented_filter("filter_by_date_range")
 def filter_by_date_range(patients, start_date, end_date):
+    if isinstance(patients, ShardedPatientStore):
+        return patients.query(Query.where(("date_range", start_date, end_date)))
+    index = getattr(patients, 'index', None)
+    start_minutes = minutes_from_datetime(start_date)
+    end_minutes = minutes_from_datetime(end_date)
+    if index is not None:
+        return _patients_from_rows(index, index.rows_for_date_range(start_minutes, end_minutes))
+
     filtered_patients = {}
     for pid, patient in patients.items():
         filtered_records = [record for record in patient.records if
-                            start_date <= datetime.strptime(record['test_date'], "%Y-%m-%d %H:%M") <= end_date]
+                            start_minutes <= record['test_date'] <= end_minutes]
         if filtered_records:
             filtered_patients[pid] = Patient(pid)
             filtered_patients[pid].records = filtered_records
     return filtered_patients
 
 
+@_instrumented_filter("filter_by_status")
 def filter_by_status(patients, status):
+    if isinstance(patients, ShardedPatientStore):
+        return patients.query(Query.where(("status", status)))
+    index = getattr(patients, 'index', None)
+    if index is not None:
+        return _patients_from_rows(index, index.rows_for_status(status))
+
     filtered_patients = {}
     for pid, patient in patients.items():
         filtered_records = [record for record in patient.records if record['status'].lower() == status.lower()]
@@ -461,18 +525,21 @@ def convert_to_timedelta(turnaround_time_str):
     return timedelta(days=days, hours=hours, minutes=minutes)
 
 
+@_instrumented_filter("filter_by_turnaround_time")
 def filter_by_turnaround_time(patients, min_turnaround, max_turnaround):
-    min_turnaround_delta = convert_to_timedelta(min_turnaround)
-    max_turnaround_delta = convert_to_timedelta(max_turnaround)
+    if isinstance(patients, ShardedPatientStore):
+        return patients.query(Query.where(("turnaround", min_turnaround, max_turnaround)))
+    min_minutes = turnaround_minutes(min_turnaround)
+    max_minutes = turnaround_minutes(max_turnaround)
+    index = getattr(patients, 'index', None)
+    if index is not None:
+        return _patients_from_rows(index, index.rows_for_turnaround(min_minutes, max_minutes))
+
+    in_range = lambda test: min_minutes <= test.turnaround_minutes <= max_minutes
 
     filtered_patients = {}
     for pid, patient in patients.items():
-        filtered_records = []
-        for record in patient.records:
-            test = record['test']
-            turnaround_delta = convert_to_timedelta(test.turnaround_time)
-            if min_turnaround_delta <= turnaround_delta <= max_turnaround_delta:
-                filtered_records.append(record)
+        filtered_records = [record for record in patient.records if in_range(record['test'])]
         if filtered_records:
             filtered_patients[pid] = Patient(pid)
             filtered_patients[pid].records = filtered_records
@@ -487,7 +554,11 @@ def is_valid_date(date_str):
         return False
 
 
-def filter_medical_tests(patients):
+def apply_filter_criteria(patients, criteria):
+    return run_query(patients, Query.all(criteria))
+
+
+def prompt_filter_query():
     print("\nSelect the criteria you want to filter by:")
     print("1. Patient ID")
     print("2. Test Name")
@@ -514,24 +585,24 @@ def filter_medical_tests(patients):
             else:
                 print("Invalid input. Please enter a number between 1 and 6.")
 
-    filtered_patients = patients
+    criteria = []
 
     for criterion in selected_criteria:
         if criterion == 1:
             while True:
                 patient_id = input("Enter the Patient ID to filter by: ").strip()
                 if patient_id.isdigit():
-                    filtered_patients = filter_by_patient_id(filtered_patients, int(patient_id))
+                    criteria.append(("patient_id", int(patient_id)))
                     break
                 else:
                     print("Invalid input. Please enter a valid Patient ID.")
 
         elif criterion == 2:
             test_name = input("Enter the Test Name (abbreviation) to filter by: ").strip()
-            filtered_patients = filter_by_test_name(filtered_patients, test_name)
+            criteria.append(("test_name", test_name))
 
         elif criterion == 3:
-            filtered_patients = filter_by_abnormal_tests(filtered_patients)
+            criteria.append(("abnormal",))
 
         elif criterion == 4:
             while True:
@@ -540,133 +611,124 @@ def filter_medical_tests(patients):
                 if is_valid_date(start_date_str) and is_valid_date(end_date_str):
                     start_date = datetime.strptime(start_date_str, "%Y-%m-%d %H:%M")
                     end_date = datetime.strptime(end_date_str, "%Y-%m-%d %H:%M")
-                    filtered_patients = filter_by_date_range(filtered_patients, start_date, end_date)
+                    criteria.append(("date_range", start_date, end_date))
                     break
                 else:
                     print("Invalid date format. Please enter dates in the format YYYY-MM-DD HH:MM.")
 
         elif criterion == 5:
             status = input("Enter the Test Status to filter by (Pending, Completed, Reviewed): ").strip().lower()
-            filtered_patients = filter_by_status(filtered_patients, status)
+            criteria.append(("status", status))
 
         elif criterion == 6:
             while True:
                 min_turnaround = input("Enter the minimum turnaround time (DD-hh-mm): ").strip()
                 max_turnaround = input("Enter the maximum turnaround time (DD-hh-mm): ").strip()
                 if validate_turnaround_time(min_turnaround) and validate_turnaround_time(max_turnaround):
-                    filtered_patients = filter_by_turnaround_time(filtered_patients, min_turnaround, max_turnaround)
+                    criteria.append(("turnaround", min_turnaround, max_turnaround))
                     break
                 else:
                     print("Invalid input. Please enter turnaround time in the format DD-hh-mm.")
 
-    '''
-    if filtered_patients:
-        print("\nFiltered Medical Records:")
-        print_all_medical_records(filtered_patients)
-    else:
-        print("No records found matching the selected criteria.")
-    '''
-    return filtered_patients
-
-
-def calculate_summary_statistics(filtered_patients):
-    if not filtered_patients:
-        return "No records found for the selected criteria."
-
-    test_values = []
-    turnaround_times = []
-
-    for patient in filtered_patients.values():
-        for record in patient.records:
-            test_values.append(record['result_value'])
-
-            test = record['test']
-            turnaround_delta = convert_to_timedelta(test.turnaround_time)
-            turnaround_times.append(turnaround_delta)
-
-    min_test_value = min(test_values)
-    max_test_value = max(test_values)
-    avg_test_value = mean(test_values)
-
-    min_turnaround_time = min(turnaround_times)
-    max_turnaround_time = max(turnaround_times)
-    avg_turnaround_time = sum(turnaround_times, timedelta()) / len(turnaround_times)
-
-    min_turnaround_time_str = f"{min_turnaround_time.days}-{min_turnaround_time.seconds // 3600}-{(min_turnaround_time.seconds // 60) % 60}"
-    max_turnaround_time_str = f"{max_turnaround_time.days}-{max_turnaround_time.seconds // 3600}-{(max_turnaround_time.seconds // 60) % 60}"
-    avg_turnaround_time_str = f"{avg_turnaround_time.days}-{avg_turnaround_time.seconds // 3600}-{(avg_turnaround_time.seconds // 60) % 60}"
+    query = Query.all(criteria)
+    if len(criteria) > 1:
+        while True:
+            combine = input("Match records meeting ALL criteria or ANY criterion? (All/any): ").strip().lower()
+            if combine in ("", "all", "any"):
+                break
+            print("Invalid input. Please enter All or Any.")
+        if combine == "any":
+            query = Query.any(criteria)
+    return query
 
-    summary = f"Summary Report for Filtered Records:\n" \
-              f"-----------------------------------\n" \
-              f"Test Values:\n" \
-              f" - Minimum Test Value: {min_test_value}\n" \
-              f" - Maximum Test Value: {max_test_value}\n" \
-              f" - Average Test Value: {avg_test_value:.2f}\n\n" \
-              f"Turnaround Times:\n" \
-              f" - Minimum Turnaround Time: {min_turnaround_time_str}\n" \
-              f" - Maximum Turnaround Time: {max_turnaround_time_str}\n" \
-              f" - Average Turnaround Time: {avg_turnaround_time_str}\n"
 
-    return summary
+@_instrumented_filter("run_query")
+def run_query(patients, query, storage_backend=None):
+    if isinstance(patients, ShardedPatientStore):
+        return patients.query(query)
+    if storage_backend is None or not storage_backend.supports_query:
+        return query.execute(patients)
+    cache = getattr(patients, 'cache', None)
+    if cache is None:
+        return storage_backend.query(query)
+    return cache.get_or_compute(("storage", query.key()), patients.index.version,
+                                lambda: storage_backend.query(query))
 
 
-def export_medical_records(patients, filename="medical_records.csv"):
-    with open(filename, mode='w', newline='') as file:
-        writer = csv.writer(file)
+def filter_medical_tests(patients, storage_backend=None):
+    return run_query(patients, prompt_filter_query(), storage_backend)
 
-        writer.writerow(["Patient ID", "Abbreviation", "Test Date", "Result Value", "Unit", "Status", "Result Date"])
-        for patient in patients.values():
-            for record in patient.records:
-                writer.writerow([
-                    patient.patient_id,
-                    record['test'].abbr_name,
-                    record['test_date'],
-                    record['result_value'],
-                    record['unit'],
-                    record['status'],
-                    record['result_date'] if 'result_date' in record else ''
-                ])
 
-    print(f"Medical records exported successfully to {filename}")
+@metrics.timed("calculate_summary_statistics")
+def calculate_summary_statistics(filtered_patients, group_by=None, approximate=False):
+    if not filtered_patients:
+        return "No records found for the selected criteria."
 
+    if approximate:
+        return approximate_summary_statistics(filtered_patients, group_by)
 
-def import_medical_records(file_path, tests, patients):
-    with open(file_path, 'r') as file:
-        next(file)
+    if isinstance(filtered_patients, ShardedPatientStore):
+        summary = filtered_patients.summarize(group_by=group_by)
+    elif not group_by and getattr(filtered_patients, 'index', None) is not None:
+        # the whole store: the report only needs min/max/mean, which the rollups hold
+        summary = rollups.summarize(filtered_patients.index)
+    else:
+        summary = stats_engine.summarize_patients(filtered_patients, group_by=group_by)
+    if group_by:
+        return stats_engine.render_group_report(summary, group_by.capitalize())
+    return stats_engine.render_summary_report(summary)
+
+
+def approximate_summary_statistics(patients, group_by=None):
+    # bounded-memory report: the sketches kept at ingest when they cover these records, otherwise one
+    # streaming pass; percentiles and distinct patient counts are estimates with stated error bounds
+    sketch_set = getattr(getattr(patients, 'index', None), 'sketches', None)
+    if sketch_set is None or (group_by and sketch_set.group_by != group_by):
+        sketch_set = sketches.SketchSet(group_by or "test").add_patients(patients)
+    summary = sketch_set.summary(grouped=bool(group_by))
+    return sketches.render_approximate_report(summary, group_by.capitalize() if group_by else None)
+
+
+def query_summary_statistics(patients, query, group_by=None, storage_backend=None):
+    # calculate_summary_statistics over run_query's result, reusing the report while the data is unchanged
+    if isinstance(patients, ShardedPatientStore):
+        summary = patients.summarize(query, group_by)
+        if group_by:
+            return stats_engine.render_group_report(summary, group_by.capitalize())
+        return stats_engine.render_summary_report(summary)
+    plan = rollups.rollup_plan(query) if not group_by else None
+    if plan is not None and getattr(patients, 'index', None) is not None:
+        # criteria on whole (test, status, day) cells: answered from the rollups without touching the records
+        return stats_engine.render_summary_report(rollups.summarize(patients.index, plan))
+    cache = getattr(patients, 'cache', None)
+    if cache is None:
+        return calculate_summary_statistics(run_query(patients, query, storage_backend), group_by)
+    return cache.get_or_compute(("summary", query.key(), group_by), patients.index.version,
+                                lambda: calculate_summary_statistics(run_query(patients, query, storage_backend),
+                                                                     group_by))
+
+
+def patient_test_trend(patients, patient_id, test_name, window=trends.DEFAULT_WINDOW):
+    # the patient's results for one test in date order, with moving average, delta and rate of change
+    return trends.rolling(trends.series_points(patients, patient_id, test_name), window)
+
+
+@metrics.timed("patients_trending_abnormal")
+def patients_trending_abnormal(patients, window=trends.DEFAULT_WINDOW, horizon_days=trends.DEFAULT_HORIZON_DAYS):
+    return trends.trending_abnormal(patients, window=window, horizon_days=horizon_days)
+
+
+@metrics.timed("export_medical_records")
+def export_medical_records(patients, filename="medical_records.csv", incremental=False):
+    count = record_export.export_records(patients, filename, incremental)
+    if incremental:
+        print(f"Medical records exported to {filename} ({count} rows written)")
+    else:
+        print(f"Medical records exported successfully to {filename}")
 
-        for line in file:
-            try:
-                record_parts = line.strip().split(",")
-
-                patient_id = int(record_parts[0].strip())
-                abbr_name = record_parts[1].strip()
-                test_date = datetime.strptime(record_parts[2].strip(), "%Y-%m-%d %H:%M")
-                result_value = float(record_parts[3].strip())
-                unit = record_parts[4].strip()
-                status = record_parts[5].strip()
-                result_date = None
-                if len(record_parts) > 6 and record_parts[6].strip():
-                    result_date = datetime.strptime(record_parts[6].strip(), "%Y-%m-%d %H:%M")
-
-                if abbr_name in tests:
-                    test = tests[abbr_name]
-
-                    record = {
-                        "test": test,
-                        "test_date": test_date.strftime("%Y-%m-%d %H:%M"),
-                        "result_value": result_value,
-                        "unit": unit,
-                        "status": status,
-                        "result_date": result_date.strftime("%Y-%m-%d %H:%M") if result_date else None
-                    }
-
-                    if patient_id not in patients:
-                        patients[patient_id] = Patient(patient_id)
-
-                    patients[patient_id].add_record(record)
-                else:
-                    print(f"Warning: Test '{abbr_name}' not found in the list of valid medical tests.")
-            except Exception as e:
-                print(f"Error processing line: {line}\nException: {e}")
 
+@metrics.timed("import_medical_records")
+def import_medical_records(file_path, tests, patients, storage_backend=None, reject_path=None):
+    report = bulk_import.bulk_import(file_path, tests, patients, storage_backend, reject_path=reject_path)
+    print(report)
     return patients
@@ -0,0 +1,99 @@
+import os
+from record_format import parse_record_line, format_record_line
+
+JOURNAL_SUFFIX = ".journal"
+COMPACT_THRESHOLD_BYTES = 1024 * 1024
+
+
+def journal_path(file_path):
+    return file_path + JOURNAL_SUFFIX
+
+
+def _fsync_dir(file_path):
+    # the rename itself is only durable once the directory entry is flushed
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(file_path)), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def append_update(file_path, patient_id, record):
+    # one entry per edit: the full record line, which carries the id of the record it replaces; replayed in order
+    # on startup
+    with open(journal_path(file_path), 'a') as file:
+        file.write(format_record_line(patient_id, record) + "\n")
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def replay_journal(file_path, tests, patients, start=0):
+    # start: byte offset of the first entry to apply, for catching up with entries other processes appended
+    path = journal_path(file_path)
+    if not os.path.exists(path):
+        return 0
+
+    applied = 0
+    with open(path, 'r') as file:
+        file.seek(start)
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                record_number, record_line = line.split(" ", 1)
+                if record_number.isdigit():
+                    # entry written before record ids: "<record number> <line>" of the number-th line of the patient
+                    patient_id, abbr_name, record = parse_record_line(record_line, tests)
+                    if record is not None:
+                        record.record_id = int(record_number) + 1
+                else:
+                    patient_id, abbr_name, record = parse_record_line(line, tests)
+                if record is None:
+                    print(f"Warning: Test '{abbr_name}' not found in the list of valid medical tests.")
+                    continue
+
+                patient = patients.get(patient_id)
+                record_number = None if patient is None or record.record_id is None else \
+                    patient.find_record(record.record_id)
+                if record_number is None:
+                    # an edit is only ever journaled for a record already in the record file
+                    print(f"Warning: Journal entry refers to a missing record: {line}")
+                    continue
+                patient.replace_record(record_number, record)
+                applied += 1
+            except Exception as e:
+                # a torn last entry from a crash mid-write is skipped here
+                print(f"Error processing journal line: {line}\nException: {e}")
+
+    return applied
+
+
+def compact_medical_records(file_path, patients):
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, 'w') as file:
+        for pid, patient in patients.items():
+            for record in patient.records:
+                file.write(format_record_line(pid, record) + "\n")
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(tmp_path, file_path)
+    _fsync_dir(file_path)
+
+    # replaying a stale journal over the new base file is idempotent, so a crash here is safe
+    path = journal_path(file_path)
+    if os.path.exists(path):
+        os.remove(path)
+        _fsync_dir(file_path)
+
+
+def has_pending_updates(file_path):
+    path = journal_path(file_path)
+    return os.path.exists(path) and os.path.getsize(path) > 0
+
+
+def needs_compaction(file_path, threshold=COMPACT_THRESHOLD_BYTES):
+    path = journal_path(file_path)
+    return os.path.exists(path) and os.path.getsize(path) >= threshold
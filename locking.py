@@ -0,0 +1,149 @@
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # no advisory locks (e.g. Windows): single-process behaviour, generations still counted
+
+LOCK_SUFFIX = ".lock"
+
+_held = threading.local()  # per thread: lock path -> FileLock, so nested lock() calls reuse the lock already held
+
+
+def lock_path(file_path):
+    return file_path + LOCK_SUFFIX
+
+
+def _read_counters(fd):
+    # "<generation> <next record id>"; the record id counter is left out until something allocates ids
+    os.lseek(fd, 0, os.SEEK_SET)
+    fields = os.read(fd, 64).split()
+    return int(fields[0]) if fields else 0, int(fields[1]) if len(fields) > 1 else None
+
+
+def _write_counters(fd, generation, next_id):
+    # overwritten in place, never truncated: both counters only grow, so readers see the old or the new value
+    data = str(generation) if next_id is None else f"{generation} {next_id}"
+    os.lseek(fd, 0, os.SEEK_SET)
+    os.write(fd, data.encode())
+
+
+def read_generation(file_path):
+    # unlocked peek at the counter; a torn read of a write in progress reads as -1, which never matches
+    try:
+        fd = os.open(lock_path(file_path), os.O_RDONLY)
+    except FileNotFoundError:
+        return 0
+    try:
+        return _read_counters(fd)[0]
+    except ValueError:
+        return -1
+    finally:
+        os.close(fd)
+
+
+class FileLock:
+    # advisory flock on "<file>.lock", which also holds the file's generation (the number of writes so far) and
+    # the next free record id
+    def __init__(self, fd, exclusive):
+        self.fd = fd
+        self.exclusive = exclusive
+        self.depth = 1
+
+    def generation(self):
+        return _read_counters(self.fd)[0]
+
+    def bump(self):
+        if not self.exclusive:
+            raise RuntimeError("The generation can only be bumped under an exclusive lock")
+        generation, next_id = _read_counters(self.fd)
+        _write_counters(self.fd, generation + 1, next_id)
+        return generation + 1
+
+    def allocate_ids(self, count, first_free):
+        # the first of count consecutive record ids; first_free() -> where the counter starts when there is none
+        if not self.exclusive:
+            raise RuntimeError("Record ids can only be allocated under an exclusive lock")
+        generation, next_id = _read_counters(self.fd)
+        if next_id is None:
+            next_id = first_free()
+        _write_counters(self.fd, generation, next_id + count)
+        return next_id
+
+
+@contextmanager
+def file_lock(file_path, exclusive=True):
+    # shared for readers, exclusive for writers; re-entrant within a thread (a shared lock is upgraded when an
+    # exclusive one is asked for inside it)
+    path = os.path.abspath(lock_path(file_path))
+    held = getattr(_held, "locks", None)
+    if held is None:
+        held = _held.locks = {}
+
+    lock = held.get(path)
+    if lock is not None:
+        upgrade = exclusive and not lock.exclusive
+        if upgrade and fcntl is not None:
+            fcntl.flock(lock.fd, fcntl.LOCK_EX)
+        lock.exclusive |= upgrade
+        lock.depth += 1
+        try:
+            yield lock
+        finally:
+            lock.depth -= 1
+            if upgrade:
+                lock.exclusive = False
+                if fcntl is not None:
+                    fcntl.flock(lock.fd, fcntl.LOCK_SH)
+        return
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        lock = held[path] = FileLock(fd, exclusive)
+        try:
+            yield lock
+        finally:
+            del held[path]
+    finally:
+        # closing the descriptor releases the flock
+        os.close(fd)
+
+
+class SharedFile:
+    # a data file several processes read and write; generation is the last one this process has caught up with
+    def __init__(self, path):
+        self.path = path
+        self.generation = read_generation(path)
+
+    def changed(self):
+        # one small read, no lock: whether anyone wrote since this process last caught up
+        return read_generation(self.path) != self.generation
+
+    def locked(self, exclusive=True):
+        return file_lock(self.path, exclusive)
+
+    @contextmanager
+    def writing(self):
+        # exclusive lock for one write; bumps the generation once the outermost write is done, and keeps this
+        # process caught up only if it was before (a caller that merges the other writes first sets generation)
+        with self.locked() as lock:
+            if lock.depth > 1:
+                yield lock
+                return
+            generation = lock.generation()
+            try:
+                yield lock
+            finally:
+                bumped = lock.bump()
+                if self.generation == generation:
+                    self.generation = bumped
+
+
+def shared_file(target):
+    if isinstance(target, SharedFile):
+        return target
+    return SharedFile(target)
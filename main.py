@@ -1,42 +1,77 @@
+import os
 import functions as f
+import locking
+import parallel_loader
+import snapshot
+import storage
+from patient import PatientStore
+from sharded_store import ShardedPatientStore
 
 
 def main():
-    valid_tests = f.read_medical_tests("medicalTest.txt")
-    patients = {}
-    f.read_medical_records("medicalRecord.txt", valid_tests, patients)
+    # MEDICAL_SHARDS=N partitions the patients across N shards queried in parallel worker processes
+    shards = int(os.environ.get("MEDICAL_SHARDS") or 1)
+    patients = ShardedPatientStore(shards) if shards > 1 else PatientStore()
+    # MEDICAL_LOAD_WORKERS=N parses the record file in N processes when there is no fresh snapshot (0: one per CPU)
+    workers = int(os.environ.get(parallel_loader.WORKERS_ENV) or 1)
+    records = storage.open_storage(os.environ.get("MEDICAL_RECORDS_STORAGE", "medicalRecord.txt"))
+    # several sessions can share the files: each picks up the others' changes before every menu choice
+    test_file = locking.SharedFile("medicalTest.txt")
+    if isinstance(records, storage.TextStorage):
+        with records.shared.locked(exclusive=False):
+            valid_tests = snapshot.load_medical_data(test_file.path, records.file_path, patients, workers)
+            records.attach(valid_tests, patients)
+    else:
+        valid_tests = f.read_medical_tests(test_file.path)
+        f.read_medical_records(records, valid_tests, patients, workers)
     print("\nMedical Test Management System")
     while True:
         f.display_menu()
         choice = input("\nEnter your choice (1-11): ")
+        changes = f.refresh_shared_data(valid_tests, test_file, patients, records)
+        if changes:
+            print(f"Loaded {changes} changes made by other sessions.")
 
         if choice == '1':
-            f.add_new_medical_test(valid_tests, "medicalTest.txt")
+            f.add_new_medical_test(valid_tests, test_file)
         elif choice == '2':
-            f.add_new_medical_test_record(valid_tests, patients, "medicalRecord.txt")
+            f.add_new_medical_test_record(valid_tests, patients, records)
         elif choice == '3':
-            f.update_patient_records(patients, valid_tests, "medicalRecord.txt")
+            f.update_patient_records(patients, valid_tests, records)
         elif choice == '4':
-            f.update_medical_tests(valid_tests, "medicalTest.txt")
+            updated_test = f.update_medical_tests(valid_tests, test_file)
+            flipped = patients.refresh_test(updated_test.abbr_name)
+            if flipped["abnormal"] or flipped["normal"]:
+                print(f"{len(flipped['abnormal'])} stored {updated_test.abbr_name} results are now abnormal, "
+                      f"{len(flipped['normal'])} are now normal.")
+                for patient_id, record in flipped["abnormal"]:
+                    print(f" - Patient {patient_id}: {record['result_value']} {record['unit']} is now abnormal")
         elif choice == '5':
-            filtered_patients = f.filter_medical_tests(patients)
+            filtered_patients = f.filter_medical_tests(patients, records)
             if filtered_patients:
                 f.print_all_medical_records(filtered_patients)
             else:
                 print("No matching data found.")
         elif choice == '6':
-            filtered_records = f.filter_medical_tests(patients)
-            report = f.calculate_summary_statistics(filtered_records)
+            query = f.prompt_filter_query()
+            group_by = input("Break the report down by (test/status/patient, leave empty for none): ").strip().lower()
+            report = f.query_summary_statistics(patients, query, group_by if group_by in ("test", "status", "patient") else None, records)
             print(report)
         elif choice == '7':
-            f.export_medical_records(patients)
+            incremental = input("Export only records added or changed since the last export? (y/N): ").strip().lower() == 'y'
+            f.export_medical_records(patients, incremental=incremental)
         elif choice == '8':
-            f.import_medical_records("medical_records.csv", valid_tests, patients)
+            f.import_medical_records("medical_records.csv", valid_tests, patients, records)
         elif choice == '9':
             f.print_all_medical_tests(valid_tests)
         elif choice == '10':
             f.print_all_medical_records(patients)
         elif choice == '11':
+            if records.close(patients) and not test_file.changed():
+                snapshot.refresh_snapshot(test_file.path, records.file_path, valid_tests, patients, records.shared)
+            cache_stats = patients.cache.stats()
+            print(f"Query cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                  f"{cache_stats['invalidations']} invalidated by changes.")
             print("Exiting the system. Goodbye!")
             break
         else:
@@ -1,3 +1,6 @@
+from timeutil import turnaround_minutes, format_turnaround_minutes
+
+
 class MedicalTest:
     def __init__(self, name, abbr_name, lower_range, upper_range, unit, turnaround_time):
         self.name = name
@@ -5,7 +8,15 @@ class MedicalTest:
         self.lower_range = lower_range
         self.upper_range = upper_range
         self.unit = unit
-        self.turnaround_time = turnaround_time
+        self.turnaround_minutes = turnaround_minutes(turnaround_time)
+
+    @property
+    def turnaround_time(self):
+        return format_turnaround_minutes(self.turnaround_minutes)
+
+    @turnaround_time.setter
+    def turnaround_time(self, value):
+        self.turnaround_minutes = turnaround_minutes(value)
 
     def is_result_normal(self, result_value):
         if self.lower_range is not None and result_value < self.lower_range:
@@ -14,6 +25,17 @@ class MedicalTest:
             return False
         return True
 
+    def abnormal_check(self):
+        # bounds are bound once, so the per-result check is a single comparison chain
+        lower_range, upper_range = self.lower_range, self.upper_range
+        if lower_range is not None and upper_range is not None:
+            return lambda result_value: result_value < lower_range or result_value > upper_range
+        if lower_range is not None:
+            return lambda result_value: result_value < lower_range
+        if upper_range is not None:
+            return lambda result_value: result_value > upper_range
+        return lambda result_value: False
+
     def __str__(self):
         return f"{self.name} ({self.abbr_name}): Range: > {self.lower_range}, < {self.upper_range}; Unit: {self.unit}; Turnaround Time: {self.turnaround_time}"
 
@@ -0,0 +1,213 @@
+import atexit
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+METRICS_ENV = "MEDICAL_METRICS"  # metrics file written at exit; a .prom suffix selects the Prometheus text format
+PROFILE_ENV = "MEDICAL_PROFILE"  # "cprofile" or "tracemalloc": profile one cli.py command
+PROFILE_MODES = ("cprofile", "tracemalloc")
+PROMETHEUS_SUFFIXES = (".prom",)
+PROFILE_TOP = 25
+
+
+class Metrics:
+    # process-wide phase timers and counters; while disabled every call is a single flag check
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timers = {}  # name -> [calls, total seconds, max seconds]
+
+    def count(self, name, value=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        if self.enabled:
+            with self.lock:
+                timer = self.timers.get(name)
+                if timer is None:
+                    self.timers[name] = [1, seconds, seconds]
+                else:
+                    timer[0] += 1
+                    timer[1] += seconds
+                    if seconds > timer[2]:
+                        timer[2] = seconds
+
+    @contextmanager
+    def timer(self, name):
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def timed_iter(self, name, iterable):
+        # times producing each item (e.g. parsing the next batch) but not what the consumer does with it
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.observe(name, time.perf_counter() - started)
+            yield item
+
+    def selectivity(self, name, scanned, matched):
+        self.count(f"{name}.rows_scanned", scanned)
+        self.count(f"{name}.rows_matched", matched)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.timers.clear()
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            timers = {name: {"calls": calls, "total_seconds": total, "mean_seconds": total / calls,
+                             "max_seconds": longest}
+                      for name, (calls, total, longest) in self.timers.items()}
+        selectivity = {}
+        for name, scanned in counters.items():
+            if name.endswith(".rows_scanned"):
+                prefix = name[:-len(".rows_scanned")]
+                selectivity[prefix] = counters.get(f"{prefix}.rows_matched", 0) / scanned if scanned else 0.0
+        return {"counters": counters, "timers": timers, "selectivity": selectivity}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        # text exposition format 0.0.4; metric and phase names become labels
+        snapshot = self.snapshot()
+        lines = ["# TYPE medical_events_total counter"]
+        lines += [f'medical_events_total{{name="{_label(name)}"}} {value}'
+                  for name, value in sorted(snapshot["counters"].items())]
+        lines.append("# TYPE medical_phase_seconds summary")
+        for name, timer in sorted(snapshot["timers"].items()):
+            lines.append(f'medical_phase_seconds_count{{phase="{_label(name)}"}} {timer["calls"]}')
+            lines.append(f'medical_phase_seconds_sum{{phase="{_label(name)}"}} {timer["total_seconds"]:.6f}')
+        lines.append("# TYPE medical_phase_max_seconds gauge")
+        lines += [f'medical_phase_max_seconds{{phase="{_label(name)}"}} {timer["max_seconds"]:.6f}'
+                  for name, timer in sorted(snapshot["timers"].items())]
+        lines.append("# TYPE medical_filter_selectivity gauge")
+        lines += [f'medical_filter_selectivity{{filter="{_label(name)}"}} {value:.6f}'
+                  for name, value in sorted(snapshot["selectivity"].items())]
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        text = self.to_prometheus() if path.endswith(PROMETHEUS_SUFFIXES) else self.to_json()
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as file:
+            file.write(text)
+        os.replace(tmp_path, path)
+
+
+def _label(value):
+    return re.sub(r'["\\\n]', "_", value)
+
+
+METRICS = Metrics()
+count = METRICS.count
+observe = METRICS.observe
+timer = METRICS.timer
+timed_iter = METRICS.timed_iter
+selectivity = METRICS.selectivity
+_dump_paths = set()
+
+
+def enabled():
+    return METRICS.enabled
+
+
+def enable(path=None):
+    # starts collecting; with a path the metrics are written there when the process exits
+    METRICS.enabled = True
+    if path and path not in _dump_paths:
+        _dump_paths.add(path)
+        atexit.register(METRICS.dump, path)
+
+
+def timed(name):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                METRICS.observe(name, time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+
+def _profile_report(mode, top, collect):
+    if mode == "cprofile":
+        stream = io.StringIO()
+        pstats.Stats(collect, stream=stream).sort_stats("cumulative").print_stats(top)
+        return stream.getvalue()
+    snapshot, current, peak = collect
+    lines = [f"tracemalloc: {current / 2 ** 20:.1f} MiB still allocated, peak {peak / 2 ** 20:.1f} MiB",
+             f"top {top} allocation sites still holding memory:"]
+    lines += [f"  {stat}" for stat in snapshot.statistics("lineno")[:top]]
+    return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def profiled(mode, output=None, top=PROFILE_TOP):
+    # opt-in profile of one block: cProfile writes pstats data to output, tracemalloc a text report;
+    # either way the top entries go to stderr
+    if not mode:
+        yield
+        return
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Unknown profile mode {mode!r}, expected one of {', '.join(PROFILE_MODES)}")
+
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+        if output:
+            profiler.dump_stats(output)
+        report = _profile_report(mode, top, profiler)
+    else:
+        tracemalloc.start()
+        try:
+            yield
+            current, peak = tracemalloc.get_traced_memory()
+            collected = (tracemalloc.take_snapshot(), current, peak)
+        finally:
+            tracemalloc.stop()
+        report = _profile_report(mode, top, collected)
+        if output:
+            with open(output, 'w') as file:
+                file.write(report)
+    print(report, file=sys.stderr)
+
+
+if os.environ.get(METRICS_ENV):
+    enable(os.environ[METRICS_ENV])
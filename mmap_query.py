@@ -0,0 +1,195 @@
+import mmap
+import sys
+from array import array
+from patient import Patient
+from record import Record
+from record_store import NO_DATE
+from snapshot import is_current, read_header, snapshot_path, tests_from_header
+from timeutil import minutes_from_datetime, turnaround_minutes
+import locking
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def _release(column):
+    # numpy arrays over the map go with their last reference; memoryviews have to be released
+    if isinstance(column, memoryview):
+        column.release()
+
+
+class MappedRecords:
+    # read-only queries straight over the columns of a snapshot file; nothing is copied until rows match
+    def __init__(self, path, use_numpy=None):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = read_header(self.map)
+        if header["byteorder"] != sys.byteorder:
+            self.close()
+            raise ValueError(f"Snapshot {path} was written on a {header['byteorder']}-endian machine")
+
+        self.use_numpy = np is not None if use_numpy is None else use_numpy
+        self.tests = tests_from_header(header)
+        self.test_names = header["test_names"]
+        self.units = header["units"]
+        self.statuses = header["statuses"]
+        self.columns = {}
+        view = memoryview(self.map)
+        for entry in header["columns"]:
+            start = header["data_start"] + entry["offset"]
+            if self.use_numpy:
+                self.columns[entry["name"]] = np.frombuffer(self.map, dtype=np.dtype(entry["typecode"]),
+                                                            count=entry["length"], offset=start)
+            else:
+                size = entry["length"] * array(entry["typecode"]).itemsize
+                self.columns[entry["name"]] = view[start:start + size].cast(entry["typecode"])
+        self.size = len(self.columns["values"])
+        self._patient_rows = None
+
+    def __len__(self):
+        return self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        # views must be released before the map can be closed
+        columns, self.columns = getattr(self, "columns", {}), {}
+        while columns:
+            _release(columns.popitem()[1])
+        if getattr(self, "map", None) is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def _row_range(self, patient_id):
+        if self._patient_rows is None:
+            self._patient_rows = dict(zip(self.columns["range_patient_ids"].tolist(),
+                                          zip(self.columns["range_starts"].tolist(),
+                                              self.columns["range_stops"].tolist())))
+        return self._patient_rows.get(patient_id, (0, 0))
+
+    def _test_ids(self, predicate):
+        return [test_id for test_id, abbr_name in enumerate(self.test_names)
+                if abbr_name in self.tests and predicate(self.tests[abbr_name])]
+
+    def _status_codes(self, status):
+        return [code for code, name in enumerate(self.statuses) if name.lower() == status.lower()]
+
+    def _bounds(self):
+        lower = [self.tests[abbr_name].lower_range if abbr_name in self.tests else None for abbr_name in self.test_names]
+        upper = [self.tests[abbr_name].upper_range if abbr_name in self.tests else None for abbr_name in self.test_names]
+        return lower, upper
+
+    def _turnaround_predicate(self, min_turnaround, max_turnaround):
+        min_minutes = turnaround_minutes(min_turnaround)
+        max_minutes = turnaround_minutes(max_turnaround)
+        return lambda test: min_minutes <= test.turnaround_minutes <= max_minutes
+
+    def query(self, criteria):
+        # the patient id criterion narrows to that patient's row range before anything is scanned
+        start, stop = 0, self.size
+        for criterion in criteria:
+            if criterion[0] == "patient_id":
+                row_start, row_stop = self._row_range(criterion[1])
+                start, stop = max(start, row_start), min(stop, row_stop)
+        if start >= stop:
+            return []
+        remaining = [criterion for criterion in criteria if criterion[0] != "patient_id"]
+        if self.use_numpy:
+            return (np.flatnonzero(self._mask_numpy(remaining, start, stop)) + start).tolist()
+        return self._query_python(remaining, start, stop)
+
+    def _mask_numpy(self, criteria, start, stop):
+        columns = {name: column[start:stop] for name, column in self.columns.items()
+                   if name in ("test_ids", "test_dates", "values", "status_codes")}
+        mask = np.ones(stop - start, dtype=bool)
+        for criterion in criteria:
+            kind, args = criterion[0], criterion[1:]
+            if kind == "test_name":
+                mask &= np.isin(columns["test_ids"], self._test_ids(lambda test: test.abbr_name == args[0]))
+            elif kind == "abnormal":
+                lower, upper = self._bounds()
+                lower = np.array([np.nan if value is None else value for value in lower])[columns["test_ids"]]
+                upper = np.array([np.nan if value is None else value for value in upper])[columns["test_ids"]]
+                mask &= (columns["values"] < lower) | (columns["values"] > upper)
+            elif kind == "date_range":
+                test_dates = columns["test_dates"]
+                mask &= (test_dates >= minutes_from_datetime(args[0])) & (test_dates <= minutes_from_datetime(args[1]))
+            elif kind == "status":
+                mask &= np.isin(columns["status_codes"], self._status_codes(args[0]))
+            elif kind == "turnaround":
+                mask &= np.isin(columns["test_ids"], self._test_ids(self._turnaround_predicate(*args)))
+            else:
+                raise ValueError(f"Unknown filter criterion: {kind}")
+        return mask
+
+    def _query_python(self, criteria, start, stop):
+        rows = range(start, stop)
+        for criterion in criteria:
+            kind, args = criterion[0], criterion[1:]
+            if kind == "test_name":
+                wanted = set(self._test_ids(lambda test: test.abbr_name == args[0]))
+                test_ids = self.columns["test_ids"]
+                rows = [row for row in rows if test_ids[row] in wanted]
+            elif kind == "abnormal":
+                lower, upper = self._bounds()
+                test_ids = self.columns["test_ids"]
+                values = self.columns["values"]
+                rows = [row for row in rows
+                        if (lower[test_ids[row]] is not None and values[row] < lower[test_ids[row]])
+                        or (upper[test_ids[row]] is not None and values[row] > upper[test_ids[row]])]
+            elif kind == "date_range":
+                start_minutes = minutes_from_datetime(args[0])
+                end_minutes = minutes_from_datetime(args[1])
+                test_dates = self.columns["test_dates"]
+                rows = [row for row in rows if start_minutes <= test_dates[row] <= end_minutes]
+            elif kind == "status":
+                wanted = set(self._status_codes(args[0]))
+                status_codes = self.columns["status_codes"]
+                rows = [row for row in rows if status_codes[row] in wanted]
+            elif kind == "turnaround":
+                wanted = set(self._test_ids(self._turnaround_predicate(*args)))
+                test_ids = self.columns["test_ids"]
+                rows = [row for row in rows if test_ids[row] in wanted]
+            else:
+                raise ValueError(f"Unknown filter criterion: {kind}")
+        return list(rows)
+
+    def record(self, row):
+        columns = self.columns
+        result_date = int(columns["result_dates"][row])
+        return Record(self.tests[self.test_names[columns["test_ids"][row]]], int(columns["test_dates"][row]),
+                      float(columns["values"][row]), self.units[columns["unit_ids"][row]],
+                      self.statuses[columns["status_codes"][row]], None if result_date == NO_DATE else result_date,
+                      int(columns["record_ids"][row]) or None)
+
+    def patients(self, rows):
+        patients = {}
+        patient_ids = self.columns["patient_ids"]
+        for row in rows:
+            patient_id = int(patient_ids[row])
+            if patient_id not in patients:
+                patients[patient_id] = Patient(patient_id)
+            patients[patient_id].records.append(self.record(row))
+        return patients
+
+
+def query_snapshot(path, criteria, use_numpy=None):
+    with MappedRecords(path, use_numpy) as mapped:
+        return mapped.patients(mapped.query(criteria))
+
+
+def query_current_snapshot(test_file, record_file, criteria, use_numpy=None):
+    # patients matching all criteria, straight from the record file's snapshot; None when the snapshot is missing
+    # or older than the text files, which then have to be loaded instead. The shared lock keeps writers out
+    # between the check and the mapping.
+    with locking.file_lock(record_file, exclusive=False):
+        if not is_current(test_file, record_file):
+            return None
+        return query_snapshot(snapshot_path(record_file), criteria, use_numpy)
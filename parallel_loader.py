@@ -0,0 +1,91 @@
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from patient import Patient
+from record_format import parse_record_fields
+from record_store import RecordStore
+import journal
+
+MIN_CHUNK_BYTES = 1024 * 1024
+CHUNKS_PER_WORKER = 4
+# processes that parse the record file when it is loaded in full; 0 for one per CPU
+WORKERS_ENV = "MEDICAL_LOAD_WORKERS"
+
+
+def chunk_ranges(file_path, num_chunks, min_chunk_bytes=MIN_CHUNK_BYTES):
+    # byte ranges that always end just after a newline (or at EOF)
+    size = os.path.getsize(file_path)
+    step = max(size // max(num_chunks, 1) + 1, min_chunk_bytes)
+    ranges = []
+    with open(file_path, 'rb') as file:
+        start = 0
+        while start < size:
+            end = start + step
+            if end >= size:
+                end = size
+            else:
+                file.seek(end)
+                file.readline()
+                end = file.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def parse_chunk(file_path, start, end, valid_tests):
+    with open(file_path, 'rb') as file:
+        file.seek(start)
+        data = file.read(end - start)
+
+    # rows only: a chunk's patients are not contiguous, so patient_ranges stays empty
+    batch = RecordStore(None)
+    messages = []
+    for line in io.StringIO(data.decode(), newline=None):
+        if not line.strip():
+            continue
+        try:
+            patient_id, abbr_name, test_date, result_value, unit, status, result_date, record_id = \
+                parse_record_fields(line)
+        except Exception as e:
+            messages.append(f"Error processing line: {line}\nException: {e}")
+            continue
+        if abbr_name not in valid_tests:
+            messages.append(f"Warning: Test '{abbr_name}' not found in the list of valid medical tests.")
+            continue
+        batch.append_row(patient_id, abbr_name, test_date, result_value, unit, status, result_date, record_id)
+    return batch, messages
+
+
+def _parse_chunk_args(args):
+    return parse_chunk(*args)
+
+
+def iter_parsed_chunks(file_path, tests, workers=None):
+    workers = workers or os.cpu_count() or 1
+    valid_tests = frozenset(tests)
+    ranges = chunk_ranges(file_path, workers * CHUNKS_PER_WORKER)
+    jobs = [(file_path, start, end, valid_tests) for start, end in ranges]
+
+    if workers == 1 or len(jobs) <= 1:
+        yield from map(_parse_chunk_args, jobs)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # map() hands results back in submission order, so the merge keeps file order
+        yield from executor.map(_parse_chunk_args, jobs)
+
+
+def read_medical_records_parallel(file_path, tests, patients, workers=None):
+    for batch, messages in iter_parsed_chunks(file_path, tests, workers):
+        for message in messages:
+            print(message)
+        batch.tests = tests
+        patient_ids = batch.patient_ids
+        for row in range(len(batch)):
+            patient_id = patient_ids[row]
+            if patient_id not in patients:
+                patients[patient_id] = Patient(patient_id)
+            patients[patient_id].add_loaded_record(batch.record(row))
+
+    journal.replay_journal(file_path, tests, patients)
+    return patients
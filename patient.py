@@ -1,15 +1,83 @@
+from record_index import RecordIndex
+from query_cache import QueryCache
+from timeutil import format_minutes
+
+
 class Patient:
     def __init__(self, patient_id):
         self.patient_id = patient_id
         self.records = []
+        self.index = None
 
     def add_record(self, record):
+        if self.index is not None:
+            self.index.add(self.patient_id, record)
         self.records.append(record)
 
+    def add_loaded_record(self, record):
+        # a record read from the record file: lines written before record ids existed are numbered by their
+        # position among the patient's lines, which appending and journaling never change
+        if record.record_id is None:
+            record.record_id = len(self.records) + 1
+        self.add_record(record)
+
+    def add_records(self, records):
+        # bulk append; the index picks the records up on its next use instead of one by one
+        records = list(records)
+        if self.index is not None:
+            self.index.defer(self.patient_id, records)
+        self.records.extend(records)
+
+    def replace_record(self, record_number, record):
+        if self.index is not None:
+            self.index.replace(self.records[record_number], record)
+        self.records[record_number] = record
+
+    def find_record(self, record_id):
+        # record number of the record with this id, None if the patient has none
+        for record_number, record in enumerate(self.records):
+            if record.record_id == record_id:
+                return record_number
+        return None
+
     def __str__(self):
         record_str = "\n".join(
-            f"{record['test'].abbr_name}, {record['test_date']}, {record['result_value']}, {record['unit']}, {record['test'].unit}"
-            f"{', ' + record['result_date'] if record['status'] == 'completed' else ''}"
+            f"{record['test'].abbr_name}, {format_minutes(record['test_date'])}, {record['result_value']}, {record['unit']}, {record['test'].unit}"
+            f"{', ' + format_minutes(record['result_date']) if record['status'] == 'completed' and record['result_date'] is not None else ''}"
             for record in self.records
         )
         return f"Patient ID: {self.patient_id}\nRecords:\n{record_str}\n"
+
+
+def count_records(patients):
+    index = getattr(patients, 'index', None)
+    if index is not None:
+        return len(index)
+    return sum(len(patient.records) for patient in patients.values())
+
+
+class PatientStore(dict):
+    # patients mapping that keeps a RecordIndex in step with every Patient it holds
+    def __init__(self):
+        super().__init__()
+        self.index = RecordIndex()
+        self.cache = QueryCache()
+
+    def __setitem__(self, patient_id, patient):
+        if patient_id in self:
+            for record in self[patient_id].records:
+                self.index.remove(record)
+            self[patient_id].index = None
+        super().__setitem__(patient_id, patient)
+        patient.index = self.index
+        if patient.records:
+            # a copy, so records added to the patient later are not indexed a second time
+            self.index.defer(patient_id, list(patient.records))
+
+    def refresh_test(self, abbr_name):
+        return self.index.refresh_test(abbr_name)
+
+    def enable_sketches(self, sketches):
+        # keeps a sketches.SketchSet up to date with every record added from now on (and those already here)
+        self.index.enable_sketches(sketches)
+        return sketches
@@ -0,0 +1,183 @@
+from patient import Patient, count_records
+from criteria import CRITERIA_KINDS, criterion_predicate, test_predicate
+from timeutil import minutes_from_datetime, turnaround_minutes
+import metrics
+
+# most selective first: a patient id is a single key lookup, a test name one posting list, and so on
+PLAN_ORDER = {"patient_id": 0, "test_name": 1, "date_range": 2, "status": 3, "turnaround": 4, "abnormal": 5}
+
+
+class Query:
+    # lazy filter: a tree of criteria combined with AND/OR, evaluated once by execute()
+    def __init__(self, op, children=(), criterion=None):
+        self.op = op
+        self.children = tuple(children)
+        self.criterion = criterion
+
+    @classmethod
+    def where(cls, criterion):
+        if criterion[0] not in CRITERIA_KINDS:
+            raise ValueError(f"Unknown filter criterion: {criterion[0]}")
+        return cls("criterion", criterion=tuple(criterion))
+
+    @classmethod
+    def all(cls, criteria):
+        return cls("and", [cls.where(criterion) for criterion in criteria])
+
+    @classmethod
+    def any(cls, criteria):
+        return cls("or", [cls.where(criterion) for criterion in criteria])
+
+    def __and__(self, other):
+        return Query("and", self._flatten("and") + other._flatten("and"))
+
+    def __or__(self, other):
+        return Query("or", self._flatten("or") + other._flatten("or"))
+
+    def _flatten(self, op):
+        return self.children if self.op == op else (self,)
+
+    def __repr__(self):
+        if self.op == "criterion":
+            return f"Query.where({self.criterion!r})"
+        return f"({f' {self.op.upper()} '.join(map(repr, self.children))})"
+
+    def rank(self):
+        if self.op == "criterion":
+            return PLAN_ORDER[self.criterion[0]]
+        return min((child.rank() for child in self.children), default=len(PLAN_ORDER))
+
+    def planned(self):
+        if self.op == "criterion":
+            return self
+        children = [child.planned() for child in self.children]
+        if self.op == "and":
+            children.sort(key=Query.rank)
+        return Query(self.op, children)
+
+    def criteria(self):
+        if self.op == "criterion":
+            return [self.criterion]
+        return [criterion for child in self.children for criterion in child.criteria()]
+
+    def predicate(self):
+        if self.op == "criterion":
+            return criterion_predicate(self.criterion)
+        predicates = [child.predicate() for child in self.children]
+        if self.op == "and":
+            return lambda patient_id, record: all(predicate(patient_id, record) for predicate in predicates)
+        return lambda patient_id, record: any(predicate(patient_id, record) for predicate in predicates)
+
+    def key(self):
+        # normalized, hashable form: equal for queries that match the same records (argument spelling, child order)
+        if self.op == "criterion":
+            return criterion_key(self.criterion)
+        keys = sorted(set(child.key() for child in self.children), key=repr)
+        if len(keys) == 1:
+            return keys[0]
+        return (self.op, tuple(keys))
+
+    def patient_ids(self):
+        # the only patients that can match, or None when the query is not pinned to specific patients
+        if self.op == "criterion":
+            return {self.criterion[1]} if self.criterion[0] == "patient_id" else None
+        child_ids = [child.patient_ids() for child in self.children]
+        if self.op == "and":
+            pinned = [ids for ids in child_ids if ids is not None]
+            return set.intersection(*pinned) if pinned else None
+        return None if any(ids is None for ids in child_ids) else set().union(*child_ids)
+
+    def execute(self, patients):
+        if not metrics.enabled():
+            return self._execute(patients)
+        with metrics.timer("query.execute"):
+            result = self._execute(patients)
+        metrics.selectivity("query", count_records(patients), count_records(result))
+        return result
+
+    def _execute(self, patients):
+        plan = self.planned()
+        if not plan.children and plan.op != "criterion":
+            return patients if plan.op == "and" else {}
+        index = getattr(patients, 'index', None)
+        if index is None:
+            return _execute_scan(plan, patients)
+        cache = getattr(patients, 'cache', None)
+        if cache is None:
+            return _execute_indexed(plan, patients, index)
+        # cached results are shared between callers and must be treated as read-only
+        return cache.get_or_compute(("records", self.key()), index.version,
+                                    lambda: _execute_indexed(plan, patients, index))
+
+
+def criterion_key(criterion):
+    kind, args = criterion[0], criterion[1:]
+    if kind == "date_range":
+        return (kind, minutes_from_datetime(args[0]), minutes_from_datetime(args[1]))
+    if kind == "status":
+        return (kind, args[0].lower())
+    if kind == "turnaround":
+        return (kind, turnaround_minutes(args[0]), turnaround_minutes(args[1]))
+    return tuple(criterion)
+
+
+def _execute_scan(plan, patients):
+    matches = plan.predicate()
+    patient_ids = plan.patient_ids()
+    if patient_ids is None:
+        candidates = patients.items()
+    elif len(patient_ids) == 1:
+        candidates = [(pid, patients[pid]) for pid in patient_ids if pid in patients]
+    else:
+        candidates = [(pid, patient) for pid, patient in patients.items() if pid in patient_ids]
+
+    filtered_patients = {}
+    for pid, patient in candidates:
+        filtered_records = [record for record in patient.records if matches(pid, record)]
+        if filtered_records:
+            filtered_patients[pid] = Patient(pid)
+            filtered_patients[pid].records = filtered_records
+    return filtered_patients
+
+
+def _index_rows(index, patients, criterion):
+    kind, args = criterion[0], criterion[1:]
+    if kind == "patient_id":
+        return index.rows_for_patient(patients[args[0]]) if args[0] in patients else set()
+    if kind == "test_name":
+        return index.rows_for_test(args[0])
+    if kind == "abnormal":
+        return index.abnormal_rows()
+    if kind == "date_range":
+        return index.rows_for_date_range(minutes_from_datetime(args[0]), minutes_from_datetime(args[1]))
+    if kind == "status":
+        return index.rows_for_status(args[0])
+    if kind == "turnaround":
+        return index.rows_for_turnaround(turnaround_minutes(args[0]), turnaround_minutes(args[1]))
+    return index.rows_for_tests(test_predicate(criterion))
+
+
+def _plan_rows(plan, patients, index):
+    if plan.op == "criterion":
+        return _index_rows(index, patients, plan.criterion)
+    if plan.op == "or":
+        rows = set()
+        for child in plan.children:
+            rows |= _plan_rows(child, patients, index)
+        return rows
+    # AND: only the leading (most selective) child touches an index, the rest filter its candidates
+    rows = _plan_rows(plan.children[0], patients, index)
+    for child in plan.children[1:]:
+        if not rows:
+            break
+        matches = child.predicate()
+        rows = {row for row in rows if matches(*index.rows[row])}
+    return rows
+
+
+def _execute_indexed(plan, patients, index):
+    filtered_patients = {}
+    for pid, records in index.group_rows(_plan_rows(plan, patients, index)).items():
+        filtered_patients[pid] = Patient(pid)
+        filtered_patients[pid].records = records
+    return filtered_patients
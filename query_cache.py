@@ -0,0 +1,61 @@
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAXSIZE = 128
+
+
+class QueryCache:
+    # bounded LRU of query results; an entry only counts while the data version it was computed at is current
+    def __init__(self, maxsize=DEFAULT_MAXSIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()  # key -> (version, result)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                del self.entries[key]
+                self.invalidations += 1
+            self.misses += 1
+            return False, None
+
+    def put(self, key, version, result):
+        with self.lock:
+            self.entries[key] = (version, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_compute(self, key, version, compute):
+        found, result = self.get(key, version)
+        if not found:
+            result = compute()
+            self.put(key, version, result)
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+            }
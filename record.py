@@ -0,0 +1,30 @@
+class Record:
+    # slotted replacement for the per-record dict; record['key'] access keeps working
+    __slots__ = ("test", "test_date", "result_value", "unit", "status", "result_date", "record_id")
+
+    def __init__(self, test, test_date, result_value, unit, status, result_date=None, record_id=None):
+        self.test = test
+        self.test_date = test_date
+        self.result_value = result_value
+        self.unit = unit
+        self.status = status
+        self.result_date = result_date
+        self.record_id = record_id  # stable id in the record file; None until the record is written there
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __repr__(self):
+        return (f"Record({self.test.abbr_name!r}, {self.test_date}, {self.result_value}, "
+                f"{self.unit!r}, {self.status!r}, {self.result_date})")
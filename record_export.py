@@ -0,0 +1,314 @@
+import csv
+import gzip
+import hashlib
+import json
+import os
+import struct
+import sys
+from array import array
+from record_format import CSV_COLUMNS, format_csv_row
+from record_store import RecordStore
+import metrics
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+DEFAULT_BATCH_SIZE = 10000
+WATERMARK_SUFFIX = ".watermark"
+WATERMARK_DIGEST = "blake2b-64"
+GZIP_SUFFIXES = (".gz",)
+COLUMNAR_SUFFIXES = (".arrow", ".medcols")
+
+# Fallback columnar layout (when pyarrow is not installed):
+#   COLUMNAR_MAGIC, then one block per batch until EOF:
+#   uint32 header length | JSON header | column blobs in header order, back to back
+# The header holds "rows", "byteorder", the string tables ("test_names", "units", "statuses") the id columns
+# point into, and "columns": [{"name", "typecode", "length"}] for the RecordStore columns. result_dates uses
+# record_store.NO_DATE for records without a result date.
+COLUMNAR_MAGIC = b"MEDCOLS\x00"
+COLUMNAR_COLUMNS = (
+    ("patient_ids", 'q'),
+    ("test_ids", 'i'),
+    ("unit_ids", 'i'),
+    ("test_dates", 'q'),
+    ("result_dates", 'q'),
+    ("values", 'd'),
+    ("status_codes", 'b'),
+)
+
+
+def iter_record_batches(patients, batch_size=DEFAULT_BATCH_SIZE):
+    # lists of (patient_id, record) in patient order, so exporters never hold more than one batch of output
+    batch = []
+    for patient_id, patient in patients.items():
+        for record in patient.records:
+            batch.append((patient_id, record))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def _write_csv(file, patients, batch_size):
+    writer = csv.writer(file)
+    writer.writerow(CSV_COLUMNS)
+    count = 0
+    for batch in iter_record_batches(patients, batch_size):
+        writer.writerows(format_csv_row(patient_id, record) for patient_id, record in batch)
+        count += len(batch)
+    return count
+
+
+def export_csv(patients, file_path, batch_size=DEFAULT_BATCH_SIZE):
+    with open(file_path, 'w', newline='') as file:
+        return _write_csv(file, patients, batch_size)
+
+
+def export_csv_gzip(patients, file_path, batch_size=DEFAULT_BATCH_SIZE):
+    with gzip.open(file_path, 'wt', newline='') as file:
+        return _write_csv(file, patients, batch_size)
+
+
+def watermark_path(file_path):
+    return file_path + WATERMARK_SUFFIX
+
+
+def _row_digest(row):
+    # 64 bits, so a changed row going unnoticed behind an equal digest is not a practical concern
+    return int.from_bytes(hashlib.blake2b(",".join(map(str, row)).encode(), digest_size=8).digest(), 'little')
+
+
+def read_watermark(file_path):
+    # (patient_id -> digests of the rows already exported for that patient, by record number; the RecordIndex
+    # token and version the export was taken at, or None), or (None, None) when there is no watermark or it does
+    # not belong to the file as it is now
+    try:
+        with open(watermark_path(file_path), 'rb') as file:
+            header_len, = struct.unpack("<I", file.read(4))
+            header = json.loads(file.read(header_len))
+            patient_ids = array('q')
+            counts = array('q')
+            digests = array('Q')
+            patient_ids.fromfile(file, header["patients"])
+            counts.fromfile(file, header["patients"])
+            digests.fromfile(file, header["rows"])
+        if header["byteorder"] != sys.byteorder or header.get("digest") != WATERMARK_DIGEST or \
+                os.path.getsize(file_path) != header["export_size"]:
+            return None, None
+    except (OSError, ValueError, KeyError, EOFError, struct.error):
+        return None, None
+
+    watermark = {}
+    start = 0
+    for patient_id, count in zip(patient_ids, counts):
+        watermark[patient_id] = digests[start:start + count]
+        start += count
+    return watermark, header.get("index")
+
+
+def write_watermark(file_path, watermark, index_version=None):
+    patient_ids = array('q', watermark.keys())
+    counts = array('q', (len(digests) for digests in watermark.values()))
+    header = json.dumps({
+        "byteorder": sys.byteorder,
+        "digest": WATERMARK_DIGEST,
+        "patients": len(patient_ids),
+        "rows": sum(counts),
+        "export_size": os.path.getsize(file_path),
+        "index": index_version,
+    }).encode()
+    tmp_path = watermark_path(file_path) + ".tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(struct.pack("<I", len(header)))
+        file.write(header)
+        patient_ids.tofile(file)
+        counts.tofile(file)
+        for digests in watermark.values():
+            digests.tofile(file)
+    os.replace(tmp_path, watermark_path(file_path))
+
+
+def _index_version(patients):
+    # [token, version] of the patients' RecordIndex as of now, None for plain dicts of patients
+    index = getattr(patients, 'index', None)
+    return None if index is None else [index.token, index.current_version()]
+
+
+def _current_digests(patients, watermark, since):
+    # patient_id -> digests of the rows exported before, if they are all still as exported; None when one changed
+    # or is gone, which appending cannot bring the file up to date with. When the watermark was taken from this
+    # same index (since), rows it has not re-indexed since are unchanged and are not formatted again; otherwise
+    # (another process, a plain dict) every exported row is formatted and compared by digest
+    index = getattr(patients, 'index', None)
+    version = since[1] if index is not None and since is not None and since[0] == index.token else None
+    current = {}
+    for patient_id, patient in patients.items():
+        previous = watermark.get(patient_id, array('Q'))
+        exported = patient.records[:len(previous)]
+        if len(exported) < len(previous):
+            return None
+        if version is not None:
+            if index.changed_since(exported, version):
+                return None
+            current[patient_id] = array('Q', previous)
+        else:
+            digests = array('Q', (_row_digest(format_csv_row(patient_id, record)) for record in exported))
+            if digests != previous:
+                return None
+            current[patient_id] = digests
+    if any(patient_id not in current for patient_id in watermark):
+        return None
+    return current
+
+
+def export_csv_incremental(patients, file_path, batch_size=DEFAULT_BATCH_SIZE, full=False):
+    # appends only the records added since the last export of file_path, so the file still holds every record
+    # once, as it is now; when an exported record changed or was removed, or there is no usable watermark
+    # (first export, file replaced or edited), the file is rewritten in full. Returns the rows written.
+    index_version = _index_version(patients)
+    watermark, since = (None, None) if full else read_watermark(file_path)
+    digests = None if watermark is None else _current_digests(patients, watermark, since)
+    full = digests is None
+    if full:
+        watermark, digests = {}, {}
+
+    count = 0
+    with open(file_path, 'w' if full else 'a', newline='') as file:
+        writer = csv.writer(file)
+        if full:
+            writer.writerow(CSV_COLUMNS)
+        rows = []
+        for patient_id, patient in patients.items():
+            exported = len(watermark.get(patient_id, ()))
+            patient_digests = digests.setdefault(patient_id, array('Q'))
+            for record in patient.records[exported:]:
+                row = format_csv_row(patient_id, record)
+                patient_digests.append(_row_digest(row))
+                rows.append(row)
+                if len(rows) >= batch_size:
+                    writer.writerows(rows)
+                    count += len(rows)
+                    rows = []
+        writer.writerows(rows)
+        count += len(rows)
+
+    write_watermark(file_path, digests, index_version)
+    return count
+
+
+def _batch_store(batch):
+    store = RecordStore({})
+    for patient_id, record in batch:
+        store.append_row(patient_id, record['test'].abbr_name, record['test_date'], record['result_value'],
+                         record['unit'], record['status'], record['result_date'])
+    return store
+
+
+def _export_arrow(patients, file_path, batch_size):
+    schema = pa.schema([
+        ("patient_id", pa.int64()),
+        ("test", pa.string()),
+        ("test_date", pa.timestamp("s")),
+        ("result_value", pa.float64()),
+        ("unit", pa.string()),
+        ("status", pa.string()),
+        ("result_date", pa.timestamp("s")),
+    ])
+    count = 0
+    with pa.OSFile(file_path, 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+        for batch in iter_record_batches(patients, batch_size):
+            writer.write_batch(pa.record_batch([
+                [patient_id for patient_id, _ in batch],
+                [record['test'].abbr_name for _, record in batch],
+                [record['test_date'] * 60 for _, record in batch],
+                [record['result_value'] for _, record in batch],
+                [record['unit'] for _, record in batch],
+                [record['status'] for _, record in batch],
+                [None if record['result_date'] is None else record['result_date'] * 60 for _, record in batch],
+            ], schema=schema))
+            count += len(batch)
+    return count
+
+
+def _export_medcols(patients, file_path, batch_size):
+    count = 0
+    with open(file_path, 'wb') as file:
+        file.write(COLUMNAR_MAGIC)
+        for batch in iter_record_batches(patients, batch_size):
+            store = _batch_store(batch)
+            columns = [(name, typecode, getattr(store, name)) for name, typecode in COLUMNAR_COLUMNS]
+            header = json.dumps({
+                "rows": len(batch),
+                "byteorder": sys.byteorder,
+                "test_names": store.test_names,
+                "units": store.units,
+                "statuses": store.statuses,
+                "columns": [{"name": name, "typecode": typecode, "length": len(column)}
+                            for name, typecode, column in columns],
+            }).encode()
+            file.write(struct.pack("<I", len(header)))
+            file.write(header)
+            for _, _, column in columns:
+                column.tofile(file)
+            count += len(batch)
+    return count
+
+
+def export_columnar(patients, file_path, batch_size=DEFAULT_BATCH_SIZE, use_arrow=None):
+    # Arrow IPC file when pyarrow is available, otherwise the MEDCOLS layout above
+    if use_arrow is None:
+        use_arrow = pa is not None
+    if use_arrow:
+        if pa is None:
+            raise RuntimeError("pyarrow is not installed")
+        return _export_arrow(patients, file_path, batch_size)
+    return _export_medcols(patients, file_path, batch_size)
+
+
+def iter_medcols_batches(file_path, tests):
+    # reads a MEDCOLS file back one batch at a time as RecordStores (without patient row ranges)
+    with open(file_path, 'rb') as file:
+        if file.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+            raise ValueError("Not a MEDCOLS columnar export")
+        while True:
+            prefix = file.read(4)
+            if not prefix:
+                break
+            header_len, = struct.unpack("<I", prefix)
+            header = json.loads(file.read(header_len))
+            store = RecordStore(tests)
+            for entry in header["columns"]:
+                column = array(entry["typecode"])
+                column.fromfile(file, entry["length"])
+                if header["byteorder"] != sys.byteorder:
+                    column.byteswap()
+                setattr(store, entry["name"], column)
+            store.record_ids = array('q', [0]) * header["rows"]  # exports do not carry record ids
+            store.set_tables(header["test_names"], header["units"], header["statuses"])
+            yield store
+
+
+def _export(patients, file_path, incremental, batch_size):
+    if incremental and file_path.endswith(GZIP_SUFFIXES + COLUMNAR_SUFFIXES):
+        raise ValueError(f"Incremental exports are only supported for plain CSV files, not {file_path}")
+    if file_path.endswith(GZIP_SUFFIXES):
+        return export_csv_gzip(patients, file_path, batch_size)
+    if file_path.endswith(COLUMNAR_SUFFIXES):
+        return export_columnar(patients, file_path, batch_size, use_arrow=file_path.endswith(".arrow"))
+    # a full CSV export also leaves a watermark, so the next incremental export can append
+    return export_csv_incremental(patients, file_path, batch_size, full=not incremental)
+
+
+def export_records(patients, file_path, incremental=False, batch_size=DEFAULT_BATCH_SIZE):
+    # format by suffix: .gz -> gzip CSV, .arrow/.medcols -> columnar, anything else CSV
+    if not metrics.enabled():
+        return _export(patients, file_path, incremental, batch_size)
+    size_before = os.path.getsize(file_path) if incremental and os.path.exists(file_path) else 0
+    with metrics.timer("export.write"):
+        count = _export(patients, file_path, incremental, batch_size)
+    metrics.count("export.rows", count)
+    metrics.count("io.bytes_written", max(os.path.getsize(file_path) - size_before, 0))
+    return count
@@ -0,0 +1,73 @@
+from record import Record
+from timeutil import parse_minutes, format_minutes
+
+CSV_COLUMNS = ("Patient ID", "Abbreviation", "Test Date", "Result Value", "Unit", "Status", "Result Date")
+
+
+def parse_record_fields(line):
+    # "<patient id>/<record id>: ..."; lines written before record ids existed have only the patient id
+    patient_id, record_data = line.split(":", 1)
+    patient_id, _, record_id = patient_id.strip().partition("/")
+    patient_id = int(patient_id)
+    record_id = int(record_id) if record_id else None
+
+    record_parts = record_data.strip().split(", ")
+
+    abbr_name = record_parts[0].strip()
+    test_date = parse_minutes(record_parts[1].strip())
+    result_value = float(record_parts[2].strip())
+    unit = record_parts[3].strip()
+    status = record_parts[4].strip()
+    result_date = None
+    if len(record_parts) > 5:
+        result_date = parse_minutes(record_parts[5].strip())
+
+    return patient_id, abbr_name, test_date, result_value, unit, status, result_date, record_id
+
+
+def parse_record_line(line, tests):
+    patient_id, abbr_name, test_date, result_value, unit, status, result_date, record_id = parse_record_fields(line)
+
+    if abbr_name not in tests:
+        return patient_id, abbr_name, None
+
+    return patient_id, abbr_name, Record(tests[abbr_name], test_date, result_value, unit, status, result_date,
+                                         record_id)
+
+
+def parse_csv_row(row, tests):
+    patient_id = int(row[0].strip())
+    abbr_name = row[1].strip()
+    test_date = parse_minutes(row[2].strip())
+    result_value = float(row[3].strip())
+    unit = row[4].strip()
+    status = row[5].strip()
+    result_date = None
+    if len(row) > 6 and row[6].strip():
+        result_date = parse_minutes(row[6].strip())
+
+    if abbr_name not in tests:
+        return patient_id, abbr_name, None
+
+    return patient_id, abbr_name, Record(tests[abbr_name], test_date, result_value, unit, status, result_date)
+
+
+def format_csv_row(patient_id, record):
+    return [
+        patient_id,
+        record['test'].abbr_name,
+        format_minutes(record['test_date']),
+        record['result_value'],
+        record['unit'],
+        record['status'],
+        format_minutes(record['result_date']) if record['result_date'] is not None else ''
+    ]
+
+
+def format_record_line(patient_id, record):
+    if record['record_id'] is not None:
+        patient_id = f"{patient_id}/{record['record_id']}"
+    line = f"{patient_id}: {record['test'].abbr_name}, {format_minutes(record['test_date'])}, {record['result_value']}, {record['unit']}, {record['status']}"
+    if record['status'] == "completed" and record['result_date'] is not None:
+        line += f", {format_minutes(record['result_date'])}"
+    return line
@@ -0,0 +1,296 @@
+import uuid
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from numbers import Integral, Real
+from rollups import RollupTable, day_of
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def _row_key(record):
+    # (abbr_name, status, test_date, result_value) a record is indexed under; checked before any structure is
+    # touched, so a record that cannot be indexed leaves the index as it was
+    status, test_date, value = record['status'], record['test_date'], record['result_value']
+    if not isinstance(status, str):
+        raise TypeError(f"status must be a string, not {type(status).__name__}")
+    if not isinstance(test_date, Integral):
+        raise TypeError(f"test_date must be minutes since the epoch, not {type(test_date).__name__}")
+    if not isinstance(value, Real):
+        raise TypeError(f"result_value must be a number, not {type(value).__name__}")
+    return record['test'].abbr_name, status.lower(), test_date, value
+
+
+class RecordIndex:
+    def __init__(self):
+        self.rows = []           # row id -> (patient_id, record)
+        self.row_ids = {}        # id(record) -> row id
+        self.keys = []           # row id -> (abbr_name, status, test_date, result_value) as indexed
+        self.tests = {}          # abbr_name -> MedicalTest seen in the index
+        self.by_test = {}
+        self.by_status = {}
+        self.by_date = []        # (test_date, row id), sorted lazily
+        self.date_sorted = True
+        self.abnormal_by_test = {}  # abbr_name -> rows whose result is outside the test's range
+        self.checks = {}            # abbr_name -> ((lower_range, upper_range), compiled check)
+        self.turnarounds = None     # sorted (turnaround_minutes, abbr_name), rebuilt when tests change
+        self.series = {}            # (patient_id, abbr_name) -> [(test_date, row)] in date order
+        self.sketches = None        # optional sketches.SketchSet fed every added record
+        self.rollups = None         # rollups.RollupTable, built on first use and then kept in step row by row
+        self.pending = []        # (patient_id, records) handed over in bulk, indexed on first use
+        self.version = 0         # bumped by every mutation; cached query results are tied to it
+        self.row_versions = array('q')  # row id -> version at which the row was last (re)indexed
+        self.token = uuid.uuid4().hex   # tells versions of this index apart from another index's or process's
+
+    def __len__(self):
+        self._flush()
+        return len(self.row_ids)
+
+    def defer(self, patient_id, records):
+        self.version += 1
+        self.pending.append((patient_id, records))
+
+    def _flush(self):
+        if self.pending:
+            pending, self.pending = self.pending, []
+            for patient_id, records in pending:
+                for record in records:
+                    self._add(patient_id, record)
+
+    def add(self, patient_id, record):
+        self._flush()
+        self.version += 1
+        return self._add(patient_id, record)
+
+    def _add(self, patient_id, record):
+        key = _row_key(record)
+        row = len(self.rows)
+        self.rows.append((patient_id, record))
+        self.keys.append(None)
+        self.row_versions.append(0)
+        self.row_ids[id(record)] = row
+        self._index_row(row, key)
+        if self.sketches is not None:
+            self.sketches.add(patient_id, record)
+        return row
+
+    def replace(self, old_record, new_record):
+        self._flush()
+        key = _row_key(new_record)
+        self.version += 1
+        row = self.row_ids.pop(id(old_record))
+        self._unindex_row(row)
+        self.rows[row] = (self.rows[row][0], new_record)
+        self.row_ids[id(new_record)] = row
+        self._index_row(row, key)
+
+    def refresh(self, record):
+        self.replace(record, record)
+
+    def current_version(self):
+        # the version once deferred records are indexed, so that rows compare against it by when they changed
+        self._flush()
+        return self.version
+
+    def changed_since(self, records, version):
+        # whether any of these records was added or replaced after version; records not in the index count as
+        # changed, since nothing here can tell
+        self._flush()
+        for record in records:
+            row = self.row_ids.get(id(record))
+            if row is None or self.row_versions[row] > version:
+                return True
+        return False
+
+    def remove(self, record):
+        self._flush()
+        self.version += 1
+        row = self.row_ids.pop(id(record))
+        self._unindex_row(row)
+        self.rows[row] = (None, None)
+
+    def enable_sketches(self, sketches):
+        # sketches only grow: replaced and removed records stay counted in them
+        self._flush()
+        for patient_id, record in self.rows:
+            if record is not None and id(record) in self.row_ids:
+                sketches.add(patient_id, record)
+        self.sketches = sketches
+
+    def rollup_table(self):
+        # per (test, status, day) aggregates; cells whose min or max was retracted are recomputed here
+        self._flush()
+        if self.rollups is None:
+            rollups = RollupTable()
+            for key in self.keys:
+                if key is not None:
+                    rollups.add(*key)
+            self.rollups = rollups
+        elif self.rollups.stale:
+            self.rollups.refresh(self._cell_values)
+        return self.rollups
+
+    def _cell_values(self, cell_key):
+        abbr_name, status, day = cell_key
+        rows = self.by_test[abbr_name] & self.by_status[status]
+        return [self.keys[row][3] for row in rows if day_of(self.keys[row][2]) == day]
+
+    def _check(self, test):
+        bounds = (test.lower_range, test.upper_range)
+        cached = self.checks.get(test.abbr_name)
+        if cached is None or cached[0] != bounds:
+            cached = self.checks[test.abbr_name] = (bounds, test.abnormal_check())
+        return cached[1]
+
+    def refresh_test(self, abbr_name):
+        # re-evaluates only this test's rows against its current range; returns the results that flipped
+        self._flush()
+        self.version += 1
+        self.turnarounds = None
+        test = self.tests.get(abbr_name)
+        if test is None:
+            return {"abnormal": [], "normal": []}
+
+        rows = sorted(self.by_test.get(abbr_name, ()))
+        values = array('d', (self.rows[row][1]['result_value'] for row in rows))
+        if np is not None and rows:
+            column = np.frombuffer(values, dtype=np.float64)
+            mask = np.zeros(len(rows), dtype=bool)
+            if test.lower_range is not None:
+                mask |= column < test.lower_range
+            if test.upper_range is not None:
+                mask |= column > test.upper_range
+            abnormal = set(np.asarray(rows)[mask].tolist())
+        else:
+            check = self._check(test)
+            abnormal = {row for row, value in zip(rows, values) if check(value)}
+
+        previous = self.abnormal_by_test.get(abbr_name, set())
+        self.abnormal_by_test[abbr_name] = abnormal
+        return {
+            "abnormal": [self.rows[row] for row in sorted(abnormal - previous)],
+            "normal": [self.rows[row] for row in sorted(previous - abnormal)],
+        }
+
+    def _index_row(self, row, key):
+        test = self.rows[row][1]['test']
+        abbr_name, status, test_date, value = key
+
+        if self.tests.get(abbr_name) is not test:
+            self.tests[abbr_name] = test
+            self.turnarounds = None
+        self.by_test.setdefault(abbr_name, set()).add(row)
+        self.by_status.setdefault(status, set()).add(row)
+        if self.date_sorted and self.by_date and (test_date, row) < self.by_date[-1]:
+            self.date_sorted = False
+        self.by_date.append((test_date, row))
+        if self._check(test)(value):
+            self.abnormal_by_test.setdefault(abbr_name, set()).add(row)
+        series = self.series.setdefault((self.rows[row][0], abbr_name), [])
+        if not series or series[-1] < (test_date, row):
+            series.append((test_date, row))
+        else:
+            insort(series, (test_date, row))
+        self.keys[row] = key
+        self.row_versions[row] = self.version
+        if self.rollups is not None:
+            self.rollups.add(abbr_name, status, test_date, value)
+
+    def _unindex_row(self, row):
+        abbr_name, status, test_date, value = self.keys[row]
+        self.by_test[abbr_name].discard(row)
+        self.by_status[status].discard(row)
+        if self.date_sorted:
+            del self.by_date[bisect_left(self.by_date, (test_date, row))]
+        else:
+            self.by_date.remove((test_date, row))
+        self.abnormal_by_test.get(abbr_name, set()).discard(row)
+        series = self.series[(self.rows[row][0], abbr_name)]
+        del series[bisect_left(series, (test_date, row))]
+        if self.rollups is not None:
+            self.rollups.retract(abbr_name, status, test_date, value)
+        self.keys[row] = None
+
+    def _sorted_dates(self):
+        if not self.date_sorted:
+            self.by_date.sort()
+            self.date_sorted = True
+        return self.by_date
+
+    def rows_for_patient(self, patient):
+        self._flush()
+        return {self.row_ids[id(record)] for record in patient.records}
+
+    def rows_for_test(self, abbr_name):
+        self._flush()
+        return set(self.by_test.get(abbr_name, ()))
+
+    def rows_for_status(self, status):
+        self._flush()
+        return set(self.by_status.get(status.lower(), ()))
+
+    def rows_for_date_range(self, start_date, end_date):
+        self._flush()
+        by_date = self._sorted_dates()
+        lo = bisect_left(by_date, (start_date, -1))
+        hi = bisect_right(by_date, (end_date, len(self.rows)))
+        return {row for _, row in by_date[lo:hi]}
+
+    def rows_for_tests(self, predicate):
+        self._flush()
+        rows = set()
+        for abbr_name, test in self.tests.items():
+            if predicate(test):
+                rows |= self.by_test[abbr_name]
+        return rows
+
+    def _sorted_turnarounds(self):
+        if self.turnarounds is None:
+            self.turnarounds = sorted((test.turnaround_minutes, abbr_name) for abbr_name, test in self.tests.items())
+        return self.turnarounds
+
+    def prepare(self):
+        # builds everything the read paths would otherwise build lazily, so concurrent readers only read
+        self._flush()
+        self._sorted_dates()
+        self._sorted_turnarounds()
+
+    def rows_for_turnaround(self, min_minutes, max_minutes):
+        # resolves to the tests in range first, then takes their postings whole
+        self._flush()
+        turnarounds = self._sorted_turnarounds()
+        lo = bisect_left(turnarounds, (min_minutes, ""))
+        rows = set()
+        for minutes, abbr_name in turnarounds[lo:]:
+            if minutes > max_minutes:
+                break
+            rows |= self.by_test[abbr_name]
+        return rows
+
+    def series_rows(self, patient_id, abbr_name):
+        # [(test_date, row)] of one patient's results for one test, oldest first
+        self._flush()
+        return list(self.series.get((patient_id, abbr_name), ()))
+
+    def abnormal_rows(self):
+        self._flush()
+        return set().union(*self.abnormal_by_test.values())
+
+    def abnormal_rows_for_test(self, abbr_name):
+        self._flush()
+        return set(self.abnormal_by_test.get(abbr_name, ()))
+
+    def all_rows(self):
+        self._flush()
+        return set(self.row_ids.values())
+
+    def group_rows(self, rows):
+        # row ids grow with insertion, so sorting restores the patients/records order of a full scan
+        self._flush()
+        grouped = {}
+        for row in sorted(rows):
+            patient_id, record = self.rows[row]
+            grouped.setdefault(patient_id, []).append(record)
+        return grouped
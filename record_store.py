@@ -0,0 +1,128 @@
+import sys
+from array import array
+from record import Record
+from patient import Patient
+
+STATUSES = ("pending", "completed", "reviewed")
+NO_DATE = -2 ** 63
+
+
+class RecordStore:
+    # column-per-field record storage; each patient's records occupy one contiguous row range
+    def __init__(self, tests):
+        self.tests = tests
+        self.patient_ids = array('q')
+        self.test_ids = array('i')
+        self.unit_ids = array('i')
+        self.test_dates = array('q')
+        self.result_dates = array('q')
+        self.values = array('d')
+        self.status_codes = array('b')
+        self.record_ids = array('q')  # 0 for records without one
+        self.test_names = []
+        self.units = []
+        self.statuses = list(STATUSES)
+        self.patient_ranges = {}
+        self._test_lookup = {}
+        self._unit_lookup = {}
+        self._status_lookup = {status: code for code, status in enumerate(self.statuses)}
+
+    def __len__(self):
+        return len(self.values)
+
+    @classmethod
+    def from_patients(cls, patients, tests):
+        store = cls(tests)
+        for pid, patient in patients.items():
+            store.add_patient_records(pid, patient.records)
+        return store
+
+    def set_tables(self, test_names, units, statuses):
+        self.test_names = list(test_names)
+        self.units = list(units)
+        self.statuses = list(statuses)
+        self._test_lookup = {value: code for code, value in enumerate(self.test_names)}
+        self._unit_lookup = {value: code for code, value in enumerate(self.units)}
+        self._status_lookup = {value: code for code, value in enumerate(self.statuses)}
+
+    def _intern(self, value, table, lookup):
+        code = lookup.get(value)
+        if code is None:
+            code = len(table)
+            table.append(value)
+            lookup[value] = code
+        return code
+
+    def test_id(self, abbr_name):
+        return self._intern(abbr_name, self.test_names, self._test_lookup)
+
+    def status_code(self, status):
+        return self._intern(status, self.statuses, self._status_lookup)
+
+    def add_patient_records(self, patient_id, records):
+        self.add_patient_rows(patient_id, ((record['test'].abbr_name, record['test_date'], record['result_value'],
+                                            record['unit'], record['status'], record['result_date'],
+                                            record['record_id'])
+                                           for record in records))
+
+    def add_patient_rows(self, patient_id, rows):
+        # rows of append_row's fields after the patient id; the record id may be left off
+        if patient_id in self.patient_ranges:
+            raise ValueError(f"Patient {patient_id} already has a row range in the store")
+        start = len(self.values)
+        for row in rows:
+            self.append_row(patient_id, *row)
+        self.patient_ranges[patient_id] = (start, len(self.values))
+
+    def append_row(self, patient_id, abbr_name, test_date, result_value, unit, status, result_date, record_id=None):
+        self.patient_ids.append(patient_id)
+        self.test_ids.append(self.test_id(abbr_name))
+        self.unit_ids.append(self._intern(unit, self.units, self._unit_lookup))
+        self.test_dates.append(test_date)
+        self.result_dates.append(NO_DATE if result_date is None else result_date)
+        self.values.append(result_value)
+        self.status_codes.append(self.status_code(status))
+        self.record_ids.append(record_id or 0)
+
+    def record(self, row):
+        result_date = self.result_dates[row]
+        return Record(self.tests[self.test_names[self.test_ids[row]]], self.test_dates[row], self.values[row],
+                      self.units[self.unit_ids[row]], self.statuses[self.status_codes[row]],
+                      None if result_date == NO_DATE else result_date, self.record_ids[row] or None)
+
+    def rows_for_patient(self, patient_id):
+        start, stop = self.patient_ranges.get(patient_id, (0, 0))
+        return range(start, stop)
+
+    def patient(self, patient_id):
+        return PatientView(self, patient_id)
+
+    def patients(self):
+        return {pid: PatientView(self, pid) for pid in self.patient_ranges}
+
+    def memory_footprint(self):
+        columns = {
+            "patient_ids": self.patient_ids, "test_ids": self.test_ids, "unit_ids": self.unit_ids,
+            "test_dates": self.test_dates, "result_dates": self.result_dates, "values": self.values,
+            "status_codes": self.status_codes, "record_ids": self.record_ids,
+        }
+        footprint = {name: column.buffer_info()[1] * column.itemsize for name, column in columns.items()}
+        footprint["string_tables"] = sum(sys.getsizeof(value) for table in (self.test_names, self.units, self.statuses)
+                                         for value in table)
+        footprint["patient_ranges"] = sys.getsizeof(self.patient_ranges) + sum(
+            sys.getsizeof(pid) + sys.getsizeof(rows) for pid, rows in self.patient_ranges.items())
+        footprint["total"] = sum(footprint.values())
+        return footprint
+
+
+class PatientView:
+    # read-only Patient over a row range of a RecordStore; records are built on access
+    def __init__(self, store, patient_id):
+        self.store = store
+        self.patient_id = patient_id
+
+    @property
+    def records(self):
+        return [self.store.record(row) for row in self.store.rows_for_patient(self.patient_id)]
+
+    __str__ = Patient.__str__
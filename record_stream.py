@@ -0,0 +1,63 @@
+import csv
+from patient import Patient
+from record_format import parse_record_line, parse_csv_row
+from criteria import criteria_predicate
+import metrics
+
+DEFAULT_BATCH_SIZE = 10000
+
+
+def _batches(rows, parse, tests, batch_size):
+    batch = []
+    for line, fields in rows:
+        try:
+            patient_id, abbr_name, record = parse(fields, tests)
+        except Exception as e:
+            print(f"Error processing line: {line}\nException: {e}")
+            metrics.count("parse.rows_rejected")
+            continue
+        if record is None:
+            print(f"Warning: Test '{abbr_name}' not found in the list of valid medical tests.")
+            metrics.count("parse.rows_rejected")
+            continue
+        batch.append((patient_id, record))
+        if len(batch) >= batch_size:
+            metrics.count("parse.rows", len(batch))
+            yield batch
+            batch = []
+    if batch:
+        metrics.count("parse.rows", len(batch))
+        yield batch
+
+
+def iter_record_batches(file_path, tests, batch_size=DEFAULT_BATCH_SIZE):
+    # yields lists of (patient_id, record) from a medicalRecord.txt-style file
+    with open(file_path, 'r') as file:
+        yield from _batches(((line, line) for line in file if line.strip()), parse_record_line, tests, batch_size)
+
+
+def iter_csv_batches(file_path, tests, batch_size=DEFAULT_BATCH_SIZE):
+    # same batches from an export_medical_records-style CSV; the header row is skipped
+    with open(file_path, 'r', newline='') as file:
+        reader = csv.reader(file)
+        next(reader, None)
+        yield from _batches(((",".join(row), row) for row in reader if row), parse_csv_row, tests, batch_size)
+
+
+def filter_batches(batches, criteria):
+    matches = criteria_predicate(criteria)
+    for batch in batches:
+        filtered = [(patient_id, record) for patient_id, record in batch if matches(patient_id, record)]
+        if filtered:
+            yield filtered
+
+
+def collect_patients(batches, patients=None):
+    if patients is None:
+        patients = {}
+    for batch in batches:
+        for patient_id, record in batch:
+            if patient_id not in patients:
+                patients[patient_id] = Patient(patient_id)
+            patients[patient_id].add_record(record)
+    return patients
@@ -0,0 +1,180 @@
+import math
+from criteria import test_predicate
+from stats_engine import RunningStats, describe_running
+from timeutil import MINUTES_PER_DAY, minutes_from_datetime
+
+# criteria that select whole (test, status, day) cells; turnaround resolves to a set of tests
+ROLLUP_KINDS = ("test_name", "status", "date_range", "turnaround")
+
+
+def day_of(test_date):
+    return test_date // MINUTES_PER_DAY
+
+
+def _compensated(total, error, value):
+    # Neumaier summation: error collects what rounding drops, so adding and later retracting a value
+    # leaves the sum where it would be without it
+    result = total + value
+    if abs(total) >= abs(value):
+        error += (total - result) + value
+    else:
+        error += (value - result) + total
+    return result, error
+
+
+class RollupCell:
+    # result_value aggregates of one (test, status, day); turnarounds follow from the count and the test
+    __slots__ = ("count", "total", "error", "m2", "min", "max", "stale")
+
+    def __init__(self):
+        self.count = 0
+        self.total = self.error = 0.0
+        self.m2 = 0.0  # squared deviations from the mean, as in stats_engine.RunningStats
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.stale = False  # min or max was retracted and needs the cell's values again
+
+    def mean(self):
+        return (self.total + self.error) / self.count
+
+    def add(self, value):
+        previous = self.mean() if self.count else value
+        self.count += 1
+        self.total, self.error = _compensated(self.total, self.error, value)
+        self.m2 += (value - previous) * (value - self.mean())
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def retract(self, value):
+        # Welford's update run backwards; rebuilding a stale cell also resets the rounding it leaves in m2
+        previous = self.mean()
+        self.count -= 1
+        self.total, self.error = _compensated(self.total, self.error, -value)
+        self.m2 = max(self.m2 - (value - previous) * (value - self.mean()), 0.0) if self.count else 0.0
+        if value <= self.min or value >= self.max:
+            self.stale = True
+
+    def rebuild(self, values):
+        self.__init__()
+        for value in values:
+            self.add(value)
+
+
+class RollupTable:
+    # materialized (abbr_name, status, day) -> RollupCell, kept in step with a RecordIndex row by row
+    def __init__(self):
+        self.cells = {}
+        self.stale = set()
+
+    def add(self, abbr_name, status, test_date, value):
+        key = (abbr_name, status, day_of(test_date))
+        cell = self.cells.get(key)
+        if cell is None:
+            cell = self.cells[key] = RollupCell()
+        cell.add(value)
+
+    def retract(self, abbr_name, status, test_date, value):
+        key = (abbr_name, status, day_of(test_date))
+        cell = self.cells[key]
+        cell.retract(value)
+        if not cell.count:
+            del self.cells[key]
+            self.stale.discard(key)
+        elif cell.stale:
+            self.stale.add(key)
+
+    def refresh(self, cell_values):
+        # cell_values(key) -> the current result values of that cell
+        for key in self.stale:
+            self.cells[key].rebuild(cell_values(key))
+        self.stale.clear()
+
+
+class RollupPlan:
+    # the cells an AND of rollup-aligned criteria selects
+    def __init__(self):
+        self.test_checks = []
+        self.status = None
+        self.first_day = None
+        self.last_day = None
+        self.empty = False
+
+    def matches_test(self, test):
+        return all(check(test) for check in self.test_checks)
+
+    def matches_cell(self, status, day):
+        return (self.status is None or status == self.status) and \
+            (self.first_day is None or self.first_day <= day) and \
+            (self.last_day is None or day <= self.last_day)
+
+
+def rollup_plan(query=None):
+    # a RollupPlan for queries the rollups can answer exactly, None for those that cut through a cell
+    # (patient ids, abnormal results, date ranges that start or end mid-day, OR)
+    if query is None:
+        criteria = []
+    elif query.op == "criterion":
+        criteria = [query.criterion]
+    elif query.op == "and" and all(child.op == "criterion" for child in query.children):
+        criteria = [child.criterion for child in query.children]
+    else:
+        return None
+
+    plan = RollupPlan()
+    for criterion in criteria:
+        kind = criterion[0]
+        if kind not in ROLLUP_KINDS:
+            return None
+        if kind == "status":
+            status = criterion[1].lower()
+            plan.empty |= plan.status is not None and plan.status != status
+            plan.status = status
+        elif kind == "date_range":
+            start = minutes_from_datetime(criterion[1])
+            end = minutes_from_datetime(criterion[2])
+            if start % MINUTES_PER_DAY or (end + 1) % MINUTES_PER_DAY:
+                return None
+            plan.first_day = day_of(start) if plan.first_day is None else max(plan.first_day, day_of(start))
+            plan.last_day = day_of(end) if plan.last_day is None else min(plan.last_day, day_of(end))
+        else:
+            plan.test_checks.append(test_predicate(criterion))
+    return plan
+
+
+def summarize(index, plan=None):
+    # stats_engine summary of the records the plan selects in O(cells), without percentiles
+    table = index.rollup_table()
+    plan = plan or RollupPlan()
+    if plan.empty:
+        return None
+    tests = {abbr_name: test for abbr_name, test in index.tests.items() if plan.matches_test(test)}
+    counts = {}  # abbr_name -> matching results; every result of a test has its turnaround
+    cells = []
+    totals = []
+    value_stats = RunningStats()
+    for (abbr_name, status, day), cell in table.cells.items():
+        if abbr_name in tests and plan.matches_cell(status, day):
+            counts[abbr_name] = counts.get(abbr_name, 0) + cell.count
+            cells.append(cell)
+            totals += (cell.total, cell.error)
+            value_stats.min = min(value_stats.min, cell.min)
+            value_stats.max = max(value_stats.max, cell.max)
+    if not counts:
+        return None
+
+    # Chan et al.'s update for all the cells at once: within-cell m2 plus each cell mean's deviation
+    value_stats.count = sum(counts.values())
+    value_stats.total = math.fsum(totals)
+    mean = value_stats.mean()
+    value_stats.m2 = math.fsum(cell.m2 + cell.count * (cell.mean() - mean) ** 2 for cell in cells)
+    turnaround_stats = RunningStats()
+    turnaround_stats.count = value_stats.count
+    turnaround_stats.total = float(sum(count * tests[name].turnaround_minutes for name, count in counts.items()))
+    mean = turnaround_stats.mean()
+    turnaround_stats.m2 = math.fsum(count * (tests[name].turnaround_minutes - mean) ** 2
+                                    for name, count in counts.items())
+    turnaround_stats.min = min(tests[name].turnaround_minutes for name in counts)
+    turnaround_stats.max = max(tests[name].turnaround_minutes for name in counts)
+    return describe_running(value_stats, turnaround_stats)
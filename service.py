@@ -0,0 +1,296 @@
+import argparse
+import asyncio
+import json
+import os
+import traceback
+from contextlib import asynccontextmanager
+from datetime import datetime
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qs
+from batch import BatchSession, record_to_dict
+from functions import validate_turnaround_time
+from query import Query
+from timeutil import DATE_FORMAT
+import metrics
+import parallel_loader
+import stats_engine
+
+STREAM_BATCH_SIZE = 1000
+MAX_BODY_BYTES = 64 * 1024 * 1024
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ReadWriteLock:
+    # any number of readers or one writer; a waiting writer holds back new readers so writes are not starved
+    def __init__(self):
+        self.readers = 0
+        self.writing = False
+        self.writers_waiting = 0
+        self.condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def read(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: not self.writing and not self.writers_waiting)
+            self.readers += 1
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.readers -= 1
+                self.condition.notify_all()
+
+    @asynccontextmanager
+    async def write(self):
+        async with self.condition:
+            self.writers_waiting += 1
+            await self.condition.wait_for(lambda: not self.writing and not self.readers)
+            self.writers_waiting -= 1
+            self.writing = True
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+
+def _param(params, name):
+    values = params.get(name)
+    return values[-1] if values else None
+
+
+def _date_param(params, name, default):
+    value = _param(params, name)
+    if value is None:
+        return default
+    try:
+        return datetime.strptime(value, DATE_FORMAT)
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"{name} must be in the format YYYY-MM-DD HH:MM")
+
+
+def criteria_from_params(params):
+    # same criteria as the filter menu: patient_id, test, abnormal, start/end, status, turnaround_min/turnaround_max
+    criteria = []
+    patient_id = _param(params, "patient_id")
+    if patient_id is not None:
+        if not patient_id.isdigit():
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "patient_id must be a number")
+        criteria.append(("patient_id", int(patient_id)))
+    if _param(params, "test"):
+        criteria.append(("test_name", _param(params, "test")))
+    if _param(params, "abnormal") in ("1", "true", "yes"):
+        criteria.append(("abnormal",))
+    if "start" in params or "end" in params:
+        criteria.append(("date_range", _date_param(params, "start", datetime.min), _date_param(params, "end", datetime.max)))
+    if _param(params, "status"):
+        criteria.append(("status", _param(params, "status").lower()))
+    if "turnaround_min" in params or "turnaround_max" in params:
+        bounds = (_param(params, "turnaround_min") or "00-00-00", _param(params, "turnaround_max") or "99-23-59")
+        if not all(validate_turnaround_time(bound) for bound in bounds):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "turnaround bounds must be in the format DD-hh-mm")
+        criteria.append(("turnaround", *bounds))
+    return criteria
+
+
+def query_from_params(params):
+    criteria = criteria_from_params(params)
+    return Query.any(criteria) if _param(params, "match") == "any" else Query.all(criteria)
+
+
+class RecordService:
+    # one warm BatchSession shared by all connections; queries run in worker threads under the read lock,
+    # writes run one at a time in a worker thread under the write lock
+    def __init__(self, session):
+        self.session = session
+        self.lock = ReadWriteLock()
+        self.session.patients.index.prepare()
+
+    async def run_read(self, function, *args):
+        async with self.lock.read():
+            return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    async def run_write(self, function, *args):
+        async with self.lock.write():
+            return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    def _records(self, query):
+        # copied under the read lock: the response goes out after the lock is released, while writes change the
+        # store (an empty query matches the store itself)
+        return [(pid, list(patient.records)) for pid, patient in query.execute(self.session.patients).items()]
+
+    async def query(self, params):
+        # [(patient_id, records)] of the matching patients
+        return await self.run_read(self._records, query_from_params(params))
+
+    async def stats(self, params):
+        group_by = _param(params, "group_by")
+        if group_by is not None and group_by not in stats_engine.GROUP_KEYS:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"group_by must be one of {', '.join(stats_engine.GROUP_KEYS)}")
+        query = query_from_params(params)
+        patients = self.session.patients
+        return await self.run_read(
+            patients.cache.get_or_compute, ("stats", query.key(), group_by), patients.index.version,
+            lambda: stats_engine.summarize_patients(query.execute(patients), group_by=group_by))
+
+    def _add_records(self, rows):
+        added, rejected = self.session.ingest(rows)
+        self.session.flush()
+        self.session.patients.index.prepare()
+        return added, rejected
+
+    async def add_records(self, rows):
+        added, rejected = await self.run_write(self._add_records, rows)
+        return {"added": added, "rejected": [{"row": position, "error": message} for position, _, message in rejected]}
+
+    def tests(self):
+        return [{"abbr_name": test.abbr_name, "name": test.name, "lower_range": test.lower_range,
+                 "upper_range": test.upper_range, "unit": test.unit, "turnaround_time": test.turnaround_time}
+                for test in self.session.tests.values()]
+
+    async def handle(self, reader, writer):
+        streaming = False
+        try:
+            method, target, body = await read_request(reader)
+            url = urlsplit(target)
+            params = parse_qs(url.query)
+            if method == "GET" and url.path == "/tests":
+                await send_json(writer, HTTPStatus.OK, self.tests())
+            elif method == "GET" and url.path == "/records":
+                patient_records = await self.query(params)
+                if _param(params, "stream") in ("1", "true", "yes"):
+                    streaming = True
+                    await stream_records(writer, patient_records)
+                else:
+                    await send_json(writer, HTTPStatus.OK, [record_to_dict(pid, record)
+                                                            for pid, records in patient_records
+                                                            for record in records])
+            elif method == "GET" and url.path == "/cache":
+                await send_json(writer, HTTPStatus.OK, self.session.patients.cache.stats())
+            elif method == "GET" and url.path == "/metrics":
+                await send_text(writer, HTTPStatus.OK, metrics.METRICS.to_prometheus())
+            elif method == "GET" and url.path == "/stats":
+                await send_json(writer, HTTPStatus.OK, await self.stats(params))
+            elif method == "POST" and url.path == "/records":
+                try:
+                    rows = json.loads(body or b"null")
+                except ValueError:
+                    raise HTTPError(HTTPStatus.BAD_REQUEST, "body must be JSON")
+                if isinstance(rows, dict):
+                    rows = [rows]
+                if not isinstance(rows, list):
+                    raise HTTPError(HTTPStatus.BAD_REQUEST, "body must be a record object or a list of them")
+                await send_json(writer, HTTPStatus.OK, await self.add_records(rows))
+            else:
+                raise HTTPError(HTTPStatus.NOT_FOUND, f"no route for {method} {url.path}")
+        except HTTPError as e:
+            await send_json(writer, e.status, {"error": str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            # a bug rather than a bad request: logged, and answered with a 500 unless a stream already started
+            traceback.print_exc()
+            if not streaming:
+                try:
+                    await send_json(writer, HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "internal server error"})
+                except ConnectionError:
+                    pass
+        finally:
+            writer.close()
+
+
+async def read_request(reader):
+    request_line = (await reader.readline()).decode('latin-1').strip()
+    parts = request_line.split()
+    if len(parts) != 3:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "malformed request line")
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = headers.get("content-length") or "0"
+    if not (length.isascii() and length.isdigit()):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Content-Length must be a non-negative integer")
+    length = int(length)
+    if length > MAX_BODY_BYTES:
+        raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "request body too large")
+    body = await reader.readexactly(length) if length else b""
+    return parts[0].upper(), parts[1], body
+
+
+def _head(status, content_type, extra=""):
+    return (f"HTTP/1.1 {status.value} {status.phrase}\r\nContent-Type: {content_type}\r\n"
+            f"{extra}Connection: close\r\n\r\n").encode('latin-1')
+
+
+async def send_json(writer, status, payload):
+    body = json.dumps(payload).encode()
+    writer.write(_head(status, "application/json", f"Content-Length: {len(body)}\r\n") + body)
+    await writer.drain()
+
+
+async def send_text(writer, status, text, content_type="text/plain; version=0.0.4"):
+    body = text.encode()
+    writer.write(_head(status, content_type, f"Content-Length: {len(body)}\r\n") + body)
+    await writer.drain()
+
+
+async def stream_records(writer, patient_records, batch_size=STREAM_BATCH_SIZE):
+    # newline-delimited JSON in chunked encoding, one chunk per batch so a large result never sits in one buffer;
+    # patient_records: (patient_id, records) pairs
+    writer.write(_head(HTTPStatus.OK, "application/x-ndjson", "Transfer-Encoding: chunked\r\n"))
+    lines = []
+    for pid, records in patient_records:
+        for record in records:
+            lines.append(json.dumps(record_to_dict(pid, record)))
+            if len(lines) >= batch_size:
+                await _send_chunk(writer, lines)
+                lines = []
+    if lines:
+        await _send_chunk(writer, lines)
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+
+async def _send_chunk(writer, lines):
+    chunk = ("\n".join(lines) + "\n").encode()
+    writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+    await writer.drain()
+
+
+async def serve(service, host="127.0.0.1", port=8080):
+    server = await asyncio.start_server(service.handle, host, port)
+    addresses = ", ".join(str(sock.getsockname()) for sock in server.sockets)
+    print(f"Serving medical records on {addresses}")
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local HTTP/JSON query service over the medical records.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--tests", default="medicalTest.txt")
+    parser.add_argument("--records", default=os.environ.get("MEDICAL_RECORDS_STORAGE", "medicalRecord.txt"))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get(parallel_loader.WORKERS_ENV) or 1),
+                        help="processes that parse the record file when there is no fresh snapshot (0 for one per CPU)")
+    args = parser.parse_args(argv)
+
+    with BatchSession(args.tests, args.records, args.workers) as session:
+        try:
+            asyncio.run(serve(RecordService(session), args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import itertools
+import multiprocessing
+import os
+import weakref
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from patient import Patient, PatientStore
+from query import Query
+from query_cache import QueryCache
+import stats_engine
+
+DEFAULT_SHARDS = os.cpu_count() or 1
+
+# (shard list, per-shard change counts) by store token; workers are forked after the store registers here, so each reads its
+# copy-on-write snapshot of the shards instead of receiving them with every task
+_SHARD_SETS = {}
+# worker side: shards sent after they changed, by (store token, shard number) -> (shard version, PatientStore)
+_SENT_SHARDS = {}
+_tokens = itertools.count()
+
+
+def shard_number(patient_id, num_shards):
+    return hash(patient_id) % num_shards
+
+
+def shard_version(shard, changes):
+    # index.version misses patients added without records; changes counts the patients set on the shard through
+    # the store, so a replaced patient always moves the version on
+    return shard.index.version, len(shard), changes
+
+
+def _worker_shard(token, number, version, data):
+    # the worker's copy of the shard at version: the forked one, the one sent last, or the one sent along with
+    # this task as data ((patient_id, records) pairs); None when the worker only has an older copy
+    if data is not None:
+        shard = PatientStore()
+        for patient_id, records in data:
+            patient = Patient(patient_id)
+            patient.records = records
+            shard[patient_id] = patient
+        _SENT_SHARDS[token, number] = (version, shard)
+        return shard
+    sent = _SENT_SHARDS.get((token, number))
+    if sent is not None and sent[0] == version:
+        return sent[1]
+    shards, changes = _SHARD_SETS[token]
+    return shards[number] if shard_version(shards[number], changes[number]) == version else None
+
+
+def _on_shard(function, token, number, version, data, args):
+    shard = _worker_shard(token, number, version, data)
+    return None if shard is None else function(shard, *args)
+
+
+def _shard_query(shard, query):
+    # (patient_id, positions of the matching records in that patient's record list)
+    matches = []
+    for patient_id, patient in query.execute(shard).items():
+        records = shard[patient_id].records
+        if patient.records is records:
+            matches.append((patient_id, None))
+            continue
+        position_of = {id(record): position for position, record in enumerate(records)}
+        matches.append((patient_id, [position_of[id(record)] for record in patient.records]))
+    return matches
+
+
+def _shard_summary(shard, query, group_by, keep_values):
+    patients = shard if query is None else query.execute(shard)
+    values, turnarounds, groups = stats_engine.columns_from_patients(patients, group_by)
+    return stats_engine.partial_summary(values, turnarounds, groups, keep_values)
+
+
+class ShardedPatientStore(Mapping):
+    # patients partitioned by hash(patient_id) across PatientStores; queries and summaries run once per shard
+    # in a process pool and are merged back in the order a single PatientStore would produce
+    def __init__(self, num_shards=DEFAULT_SHARDS, workers=None):
+        self.shards = [PatientStore() for _ in range(num_shards)]
+        self.order = {}  # patient_id -> None, in first-insertion order
+        self.changes = [0] * num_shards  # shard number -> patients set on it
+        self.workers = workers or num_shards
+        self.cache = QueryCache()
+        self.token = next(_tokens)
+        self.executor = None
+        self.stop_executor = None
+        _SHARD_SETS[self.token] = (self.shards, self.changes)
+        weakref.finalize(self, _SHARD_SETS.pop, self.token, None)
+
+    @classmethod
+    def from_patients(cls, patients, num_shards=DEFAULT_SHARDS, workers=None):
+        # copies the Patient objects (not the records), so the source store keeps its own index
+        store = cls(num_shards, workers)
+        for patient_id, patient in patients.items():
+            copy = Patient(patient_id)
+            copy.records = list(patient.records)
+            store[patient_id] = copy
+        return store
+
+    def shard_for(self, patient_id):
+        return self.shards[shard_number(patient_id, len(self.shards))]
+
+    def shard_version(self, number):
+        return shard_version(self.shards[number], self.changes[number])
+
+    def __getitem__(self, patient_id):
+        return self.shard_for(patient_id)[patient_id]
+
+    def __setitem__(self, patient_id, patient):
+        number = shard_number(patient_id, len(self.shards))
+        self.shards[number][patient_id] = patient
+        self.changes[number] += 1
+        self.order[patient_id] = None
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __contains__(self, patient_id):
+        return patient_id in self.order
+
+    def refresh_test(self, abbr_name):
+        # PatientStore.refresh_test over every shard, flips listed in patient order
+        position = {patient_id: position for position, patient_id in enumerate(self.order)}
+        flipped = {"abnormal": [], "normal": []}
+        for shard in self.shards:
+            for kind, rows in shard.refresh_test(abbr_name).items():
+                flipped[kind].extend(rows)
+        for rows in flipped.values():
+            rows.sort(key=lambda row: position[row[0]])
+        return flipped
+
+    @property
+    def version(self):
+        return sum(shard.index.version for shard in self.shards) + sum(self.changes)
+
+    def _executor(self):
+        # one pool for the store's lifetime: the workers start from the shards as they are when the pool forks and
+        # are sent a shard again only after it changed
+        if self.executor is not None:
+            return self.executor
+        if self.workers <= 1 or len(self.shards) <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+            return None
+        for shard in self.shards:
+            shard.index.prepare()
+        self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("fork"))
+        # a pool dropped with its store without shutdown() breaks the executor's own exit handler
+        self.stop_executor = weakref.finalize(self, self.executor.shutdown)
+        return self.executor
+
+    def _shard_data(self, number):
+        return [(patient_id, patient.records) for patient_id, patient in self.shards[number].items()]
+
+    def _map(self, function, *args):
+        executor = self._executor()
+        if executor is None:
+            return [function(shard, *args) for shard in self.shards]
+        versions = [self.shard_version(number) for number in range(len(self.shards))]
+        futures = [executor.submit(_on_shard, function, self.token, number, version, None, args)
+                   for number, version in enumerate(versions)]
+        results = [future.result() for future in futures]
+        # a worker with an older copy of a shard declines the task; it is sent again with the shard's data, which
+        # the worker that takes it keeps for the next tasks
+        resent = {number: executor.submit(_on_shard, function, self.token, number, versions[number],
+                                          self._shard_data(number), args)
+                  for number, result in enumerate(results) if result is None}
+        for number, future in resent.items():
+            results[number] = future.result()
+        return results
+
+    def _query(self, query):
+        matches = [match for shard_matches in self._map(_shard_query, query) for match in shard_matches]
+        position = {patient_id: position for position, patient_id in enumerate(self.order)}
+        matches.sort(key=lambda match: position[match[0]])
+        patients = {}
+        for patient_id, positions in matches:
+            source = self[patient_id]
+            if positions is None:
+                patients[patient_id] = source
+            else:
+                patients[patient_id] = Patient(patient_id)
+                patients[patient_id].records = [source.records[position] for position in positions]
+        return patients
+
+    def query(self, query):
+        # same patients, records and order as query.execute over one PatientStore with the same data
+        if not isinstance(query, Query):
+            query = Query.all(query)
+        return self.cache.get_or_compute(("records", query.key()), self.version, lambda: self._query(query))
+
+    def summarize(self, query=None, group_by=None, percentiles=None):
+        # stats_engine summary of the matching records from per-shard partial aggregates; percentiles (by default
+        # only for grouped summaries, the ones rendered with them) need each shard's sorted values as well
+        if group_by is not None and group_by not in stats_engine.GROUP_KEYS:
+            raise ValueError(f"Unknown group_by: {group_by}")
+        keep_values = bool(group_by) if percentiles is None else percentiles
+        key = ("summary", None if query is None else query.key(), group_by, keep_values)
+        return self.cache.get_or_compute(key, self.version, lambda: stats_engine.merge_partial_summaries(
+            self._map(_shard_summary, query, group_by, keep_values)))
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.stop_executor()
+            self.executor = None
+            self.stop_executor = None
+
+    def close(self):
+        self.shutdown()
+        _SHARD_SETS.pop(self.token, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,298 @@
+import base64
+import hashlib
+import json
+import math
+import random
+from stats_engine import GROUP_KEYS, PERCENTILES, RunningStats, render_group_report, render_summary_report
+
+DEFAULT_K = 200          # KLL accuracy parameter: rank error about 1.3% at k=200, memory O(k)
+DEFAULT_PRECISION = 12   # HyperLogLog: 2**12 one-byte registers, standard error 1.04 / 64 = 1.6%
+SKETCH_SUFFIX = ".sketch"
+_MASK64 = (1 << 64) - 1
+
+
+class KLLSketch:
+    # KLL quantile sketch (Karnin, Lang, Liberty): a stack of compactors where an item on level h stands for
+    # 2**h inputs; a full level is sorted and every other item (random offset) moves up one level
+    def __init__(self, k=DEFAULT_K, seed=None):
+        self.k = k
+        self.levels = [[]]
+        self.count = 0
+        self.size = 0
+        self.max_size = self._capacity(0)
+        self.random = random.Random(seed)
+
+    def _capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(int(math.ceil(self.k * (2 / 3) ** depth)), 2)
+
+    def _grow(self):
+        self.levels.append([])
+        self.max_size = sum(self._capacity(level) for level in range(len(self.levels)))
+
+    def _compress(self):
+        for level in range(len(self.levels)):
+            items = self.levels[level]
+            if len(items) >= self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self._grow()
+                items.sort()
+                kept = [items.pop()] if len(items) % 2 else []
+                self.levels[level + 1].extend(items[self.random.getrandbits(1)::2])
+                self.levels[level] = kept
+                self.size = sum(len(items) for items in self.levels)
+                if self.size < self.max_size:
+                    break
+
+    def update(self, value):
+        self.levels[0].append(value)
+        self.count += 1
+        self.size += 1
+        if self.size >= self.max_size:
+            self._compress()
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self._grow()
+        for level, items in enumerate(other.levels):
+            self.levels[level].extend(items)
+        self.count += other.count
+        self.size = sum(len(items) for items in self.levels)
+        while self.size >= self.max_size:
+            self._compress()
+        return self
+
+    def rank_error(self):
+        # normalized rank error at 99% confidence, the empirical bound published for KLL
+        return 2.296 / self.k ** 0.9723
+
+    def quantiles(self, fractions):
+        # fraction -> value whose rank is within rank_error() * count of fraction * count
+        if not self.count:
+            return {fraction: None for fraction in fractions}
+        weighted = sorted((value, 1 << level) for level, items in enumerate(self.levels) for value in items)
+        total = sum(weight for _, weight in weighted)
+        results = {}
+        for fraction in fractions:
+            target = fraction * total
+            cumulative = 0
+            for value, weight in weighted:
+                cumulative += weight
+                if cumulative >= target:
+                    break
+            results[fraction] = value
+        return results
+
+    def to_dict(self):
+        return {"k": self.k, "count": self.count, "levels": self.levels}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["k"])
+        sketch.levels = [[]]
+        for _ in range(len(data["levels"]) - 1):
+            sketch._grow()
+        sketch.levels = [list(items) for items in data["levels"]]
+        sketch.count = data["count"]
+        sketch.size = sum(len(items) for items in sketch.levels)
+        return sketch
+
+
+def _hash64(value):
+    if isinstance(value, int):
+        # splitmix64 finalizer: patient ids are small sequential ints, the registers need well-mixed bits
+        value = (value + 0x9E3779B97F4A7C15) & _MASK64
+        value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+        value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK64
+        return value ^ (value >> 31)
+    return int.from_bytes(hashlib.blake2b(repr(value).encode(), digest_size=8).digest(), 'big')
+
+
+class HyperLogLog:
+    # distinct-count sketch: each register keeps the longest run of leading zeros seen among the hashes it gets
+    def __init__(self, precision=DEFAULT_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        hashed = _hash64(value)
+        register = hashed >> (64 - self.precision)
+        rest = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[register]:
+            self.registers[register] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("HyperLogLog sketches with different precisions cannot be merged")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def relative_error(self):
+        # one standard error
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / math.fsum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # linear counting is more accurate for small sets
+        return estimate
+
+    def to_dict(self):
+        return {"precision": self.precision, "registers": base64.b64encode(bytes(self.registers)).decode('ascii')}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["precision"])
+        sketch.registers = bytearray(base64.b64decode(data["registers"]))
+        return sketch
+
+
+def _stats_to_dict(stats):
+    return {name: getattr(stats, name) for name in RunningStats.__slots__}
+
+
+def _stats_from_dict(data):
+    stats = RunningStats()
+    for name in RunningStats.__slots__:
+        setattr(stats, name, data[name])
+    return stats
+
+
+class GroupSketch:
+    # what one group of results needs for a summary: exact running moments, value quantiles, distinct patients
+    def __init__(self, k=DEFAULT_K, precision=DEFAULT_PRECISION):
+        self.values = RunningStats()
+        self.turnarounds = RunningStats()
+        self.quantiles = KLLSketch(k)
+        self.patients = HyperLogLog(precision)
+
+    def add(self, patient_id, value, turnaround):
+        self.values.add(value)
+        self.turnarounds.add(turnaround)
+        self.quantiles.update(value)
+        self.patients.add(patient_id)
+
+    def merge(self, other):
+        self.values.merge(other.values)
+        self.turnarounds.merge(other.turnarounds)
+        self.quantiles.merge(other.quantiles)
+        self.patients.merge(other.patients)
+        return self
+
+    def describe(self):
+        values = self.values.describe()
+        fractions = [q / 100 for q in PERCENTILES]
+        estimates = self.quantiles.quantiles(fractions)
+        values["percentiles"] = {q: estimates[fraction] for q, fraction in zip(PERCENTILES, fractions)}
+        values["rank_error"] = self.quantiles.rank_error()
+        return {
+            "count": self.values.count,
+            "result_value": values,
+            "turnaround_minutes": self.turnarounds.describe(),
+            "distinct_patients": {"estimate": round(self.patients.estimate()),
+                                  "relative_error": self.patients.relative_error()},
+        }
+
+    def to_dict(self):
+        return {"values": _stats_to_dict(self.values), "turnarounds": _stats_to_dict(self.turnarounds),
+                "quantiles": self.quantiles.to_dict(), "patients": self.patients.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls()
+        sketch.values = _stats_from_dict(data["values"])
+        sketch.turnarounds = _stats_from_dict(data["turnarounds"])
+        sketch.quantiles = KLLSketch.from_dict(data["quantiles"])
+        sketch.patients = HyperLogLog.from_dict(data["patients"])
+        return sketch
+
+
+class SketchSet:
+    # bounded-memory summary state: one GroupSketch overall and one per group (per test by default); memory
+    # depends on k, the precision and the number of groups, not on the number of results
+    def __init__(self, group_by="test", k=DEFAULT_K, precision=DEFAULT_PRECISION):
+        if group_by is not None and group_by not in GROUP_KEYS:
+            raise ValueError(f"Unknown group_by: {group_by}")
+        self.group_by = group_by
+        self.k = k
+        self.precision = precision
+        self.total = GroupSketch(k, precision)
+        self.groups = {}
+
+    def add(self, patient_id, record):
+        value = record['result_value']
+        turnaround = record['test'].turnaround_minutes
+        self.total.add(patient_id, value, turnaround)
+        if self.group_by:
+            key = GROUP_KEYS[self.group_by](patient_id, record)
+            group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = GroupSketch(self.k, self.precision)
+            group.add(patient_id, value, turnaround)
+
+    def add_patients(self, patients):
+        for patient_id, patient in patients.items():
+            for record in patient.records:
+                self.add(patient_id, record)
+        return self
+
+    def add_batches(self, batches):
+        for batch in batches:
+            for patient_id, record in batch:
+                self.add(patient_id, record)
+        return self
+
+    def merge(self, other):
+        if (other.group_by, other.k, other.precision) != (self.group_by, self.k, self.precision):
+            raise ValueError("Only sketches with the same group_by, k and precision can be merged")
+        self.total.merge(other.total)
+        for key, group in other.groups.items():
+            if key in self.groups:
+                self.groups[key].merge(group)
+            else:
+                self.groups[key] = GroupSketch.from_dict(group.to_dict())
+        return self
+
+    def summary(self, grouped=True):
+        # stats_engine.summarize() shape; percentiles and distinct patients are estimates with their error bounds
+        if not self.total.values.count:
+            return None
+        summary = self.total.describe()
+        if grouped and self.group_by:
+            summary["groups"] = {key: group.describe() for key, group in sorted(self.groups.items())}
+        return summary
+
+    def to_dict(self):
+        # JSON object keys are strings, so groups are stored as [key, sketch] pairs
+        return {"group_by": self.group_by, "k": self.k, "precision": self.precision, "total": self.total.to_dict(),
+                "groups": [[key, group.to_dict()] for key, group in self.groups.items()]}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketches = cls(data["group_by"], data["k"], data["precision"])
+        sketches.total = GroupSketch.from_dict(data["total"])
+        sketches.groups = {key: GroupSketch.from_dict(group) for key, group in data["groups"]}
+        return sketches
+
+    def save(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(), file)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as file:
+            return cls.from_dict(json.load(file))
+
+
+def render_approximate_report(summary, group_label=None):
+    if summary is None:
+        return render_summary_report(summary)
+    report = render_group_report(summary, group_label) if group_label else render_summary_report(summary)
+    distinct = summary["distinct_patients"]
+    return report + (f"\nApproximate: percentiles are within {summary['result_value']['rank_error']:.1%} of their "
+                     f"rank (99% confidence); {distinct['estimate']:,} distinct patients "
+                     f"(±{distinct['relative_error']:.1%}, one standard error).\n")
@@ -0,0 +1,222 @@
+import json
+import os
+import struct
+import sys
+from array import array
+from medical_test import MedicalTest
+from patient import Patient
+from record import Record
+from record_store import RecordStore, NO_DATE
+from functions import read_medical_tests, read_medical_records
+import journal
+import metrics
+
+# Layout: MAGIC | uint32 header length | JSON header | padding to 8 bytes | column blobs (each 8-byte aligned).
+# Column offsets in the header are relative to the start of the first blob, so columns can be mmapped in place.
+MAGIC = b"MEDSNAP\x00"
+VERSION = 2
+SNAPSHOT_SUFFIX = ".snap"
+COLUMNS = (
+    ("patient_ids", 'q'),
+    ("test_ids", 'i'),
+    ("unit_ids", 'i'),
+    ("test_dates", 'q'),
+    ("result_dates", 'q'),
+    ("values", 'd'),
+    ("status_codes", 'b'),
+    ("record_ids", 'q'),
+    ("range_patient_ids", 'q'),
+    ("range_starts", 'q'),
+    ("range_stops", 'q'),
+)
+
+
+def snapshot_path(record_file):
+    return record_file + SNAPSHOT_SUFFIX
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def source_signature(paths):
+    signature = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature[path] = [stat.st_size, stat.st_mtime_ns]
+        except FileNotFoundError:
+            signature[path] = None
+    return signature
+
+
+def _sources(test_file, record_file):
+    return [test_file, record_file, journal.journal_path(record_file)]
+
+
+def _test_to_dict(test):
+    return {"name": test.name, "abbr_name": test.abbr_name, "lower_range": test.lower_range,
+            "upper_range": test.upper_range, "unit": test.unit, "turnaround_time": test.turnaround_time}
+
+
+def _store_columns(store):
+    ranges = store.patient_ranges
+    return {
+        "patient_ids": store.patient_ids,
+        "test_ids": store.test_ids,
+        "unit_ids": store.unit_ids,
+        "test_dates": store.test_dates,
+        "result_dates": store.result_dates,
+        "values": store.values,
+        "status_codes": store.status_codes,
+        "record_ids": store.record_ids,
+        "range_patient_ids": array('q', ranges.keys()),
+        "range_starts": array('q', (start for start, _ in ranges.values())),
+        "range_stops": array('q', (stop for _, stop in ranges.values())),
+    }
+
+
+def write_snapshot(path, store, tests, sources):
+    columns = _store_columns(store)
+    layout = []
+    offset = 0
+    for name, typecode in COLUMNS:
+        column = columns[name]
+        layout.append({"name": name, "typecode": typecode, "offset": offset, "length": len(column)})
+        offset = _align(offset + len(column) * column.itemsize)
+
+    header = json.dumps({
+        "version": VERSION,
+        "byteorder": sys.byteorder,
+        "sources": sources,
+        "tests": [_test_to_dict(test) for test in tests.values()],
+        "test_names": store.test_names,
+        "units": store.units,
+        "statuses": store.statuses,
+        "columns": layout,
+    }).encode()
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(MAGIC)
+        file.write(struct.pack("<I", len(header)))
+        file.write(header)
+        data_start = _align(file.tell())
+        for entry in layout:
+            file.seek(data_start + entry["offset"])
+            columns[entry["name"]].tofile(file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_header(file):
+    if file.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a medical records snapshot")
+    header_len, = struct.unpack("<I", file.read(4))
+    header = json.loads(file.read(header_len))
+    if header["version"] != VERSION:
+        raise ValueError(f"Unsupported snapshot version {header['version']}")
+    header["data_start"] = _align(len(MAGIC) + 4 + header_len)
+    return header
+
+
+def tests_from_header(header):
+    return {test["abbr_name"]: MedicalTest(**test) for test in header["tests"]}
+
+
+def load_snapshot(path):
+    with open(path, 'rb') as file:
+        header = read_header(file)
+        tests = tests_from_header(header)
+        store = RecordStore(tests)
+        columns = {}
+        for entry in header["columns"]:
+            column = array(entry["typecode"])
+            file.seek(header["data_start"] + entry["offset"])
+            column.fromfile(file, entry["length"])
+            if header["byteorder"] != sys.byteorder:
+                column.byteswap()
+            columns[entry["name"]] = column
+
+    for name, _ in COLUMNS[:8]:
+        setattr(store, name, columns[name])
+    store.set_tables(header["test_names"], header["units"], header["statuses"])
+    store.patient_ranges = dict(zip(columns["range_patient_ids"],
+                                    zip(columns["range_starts"], columns["range_stops"])))
+    return header, tests, store
+
+
+def is_fresh(path, sources):
+    try:
+        with open(path, 'rb') as file:
+            return read_header(file)["sources"] == sources
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def is_current(test_file, record_file):
+    # whether the record file's snapshot matches the text files as they are now
+    return is_fresh(snapshot_path(record_file), source_signature(_sources(test_file, record_file)))
+
+
+def patients_from_store(store, patients):
+    test_objects = [store.tests[abbr_name] for abbr_name in store.test_names]
+    units = store.units
+    statuses = store.statuses
+    records = [
+        Record(test_objects[test_id], test_date, value, units[unit_id], statuses[status_code],
+               None if result_date == NO_DATE else result_date, record_id or None)
+        for test_id, unit_id, test_date, result_date, value, status_code, record_id in zip(
+            store.test_ids, store.unit_ids, store.test_dates, store.result_dates, store.values, store.status_codes,
+            store.record_ids)
+    ]
+    for patient_id, (start, stop) in store.patient_ranges.items():
+        patient = Patient(patient_id)
+        patient.records = records[start:stop]
+        patients[patient_id] = patient
+    return patients
+
+
+def save_medical_data(test_file, record_file, tests, patients):
+    store = RecordStore.from_patients(patients, tests)
+    write_snapshot(snapshot_path(record_file), store, tests, source_signature(_sources(test_file, record_file)))
+
+
+def refresh_snapshot(test_file, record_file, tests, patients, shared=None):
+    # shared: the record file's locking.SharedFile; the snapshot is then written only if this process has seen
+    # every other process's writes, under the lock so that none land between the check and the signature
+    if shared is None:
+        if not is_fresh(snapshot_path(record_file), source_signature(_sources(test_file, record_file))):
+            save_medical_data(test_file, record_file, tests, patients)
+        return
+    with shared.locked(exclusive=False):
+        if not shared.changed():
+            refresh_snapshot(test_file, record_file, tests, patients)
+
+
+def load_medical_data(test_file, record_file, patients, workers=1):
+    # returns the tests; patients is filled from the snapshot when it matches the text sources, otherwise the record
+    # file is parsed by workers processes
+    path = snapshot_path(record_file)
+    sources = source_signature(_sources(test_file, record_file))
+    if is_fresh(path, sources):
+        try:
+            with metrics.timer("load.snapshot"):
+                _, tests, store = load_snapshot(path)
+        except (OSError, ValueError, KeyError, EOFError) as e:
+            print(f"Warning: Ignoring unreadable snapshot {path}: {e}")
+        else:
+            metrics.count("io.bytes_read", os.path.getsize(path))
+            with metrics.timer("load.build"):
+                patients_from_store(store, patients)
+            return tests
+
+    tests = read_medical_tests(test_file)
+    read_medical_records(record_file, tests, patients, workers)
+    try:
+        with metrics.timer("io.snapshot_write"):
+            save_medical_data(test_file, record_file, tests, patients)
+    except OSError as e:
+        print(f"Warning: Could not write snapshot {path}: {e}")
+    return tests
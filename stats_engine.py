@@ -0,0 +1,392 @@
+import itertools
+import math
+from array import array
+from datetime import timedelta
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+PERCENTILES = (50, 90, 95, 99)
+GROUP_KEYS = {
+    "test": lambda pid, record: record['test'].abbr_name,
+    "status": lambda pid, record: record['status'].lower(),
+    "patient": lambda pid, record: pid,
+}
+
+
+def columns_from_patients(patients, group_by=None):
+    # one pass over the records
+    values = array('d')
+    turnarounds = array('d')
+    groups = [] if group_by else None
+    group_key = GROUP_KEYS[group_by] if group_by else None
+
+    for pid, patient in patients.items():
+        for record in patient.records:
+            values.append(record['result_value'])
+            turnarounds.append(record['test'].turnaround_minutes)
+            if group_key:
+                groups.append(group_key(pid, record))
+    return values, turnarounds, groups
+
+
+def columns_from_store(store, group_by=None):
+    test_turnarounds = array('d', (store.tests[abbr_name].turnaround_minutes for abbr_name in store.test_names))
+    if np is not None:
+        test_ids = np.frombuffer(store.test_ids, dtype=np.int32)
+        values = np.frombuffer(store.values, dtype=np.float64)
+        turnarounds = np.frombuffer(test_turnarounds, dtype=np.float64)[test_ids] if len(test_ids) else np.empty(0)
+    else:
+        values = store.values
+        turnarounds = array('d', (test_turnarounds[test_id] for test_id in store.test_ids))
+
+    groups = None
+    if group_by == "test":
+        groups = [store.test_names[test_id] for test_id in store.test_ids]
+    elif group_by == "status":
+        groups = [store.statuses[code].lower() for code in store.status_codes]
+    elif group_by == "patient":
+        groups = list(store.patient_ids)
+    elif group_by:
+        raise ValueError(f"Unknown group_by: {group_by}")
+    return values, turnarounds, groups
+
+
+def _percentile(sorted_values, q):
+    # linear interpolation between closest ranks, same as numpy's default
+    position = (len(sorted_values) - 1) * q / 100
+    lower = math.floor(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def _describe(values):
+    count = len(values)
+    ordered = sorted(values)
+    total = math.fsum(ordered)
+    mean = total / count
+    # a product rather than ** 2, which goes through pow() and can round differently from numpy's square
+    variance = math.fsum((value - mean) * (value - mean) for value in ordered) / count
+    return {
+        "count": count,
+        "min": ordered[0],
+        "max": ordered[-1],
+        "mean": mean,
+        "stddev": math.sqrt(variance),
+        "percentiles": {q: _percentile(ordered, q) for q in PERCENTILES},
+    }
+
+
+def _fsum_numpy(values):
+    # math.fsum without leaving numpy: each pass splits off the leading bits of every value against a common power
+    # of two, so np.sum over those parts is exact, and the remainders go round again until nothing is left
+    if not np.isfinite(values).all():
+        return math.fsum(values.tolist())
+    scale = 1 << (values.size + 2).bit_length()
+    remainders = values.astype(np.float64)
+    leading = np.empty_like(remainders)
+    sums = []
+    while True:
+        largest = float(np.abs(remainders).max(initial=0.0))
+        if largest == 0.0:
+            return math.fsum(sums)
+        split = scale * 2.0 ** math.frexp(largest)[1]
+        if math.isinf(split):
+            return math.fsum(values.tolist())
+        np.add(remainders, split, out=leading)
+        leading -= split
+        remainders -= leading
+        sums.append(float(leading.sum()))
+
+
+def _describe_numpy(values):
+    # the sums are the correctly rounded fsum ones, as in _describe and merged RunningStats, rather than numpy's
+    # pairwise sums, so the rendered reports agree whichever way they were computed
+    mean = _fsum_numpy(values) / values.size
+    return {
+        "count": int(values.size),
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "mean": mean,
+        "stddev": math.sqrt(_fsum_numpy(np.square(values - mean)) / values.size),
+        "percentiles": dict(zip(PERCENTILES, (float(p) for p in np.percentile(values, PERCENTILES)))),
+    }
+
+
+def _summarize_numpy(values, turnarounds, groups):
+    values = np.asarray(values, dtype=np.float64)
+    turnarounds = np.asarray(turnarounds, dtype=np.float64)
+    summary = {
+        "count": int(values.size),
+        "result_value": _describe_numpy(values),
+        "turnaround_minutes": _describe_numpy(turnarounds),
+    }
+    if groups is not None:
+        keys, inverse = np.unique(np.asarray(groups), return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.cumsum(np.bincount(inverse, minlength=len(keys)))[:-1]
+        value_groups = np.split(values[order], bounds)
+        turnaround_groups = np.split(turnarounds[order], bounds)
+        summary["groups"] = {
+            key.item(): {
+                "count": int(group_values.size),
+                "result_value": _describe_numpy(group_values),
+                "turnaround_minutes": _describe_numpy(group_turnarounds),
+            }
+            for key, group_values, group_turnarounds in zip(keys, value_groups, turnaround_groups)
+        }
+    return summary
+
+
+def _summarize_python(values, turnarounds, groups):
+    summary = {
+        "count": len(values),
+        "result_value": _describe(values),
+        "turnaround_minutes": _describe(turnarounds),
+    }
+    if groups is not None:
+        grouped = {}
+        for key, value, turnaround in zip(groups, values, turnarounds):
+            group = grouped.get(key)
+            if group is None:
+                group = grouped[key] = ([], [])
+            group[0].append(value)
+            group[1].append(turnaround)
+        summary["groups"] = {
+            key: {
+                "count": len(group_values),
+                "result_value": _describe(group_values),
+                "turnaround_minutes": _describe(group_turnarounds),
+            }
+            for key, (group_values, group_turnarounds) in sorted(grouped.items())
+        }
+    return summary
+
+
+def summarize(values, turnarounds, groups=None, use_numpy=None):
+    if not len(values):
+        return None
+    if use_numpy is None:
+        use_numpy = np is not None
+    if use_numpy:
+        if np is None:
+            raise RuntimeError("numpy is not installed")
+        return _summarize_numpy(values, turnarounds, groups)
+    return _summarize_python(values, turnarounds, groups)
+
+
+def summarize_patients(patients, group_by=None, use_numpy=None):
+    return summarize(*columns_from_patients(patients, group_by), use_numpy=use_numpy)
+
+
+def summarize_store(store, group_by=None, use_numpy=None):
+    return summarize(*columns_from_store(store, group_by), use_numpy=use_numpy)
+
+
+class RunningStats:
+    # mergeable partial aggregate; enough for min/max/mean/stddev without keeping the values. m2 is the sum of
+    # squared deviations from the mean (Welford), merged with Chan et al.'s pairwise update: a sum of squares
+    # minus the squared mean would cancel catastrophically when the spread is small next to the mean
+    __slots__ = ("count", "total", "error", "m2", "min", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.error = 0.0  # what rounding dropped from total, so merging partials does not accumulate rounding
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    @classmethod
+    def from_values(cls, values):
+        # one partial over a whole column; merged from_values partials total to the same math.fsum as all the
+        # values in one column would
+        stats = cls()
+        if len(values):
+            stats.count = len(values)
+            stats.total = math.fsum(values)
+            stats.error = math.fsum(itertools.chain(values, (-stats.total,)))
+            mean = stats.total / stats.count
+            stats.m2 = math.fsum((value - mean) * (value - mean) for value in values)
+            stats.min = min(values)
+            stats.max = max(values)
+        return stats
+
+    def mean(self):
+        return self.total / self.count
+
+    def add(self, value):
+        previous = self.mean() if self.count else value
+        self.count += 1
+        self.total += value
+        self.m2 += (value - previous) * (value - self.mean())
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if self.count and other.count:
+            delta = other.mean() - self.mean()
+            self.m2 += other.m2 + delta * delta * (self.count * other.count / (self.count + other.count))
+        else:
+            self.m2 += other.m2
+        parts = (self.total, self.error, other.total, other.error)
+        self.count += other.count
+        self.total = math.fsum(parts)
+        self.error = math.fsum(parts + (-self.total,))
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def describe(self):
+        return {
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.mean(),
+            "stddev": math.sqrt(max(self.m2, 0.0) / self.count),
+            "percentiles": {},
+        }
+
+
+def describe_running(value_stats, turnaround_stats):
+    return {
+        "count": value_stats.count,
+        "result_value": value_stats.describe(),
+        "turnaround_minutes": turnaround_stats.describe(),
+    }
+
+
+def summarize_batches(batches, group_by=None):
+    # bounded-memory summary over (patient_id, record) batches; percentiles need the values, so they are omitted
+    group_key = GROUP_KEYS[group_by] if group_by else None
+    totals = (RunningStats(), RunningStats())
+    grouped = {}
+
+    for batch in batches:
+        for pid, record in batch:
+            minutes = record['test'].turnaround_minutes
+            targets = [totals]
+            if group_key:
+                key = group_key(pid, record)
+                group = grouped.get(key)
+                if group is None:
+                    group = grouped[key] = (RunningStats(), RunningStats())
+                targets.append(group)
+            for value_stats, turnaround_stats in targets:
+                value_stats.add(record['result_value'])
+                turnaround_stats.add(minutes)
+
+    if not totals[0].count:
+        return None
+    summary = describe_running(*totals)
+    if group_key:
+        summary["groups"] = {key: describe_running(*group) for key, group in sorted(grouped.items())}
+    return summary
+
+
+def _partial(values, turnarounds, keep_values):
+    return (RunningStats.from_values(values), RunningStats.from_values(turnarounds),
+            array('d', sorted(values)) if keep_values else None,
+            array('d', sorted(turnarounds)) if keep_values else None)
+
+
+def partial_summary(values, turnarounds, groups=None, keep_values=False):
+    # map side of a sharded summary: RunningStats per column, overall and per group; percentiles cannot be
+    # merged from aggregates, so keep_values also carries the sorted values, overall and per group
+    partial = {"total": _partial(values, turnarounds, keep_values), "groups": None}
+    if groups is not None:
+        columns = {}
+        for key, value, turnaround in zip(groups, values, turnarounds):
+            column = columns.get(key)
+            if column is None:
+                column = columns[key] = (array('d'), array('d'))
+            column[0].append(value)
+            column[1].append(turnaround)
+        partial["groups"] = {key: _partial(group_values, group_turnarounds, keep_values)
+                             for key, (group_values, group_turnarounds) in columns.items()}
+    return partial
+
+
+def _merged_percentiles(runs, use_numpy):
+    # each run is already sorted, so this sort is a merge; numpy's interpolation rounds differently in the
+    # last bit, so the percentiles come from whichever implementation summarize() would use
+    ordered = sorted(itertools.chain.from_iterable(runs))
+    if use_numpy:
+        return dict(zip(PERCENTILES, (float(p) for p in np.percentile(ordered, PERCENTILES))))
+    return {q: _percentile(ordered, q) for q in PERCENTILES}
+
+
+def _merge_partials(partials, use_numpy):
+    value_stats, turnaround_stats = RunningStats(), RunningStats()
+    value_runs, turnaround_runs = [], []
+    for shard_values, shard_turnarounds, sorted_values, sorted_turnarounds in partials:
+        value_stats.merge(shard_values)
+        turnaround_stats.merge(shard_turnarounds)
+        if sorted_values is not None:
+            value_runs.append(sorted_values)
+            turnaround_runs.append(sorted_turnarounds)
+    summary = describe_running(value_stats, turnaround_stats)
+    if value_runs:
+        summary["result_value"]["percentiles"] = _merged_percentiles(value_runs, use_numpy)
+        summary["turnaround_minutes"]["percentiles"] = _merged_percentiles(turnaround_runs, use_numpy)
+    return summary
+
+
+def merge_partial_summaries(partials, use_numpy=None):
+    # reduce side: the summarize() result for all the shards' records together; the mean comes from the merged
+    # sums and the stddev from the merged m2, equal to the pure Python summary and to numpy's within the last bits
+    partials = [partial for partial in partials if partial["total"][0].count]
+    if not partials:
+        return None
+    if use_numpy is None:
+        use_numpy = np is not None
+    summary = _merge_partials([partial["total"] for partial in partials], use_numpy)
+    if partials[0]["groups"] is not None:
+        grouped = {}
+        for partial in partials:
+            for key, group in partial["groups"].items():
+                grouped.setdefault(key, []).append(group)
+        summary["groups"] = {key: _merge_partials(groups, use_numpy) for key, groups in sorted(grouped.items())}
+    return summary
+
+
+def format_turnaround(minutes):
+    delta = timedelta(minutes=minutes)
+    return f"{delta.days}-{delta.seconds // 3600}-{(delta.seconds // 60) % 60}"
+
+
+def render_summary_report(summary):
+    if summary is None:
+        return "No records found for the selected criteria."
+
+    values = summary["result_value"]
+    turnarounds = summary["turnaround_minutes"]
+    return f"Summary Report for Filtered Records:\n" \
+           f"-----------------------------------\n" \
+           f"Test Values:\n" \
+           f" - Minimum Test Value: {values['min']}\n" \
+           f" - Maximum Test Value: {values['max']}\n" \
+           f" - Average Test Value: {values['mean']:.2f}\n\n" \
+           f"Turnaround Times:\n" \
+           f" - Minimum Turnaround Time: {format_turnaround(turnarounds['min'])}\n" \
+           f" - Maximum Turnaround Time: {format_turnaround(turnarounds['max'])}\n" \
+           f" - Average Turnaround Time: {format_turnaround(turnarounds['mean'])}\n"
+
+
+def render_group_report(summary, group_label="Group"):
+    if summary is None or "groups" not in summary:
+        return render_summary_report(summary)
+
+    lines = [f"{group_label:<12} {'Count':>7} {'Min':>9} {'Max':>9} {'Mean':>9} {'StdDev':>9} "
+             + " ".join(f"{'P' + str(q):>9}" for q in PERCENTILES)]
+    for key, group in summary["groups"].items():
+        values = group["result_value"]
+        lines.append(f"{str(key):<12} {group['count']:>7} {values['min']:>9.2f} {values['max']:>9.2f} "
+                     f"{values['mean']:>9.2f} {values['stddev']:>9.2f} "
+                     + " ".join(f"{values['percentiles'][q]:>9.2f}" if q in values['percentiles'] else f"{'-':>9}"
+                                for q in PERCENTILES))
+    return "\n".join(lines) + "\n"
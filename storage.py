@@ -0,0 +1,407 @@
+import os
+import sqlite3
+from contextlib import contextmanager, nullcontext
+from patient import Patient
+from record import Record
+from record_format import format_record_line, parse_record_line
+from timeutil import minutes_from_datetime, turnaround_minutes
+import journal
+import locking
+import metrics
+import parallel_loader
+import record_stream
+from query import Query
+
+SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
+INSERT_BATCH_SIZE = 10000
+
+
+class StorageBackend:
+    # persistence behind read_medical_records / add_new_medical_test_record / update_patient_records
+    supports_query = False
+
+    def load(self, tests, patients, workers=1):
+        raise NotImplementedError
+
+    def append_record(self, patient_id, record_number, record):
+        raise NotImplementedError
+
+    def append_records(self, rows):
+        # rows of (patient_id, record_number, record), persisted together
+        for patient_id, record_number, record in rows:
+            self.append_record(patient_id, record_number, record)
+
+    def update_record(self, patients, patient_id, record_number, record):
+        raise NotImplementedError
+
+    def query(self, query):
+        raise NotImplementedError
+
+    def writing(self):
+        # context for one change made by several calls; backends with their own concurrency control need nothing
+        return nullcontext(self)
+
+    def refresh(self):
+        # applies what other processes wrote since this one loaded; returns the number of records applied
+        return 0
+
+    def close(self, patients=None):
+        pass
+
+
+def _file_identity(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None, 0
+    return (stat.st_dev, stat.st_ino), stat.st_size
+
+
+class TextStorage(StorageBackend):
+    # several processes can share the files: every write holds an exclusive lock on "<file>.lock" and bumps the
+    # generation stored there, and an attached store catches up by reading only what was written after it
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.shared = locking.SharedFile(file_path)
+        self.tests = None
+        self.patients = None         # set by attach(): the in-memory data refresh() keeps up to date
+        self.identity = None         # (st_dev, st_ino) of the record file the positions below refer to
+        self.position = 0            # bytes of the record file already in patients
+        self.journal_position = 0    # bytes of the journal already applied
+
+    def load(self, tests, patients, workers=1):
+        with self.shared.locked(exclusive=False):
+            self._load(tests, patients, workers)
+            self.attach(tests, patients)
+        return patients
+
+    def _load(self, tests, patients, workers=1):
+        if workers != 1:
+            return parallel_loader.read_medical_records_parallel(self.file_path, tests, patients, workers)
+
+        metrics.count("io.bytes_read", os.path.getsize(self.file_path))
+        for batch in metrics.timed_iter("load.parse", record_stream.iter_record_batches(self.file_path, tests)):
+            with metrics.timer("load.build"):
+                for patient_id, record in batch:
+                    if patient_id not in patients:
+                        patients[patient_id] = Patient(patient_id)
+
+                    patients[patient_id].add_loaded_record(record)
+
+        with metrics.timer("load.journal"):
+            journal.replay_journal(self.file_path, tests, patients)
+        return patients
+
+    def attach(self, tests, patients):
+        # patients holds these files as of now (loaded under the shared lock, e.g. from a snapshot); from here on
+        # refresh() and writing() keep it up to date with the other processes' writes
+        with self.shared.locked(exclusive=False) as lock:
+            self.tests = tests
+            self.patients = patients
+            self._synced(lock.generation())
+
+    def _synced(self, generation):
+        self.identity, self.position = _file_identity(self.file_path)
+        self.journal_position = _file_identity(journal.journal_path(self.file_path))[1]
+        self.shared.generation = generation
+
+    def refresh(self):
+        if self.patients is None or not self.shared.changed():
+            return 0
+        with self.shared.locked(exclusive=False) as lock:
+            return self._catch_up(lock)
+
+    def _catch_up(self, lock):
+        generation = lock.generation()
+        if generation == self.shared.generation:
+            return 0
+        identity, size = _file_identity(self.file_path)
+        with metrics.timer("load.refresh"):
+            if identity != self.identity or size < self.position:
+                # compacted (rewritten in patient order) by another process: positions no longer line up
+                applied = self._reload()
+            else:
+                # appended records first: journal entries may refer to them
+                applied = self._read_appended(size)
+                applied += journal.replay_journal(self.file_path, self.tests, self.patients, self.journal_position)
+        metrics.count("load.refresh_records", applied)
+        self._synced(generation)
+        return applied
+
+    def _read_appended(self, size):
+        with open(self.file_path, 'rb') as file:
+            file.seek(self.position)
+            data = file.read(size - self.position).decode()
+        metrics.count("io.bytes_read", len(data))
+
+        applied = 0
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            try:
+                patient_id, abbr_name, record = parse_record_line(line, self.tests)
+            except (ValueError, IndexError) as e:
+                print(f"Error processing line: {line}\nException: {e}")
+                continue
+            if record is None:
+                print(f"Warning: Test '{abbr_name}' not found in the list of valid medical tests.")
+                continue
+            if patient_id not in self.patients:
+                self.patients[patient_id] = Patient(patient_id)
+            self.patients[patient_id].add_loaded_record(record)
+            applied += 1
+        return applied
+
+    def _reload(self):
+        reloaded = self._load(self.tests, {})
+        for patient_id, patient in reloaded.items():
+            self.patients[patient_id] = patient
+        return sum(len(patient.records) for patient in reloaded.values())
+
+    @contextmanager
+    def writing(self):
+        # exclusive access for one change: an attached store first catches up, so a compaction sees the other
+        # processes' writes instead of overwriting them
+        with self.shared.writing() as lock:
+            if lock.depth > 1:
+                yield self
+                return
+            if self.patients is not None:
+                self._catch_up(lock)
+            try:
+                yield self
+            finally:
+                if self.patients is not None:
+                    self.identity, self.position = _file_identity(self.file_path)
+                    self.journal_position = _file_identity(journal.journal_path(self.file_path))[1]
+
+    def _current(self, lock):
+        # whether this process has seen every write so far, so its patients may replace the file's contents
+        return lock.generation() == self.shared.generation
+
+    def _first_free_id(self):
+        # above every id in the record file, including the positions lines without an id are numbered by
+        try:
+            file = open(self.file_path, 'r')
+        except FileNotFoundError:
+            return 1
+        lines = last_id = 0
+        with file:
+            for line in file:
+                if line.strip():
+                    lines += 1
+                    record_id = line.split(":", 1)[0].partition("/")[2].strip()
+                    if record_id.isdigit():
+                        last_id = max(last_id, int(record_id))
+        return max(lines, last_id) + 1
+
+    def _assign_ids(self, records):
+        # ids for records that were never written to the record file; record numbers shift, these do not
+        records = [record for record in records if record.record_id is None]
+        if records:
+            with self.shared.locked() as lock:
+                first = lock.allocate_ids(len(records), self._first_free_id)
+            for record_id, record in enumerate(records, first):
+                record.record_id = record_id
+
+    def append_record(self, patient_id, record_number, record):
+        with self.writing(), open(self.file_path, 'a') as file:
+            self._assign_ids([record])
+            file.write(f"\n{format_record_line(patient_id, record)}")
+
+    def append_records(self, rows):
+        with metrics.timer("io.flush"), self.writing():
+            self._assign_ids(record for _, _, record in rows)
+            lines = [f"\n{format_record_line(patient_id, record)}" for patient_id, _, record in rows]
+            with open(self.file_path, 'a') as file:
+                file.writelines(lines)
+        metrics.count("io.rows_written", len(lines))
+        if metrics.enabled():
+            metrics.count("io.bytes_written", sum(map(len, lines)))
+
+    def update_record(self, patients, patient_id, record_number, record):
+        with self.writing():
+            if record.record_id is None:
+                # never written (e.g. imported in this session): the edited record is its first line in the file
+                self.append_record(patient_id, record_number, record)
+                return
+            journal.append_update(self.file_path, patient_id, record)
+            with self.shared.locked() as lock:
+                if self._current(lock) and journal.needs_compaction(self.file_path):
+                    self._compact(patients)
+
+    def _compact(self, patients):
+        # records only in memory are written too, so they get their ids first
+        self._assign_ids(record for patient in patients.values() for record in patient.records)
+        with metrics.timer("io.compact"):
+            journal.compact_medical_records(self.file_path, patients)
+
+    def close(self, patients=None):
+        # compacts only from a view that includes every other process's writes; otherwise the journal is left
+        # for a process that has them to fold in
+        if patients is None or not journal.has_pending_updates(self.file_path):
+            return False
+        with self.writing(), self.shared.locked() as lock:
+            if not self._current(lock) or not journal.has_pending_updates(self.file_path):
+                return False
+            self._compact(patients)
+            return True
+
+
+class SqliteStorage(StorageBackend):
+    supports_query = True
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        self.tests = {}
+        with self.connection:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS records (
+                    id INTEGER PRIMARY KEY,
+                    patient_id INTEGER NOT NULL,
+                    record_number INTEGER NOT NULL,
+                    abbr_name TEXT NOT NULL,
+                    test_date INTEGER NOT NULL,
+                    result_value REAL NOT NULL,
+                    unit TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    result_date INTEGER
+                );
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_records_patient ON records (patient_id, record_number);
+                CREATE INDEX IF NOT EXISTS idx_records_test_date ON records (abbr_name, test_date);
+                CREATE INDEX IF NOT EXISTS idx_records_status ON records (status COLLATE NOCASE);
+                CREATE TABLE IF NOT EXISTS tests (
+                    abbr_name TEXT PRIMARY KEY,
+                    lower_range REAL,
+                    upper_range REAL,
+                    turnaround_minutes INTEGER NOT NULL
+                );
+            """)
+
+    def sync_tests(self, tests):
+        self.tests = tests
+        with self.connection:
+            self.connection.execute("DELETE FROM tests")
+            self.connection.executemany(
+                "INSERT INTO tests (abbr_name, lower_range, upper_range, turnaround_minutes) VALUES (?, ?, ?, ?)",
+                [(test.abbr_name, test.lower_range, test.upper_range, test.turnaround_minutes)
+                 for test in tests.values()])
+
+    def _records(self, cursor, patients):
+        for patient_id, abbr_name, test_date, result_value, unit, status, result_date in cursor:
+            if abbr_name not in self.tests:
+                print(f"Warning: Test '{abbr_name}' not found in the list of valid medical tests.")
+                continue
+            if patient_id not in patients:
+                patients[patient_id] = Patient(patient_id)
+            patients[patient_id].add_record(
+                Record(self.tests[abbr_name], test_date, result_value, unit, status, result_date))
+        return patients
+
+    def load(self, tests, patients, workers=1):
+        self.sync_tests(tests)
+        cursor = self.connection.execute(
+            "SELECT patient_id, abbr_name, test_date, result_value, unit, status, result_date "
+            "FROM records ORDER BY id")
+        with metrics.timer("load.sqlite"):
+            return self._records(cursor, patients)
+
+    def _row(self, patient_id, record_number, record):
+        return (patient_id, record_number, record['test'].abbr_name, record['test_date'], record['result_value'],
+                record['unit'], record['status'], record['result_date'])
+
+    def append_record(self, patient_id, record_number, record):
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO records (patient_id, record_number, abbr_name, test_date, result_value, unit, status, "
+                "result_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self._row(patient_id, record_number, record))
+
+    def append_records(self, rows):
+        rows = [self._row(patient_id, record_number, record) for patient_id, record_number, record in rows]
+        with metrics.timer("io.flush"), self.connection:
+            self._insert_rows(rows)
+        metrics.count("io.rows_written", len(rows))
+
+    def insert_patients(self, patients, batch_size=INSERT_BATCH_SIZE):
+        # one transaction, executemany in fixed-size batches
+        rows = []
+        with self.connection:
+            for patient_id, patient in patients.items():
+                for record_number, record in enumerate(patient.records):
+                    rows.append(self._row(patient_id, record_number, record))
+                    if len(rows) >= batch_size:
+                        self._insert_rows(rows)
+                        rows = []
+            if rows:
+                self._insert_rows(rows)
+
+    def _insert_rows(self, rows):
+        self.connection.executemany(
+            "INSERT INTO records (patient_id, record_number, abbr_name, test_date, result_value, unit, status, "
+            "result_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def update_record(self, patients, patient_id, record_number, record):
+        # upsert: an edited record may only exist in memory so far (e.g. an import)
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO records (patient_id, record_number, abbr_name, test_date, result_value, unit, status, "
+                "result_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (patient_id, record_number) DO UPDATE SET "
+                "abbr_name = excluded.abbr_name, test_date = excluded.test_date, result_value = excluded.result_value, "
+                "unit = excluded.unit, status = excluded.status, result_date = excluded.result_date",
+                self._row(patient_id, record_number, record))
+
+    def _clause(self, query, params):
+        if query.op != "criterion":
+            clauses = [self._clause(child, params) for child in query.children]
+            if not clauses:
+                return "1" if query.op == "and" else "0"
+            return "(" + f" {query.op.upper()} ".join(clauses) + ")"
+
+        kind, args = query.criterion[0], query.criterion[1:]
+        if kind == "patient_id":
+            params.append(args[0])
+            return "r.patient_id = ?"
+        if kind == "test_name":
+            params.append(args[0])
+            return "r.abbr_name = ?"
+        if kind == "abnormal":
+            return ("((t.lower_range IS NOT NULL AND r.result_value < t.lower_range) OR "
+                    "(t.upper_range IS NOT NULL AND r.result_value > t.upper_range))")
+        if kind == "date_range":
+            params.extend((minutes_from_datetime(args[0]), minutes_from_datetime(args[1])))
+            return "r.test_date BETWEEN ? AND ?"
+        if kind == "status":
+            params.append(args[0])
+            return "r.status = ? COLLATE NOCASE"
+        if kind == "turnaround":
+            params.extend((turnaround_minutes(args[0]), turnaround_minutes(args[1])))
+            return "t.turnaround_minutes BETWEEN ? AND ?"
+        raise ValueError(f"Unknown filter criterion: {kind}")
+
+    def build_query(self, query):
+        if not isinstance(query, Query):
+            query = Query.all(query)
+        params = []
+        sql = ("SELECT r.patient_id, r.abbr_name, r.test_date, r.result_value, r.unit, r.status, r.result_date "
+               "FROM records r JOIN tests t ON t.abbr_name = r.abbr_name WHERE " + self._clause(query, params))
+        # id order groups back into the same patient/record order as the in-memory filters
+        return sql + " ORDER BY r.id", params
+
+    def query(self, query):
+        # ranges/turnaround may have changed through update_medical_tests since the last sync
+        self.sync_tests(self.tests)
+        sql, params = self.build_query(query)
+        return self._records(self.connection.execute(sql, params), {})
+
+    def close(self, patients=None):
+        self.connection.close()
+        return False
+
+
+def open_storage(target):
+    if isinstance(target, StorageBackend):
+        return target
+    if str(target).endswith(SQLITE_SUFFIXES):
+        return SqliteStorage(target)
+    return TextStorage(target)
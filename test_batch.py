@@ -0,0 +1,31 @@
+from batch import BatchSession
+
+TESTS = "Name: Hemoglobin (Hgb); Range: > 13.8, < 17.2; Unit: g/dL, 00-03-04\n"
+RECORDS = "1300500: Hgb, 2023-07-07 07:50, 12.0, g/dL, reviewed\n"
+
+
+def values(patients):
+    return sorted((pid, record['result_value']) for pid, patient in patients.items() for record in patient.records)
+
+
+def row(**fields):
+    return dict({"patient_id": 1300500, "test": "Hgb", "test_date": "2024-01-01 10:00", "result_value": 14.0},
+                **fields)
+
+
+def test_rejected_rows_leave_the_index_and_queries_unchanged(tmp_path):
+    (tmp_path / "medicalTest.txt").write_text(TESTS)
+    (tmp_path / "medicalRecord.txt").write_text(RECORDS)
+    with BatchSession(str(tmp_path / "medicalTest.txt"), str(tmp_path / "medicalRecord.txt")) as session:
+        missing_date = row()
+        del missing_date["test_date"]
+        rows = [row(), missing_date, row(test_date=None), row(test_date=27000000.5), row(status=None),
+                row(test="XYZ"), row(result_value="high"), row(result_date="2023-12-31 10:00"),
+                row(patient_id=1300600, test_date=None)]
+        added, rejected = session.ingest(rows)
+        assert (added, [position for position, _, _ in rejected]) == (1, [2, 3, 4, 5, 6, 7, 8, 9])
+
+        assert len(session.patients.index) == 2
+        assert 1300600 not in session.patients
+        assert values(session.query([("test_name", "Hgb")])) == [(1300500, 12.0), (1300500, 14.0)]
+        assert values(session.query([("abnormal",)])) == [(1300500, 12.0)]
@@ -0,0 +1,39 @@
+import os
+import bulk_import
+import storage
+from functions import read_medical_tests
+from patient import PatientStore
+
+TESTS = "Name: Hemoglobin (Hgb); Range: > 13.8, < 17.2; Unit: g/dL, 00-03-04\n"
+HEADER = "Patient ID,Abbreviation,Test Date,Result Value,Unit,Status,Result Date\n"
+
+
+def load(tmp_path):
+    tests = read_medical_tests(str(tmp_path / "medicalTest.txt"))
+    patients = PatientStore()
+    records = storage.open_storage(str(tmp_path / "medicalRecord.txt"))
+    records.load(tests, patients)
+    return tests, patients, records
+
+
+def test_imports_are_stored_and_old_rejects_cleared(tmp_path):
+    (tmp_path / "medicalTest.txt").write_text(TESTS)
+    (tmp_path / "medicalRecord.txt").write_text("1300511: Hgb, 2021-03-02 07:30, 110.0, g/dL, pending\n")
+    csv_path = tmp_path / "medical_records.csv"
+    reject_path = bulk_import.reject_path_for(str(csv_path))
+
+    csv_path.write_text(HEADER + "1300511,Hgb,2023-01-01 10:00,14.2,g/dL,pending,\n"
+                                 "1300511,XYZ,2023-01-01 10:00,1.0,g/dL,pending,\n")
+    tests, patients, records = load(tmp_path)
+    report = bulk_import.bulk_import(str(csv_path), tests, patients, records)
+    assert (report.accepted, report.rejected) == (1, 1)
+    assert os.path.exists(reject_path)
+
+    csv_path.write_text(HEADER + "1300600,Hgb,2023-01-02 10:00,15.0,g/dL,pending,\n")
+    report = bulk_import.bulk_import(str(csv_path), tests, patients, records)
+    assert (report.accepted, report.rejected) == (1, 0)
+    assert not os.path.exists(reject_path)
+
+    _, reloaded, _ = load(tmp_path)
+    assert [record['result_value'] for record in reloaded[1300511].records] == [110.0, 14.2]
+    assert [record['result_value'] for record in reloaded[1300600].records] == [15.0]
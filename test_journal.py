@@ -0,0 +1,99 @@
+import journal
+import storage
+from functions import read_medical_tests
+from patient import Patient, PatientStore
+from record import Record
+
+TESTS = "Name: Hemoglobin (Hgb); Range: > 13.8, < 17.2; Unit: g/dL, 00-03-04\n"
+RECORDS = ("1300500: Hgb, 2023-07-07 07:50, 122.0, g/dL, reviewed\n"
+           "1300511: Hgb, 2021-03-02 07:30, 110.0, g/dL, pending\n")
+
+
+def session(tmp_path):
+    tests = read_medical_tests(str(tmp_path / "medicalTest.txt"))
+    patients = PatientStore()
+    records = storage.open_storage(str(tmp_path / "medicalRecord.txt"))
+    records.load(tests, patients)
+    return tests, patients, records
+
+
+def values(patients, patient_id):
+    return [record['result_value'] for record in patients[patient_id].records]
+
+
+def add(tests, patients, records, patient_id, value):
+    record = Record(tests["Hgb"], 27000000, value, "g/dL", "pending")
+    with records.writing():
+        if patient_id not in patients:
+            patients[patient_id] = Patient(patient_id)
+        patients[patient_id].add_record(record)
+        records.append_record(patient_id, len(patients[patient_id].records) - 1, record)
+
+
+def edit(patients, records, patient_id, record_number, value):
+    record = patients[patient_id].records[record_number]
+    record['result_value'] = value
+    with records.writing():
+        patients[patient_id].replace_record(record_number, record)
+        records.update_record(patients, patient_id, record_number, record)
+
+
+def setup_files(tmp_path):
+    (tmp_path / "medicalTest.txt").write_text(TESTS)
+    (tmp_path / "medicalRecord.txt").write_text(RECORDS)
+
+
+def test_edits_follow_records_that_were_never_written(tmp_path):
+    setup_files(tmp_path)
+    tests, patients, records = session(tmp_path)
+    # two imported records that only exist in memory shift the record numbers of the session
+    patients[1300511].add_records([Record(tests["Hgb"], 27000000, 14.2, "g/dL", "pending"),
+                                   Record(tests["Hgb"], 27000000, 15.0, "g/dL", "pending")])
+    edit(patients, records, 1300511, 2, 16.0)
+    add(tests, patients, records, 1300511, 13.0)
+    edit(patients, records, 1300511, 3, 12.0)
+    assert values(patients, 1300511) == [110.0, 14.2, 16.0, 12.0]
+
+    _, reloaded, _ = session(tmp_path)
+    # the import that was never edited was never written; everything written comes back as edited
+    assert values(reloaded, 1300511) == [110.0, 16.0, 12.0]
+    assert values(reloaded, 1300500) == [122.0]
+
+
+def test_replay_skips_edits_of_missing_records(tmp_path, capsys):
+    setup_files(tmp_path)
+    tests, patients, _ = session(tmp_path)
+    record = Record(tests["Hgb"], 27000000, 99.0, "g/dL", "pending", record_id=7)
+    journal.append_update(str(tmp_path / "medicalRecord.txt"), 1300511, record)
+
+    _, reloaded, _ = session(tmp_path)
+    assert values(reloaded, 1300511) == [110.0]
+    assert "missing record" in capsys.readouterr().out
+
+
+def test_legacy_entries_replay_by_position(tmp_path):
+    setup_files(tmp_path)
+    (tmp_path / "medicalRecord.txt.journal").write_text("0 1300511: Hgb, 2021-03-02 07:30, 111.0, g/dL, pending\n")
+    _, patients, _ = session(tmp_path)
+    assert values(patients, 1300511) == [111.0]
+
+
+def test_compaction_keeps_ids_and_edits(tmp_path):
+    setup_files(tmp_path)
+    tests, patients, records = session(tmp_path)
+    add(tests, patients, records, 1300511, 13.0)
+    edit(patients, records, 1300511, 0, 120.0)
+    patients[1300500].add_record(Record(tests["Hgb"], 27000000, 14.0, "g/dL", "pending"))
+    assert records.close(patients)
+    assert not journal.has_pending_updates(str(tmp_path / "medicalRecord.txt"))
+
+    tests, reloaded, records = session(tmp_path)
+    assert values(reloaded, 1300511) == [120.0, 13.0]
+    assert values(reloaded, 1300500) == [122.0, 14.0]
+    for patient in reloaded.values():
+        ids = [record.record_id for record in patient.records]
+        assert None not in ids and len(set(ids)) == len(ids)
+
+    edit(reloaded, records, 1300500, 1, 15.0)
+    _, again, _ = session(tmp_path)
+    assert values(again, 1300500) == [122.0, 15.0]
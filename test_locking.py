@@ -0,0 +1,77 @@
+import locking
+import storage
+from functions import read_medical_tests
+from patient import Patient, PatientStore
+from record import Record
+
+TESTS = "\nName: Hemoglobin (Hgb); Range: > 13.8, < 17.2; Unit: g/dL, 00-03-04\n"
+RECORDS = "1300500: Hgb, 2023-07-07 07:50, 12.0, g/dL, reviewed\n"
+
+
+def open_session(tmp_path):
+    tests = read_medical_tests(str(tmp_path / "medicalTest.txt"))
+    patients = PatientStore()
+    records = storage.open_storage(str(tmp_path / "medicalRecord.txt"))
+    records.load(tests, patients)
+    return tests, patients, records
+
+
+def values(patients):
+    return sorted((pid, record['result_value']) for pid, patient in patients.items() for record in patient.records)
+
+
+def test_tests_written_with_a_leading_blank_line_load_quietly(tmp_path, capsys):
+    (tmp_path / "medicalTest.txt").write_text(TESTS)
+    assert list(read_medical_tests(str(tmp_path / "medicalTest.txt"))) == ["Hgb"]
+    assert capsys.readouterr().out == ""
+
+
+def test_writes_bump_the_generation(tmp_path):
+    path = str(tmp_path / "medicalRecord.txt")
+    assert locking.read_generation(path) == 0
+    shared = locking.SharedFile(path)
+    with shared.writing():
+        with shared.writing():
+            pass
+    assert locking.read_generation(path) == 1
+    assert not shared.changed()
+
+    other = locking.SharedFile(path)
+    with other.writing():
+        pass
+    assert shared.changed() and not other.changed()
+
+
+def test_refresh_picks_up_another_sessions_writes(tmp_path):
+    (tmp_path / "medicalTest.txt").write_text(TESTS)
+    (tmp_path / "medicalRecord.txt").write_text(RECORDS)
+    tests, first, first_records = open_session(tmp_path)
+    _, second, second_records = open_session(tmp_path)
+    assert first_records.refresh() == 0
+
+    record = Record(tests["Hgb"], 27000000, 15.0, "g/dL", "pending")
+    second[1300600] = Patient(1300600)
+    second[1300600].add_record(record)
+    second_records.append_record(1300600, 0, record)
+    assert first_records.refresh() == 1
+    assert values(first) == [(1300500, 12.0), (1300600, 15.0)]
+
+    edited = second[1300500].records[0]
+    edited['result_value'] = 13.0
+    second_records.update_record(second, 1300500, 0, edited)
+    assert first_records.refresh() == 1
+    assert values(first) == values(second) == [(1300500, 13.0), (1300600, 15.0)]
+
+
+def test_record_ids_are_not_shared_between_sessions(tmp_path):
+    (tmp_path / "medicalTest.txt").write_text(TESTS)
+    (tmp_path / "medicalRecord.txt").write_text(RECORDS)
+    tests, _, first_records = open_session(tmp_path)
+    _, _, second_records = open_session(tmp_path)
+    written = []
+    for records in (first_records, second_records, first_records):
+        record = Record(tests["Hgb"], 27000000, 15.0, "g/dL", "pending")
+        records.append_record(1300700, 0, record)
+        written.append(record.record_id)
+    # the unnumbered line in the file keeps id 1
+    assert written == [2, 3, 4]
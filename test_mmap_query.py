@@ -0,0 +1,33 @@
+import cli
+import mmap_query
+import snapshot
+from patient import PatientStore
+
+TESTS = "Name: Hemoglobin (Hgb); Range: > 13.8, < 17.2; Unit: g/dL, 00-03-04\n"
+RECORDS = ("1300500: Hgb, 2023-07-07 07:50, 12.0, g/dL, reviewed\n"
+           "1300511: Hgb, 2021-03-02 07:30, 15.0, g/dL, pending\n")
+
+
+def values(patients):
+    return sorted((pid, record['result_value']) for pid, patient in patients.items() for record in patient.records)
+
+
+def test_stale_snapshots_are_not_queried(tmp_path, capsys):
+    test_file, record_file = str(tmp_path / "medicalTest.txt"), str(tmp_path / "medicalRecord.txt")
+    (tmp_path / "medicalTest.txt").write_text(TESTS)
+    (tmp_path / "medicalRecord.txt").write_text(RECORDS)
+    assert mmap_query.query_current_snapshot(test_file, record_file, []) is None
+
+    snapshot.load_medical_data(test_file, record_file, PatientStore())
+    mapped = mmap_query.query_current_snapshot(test_file, record_file, [("abnormal",)])
+    assert values(mapped) == [(1300500, 12.0)]
+
+    with open(record_file, 'a') as file:
+        file.write("1300600: Hgb, 2021-03-02 07:30, 20.0, g/dL, pending\n")
+    assert mmap_query.query_current_snapshot(test_file, record_file, [("abnormal",)]) is None
+
+    # the command falls back to the loaded records, which also brings the snapshot up to date
+    cli.run(["--tests", test_file, "--records", record_file, "query", "--mmap", "--abnormal"])
+    assert "1300600" in capsys.readouterr().out
+    assert values(mmap_query.query_current_snapshot(test_file, record_file, [("abnormal",)])) == \
+        [(1300500, 12.0), (1300600, 20.0)]
@@ -0,0 +1,54 @@
+import pytest
+import record_index
+from medical_test import MedicalTest
+from patient import Patient, PatientStore
+from query import Query
+from record import Record
+from sharded_store import ShardedPatientStore
+
+ABNORMAL = Query.where(("abnormal",))
+
+
+def build(store, test):
+    for patient_id, values in ((1300500, (12.0, 15.0)), (1300600, (16.5,)), (1300700, (18.0, 14.0))):
+        patient = Patient(patient_id)
+        for value in values:
+            patient.records.append(Record(test, 27000000, value, "g/dL", "pending"))
+        store[patient_id] = patient
+    return store
+
+
+def flips(flipped):
+    return {kind: [(pid, record['result_value']) for pid, record in rows] for kind, rows in flipped.items()}
+
+
+def abnormal_values(patients):
+    return sorted((pid, record['result_value']) for pid, patient in ABNORMAL.execute(patients).items()
+                  for record in patient.records)
+
+
+@pytest.mark.parametrize("use_numpy", [False, True])
+def test_range_edits_flip_results_between_normal_and_abnormal(monkeypatch, use_numpy):
+    if use_numpy:
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(record_index, "np", None)
+    test = MedicalTest("Hemoglobin", "Hgb", 13.8, 17.2, "g/dL", "00-03-04")
+    patients = build(PatientStore(), test)
+    assert abnormal_values(patients) == [(1300500, 12.0), (1300700, 18.0)]
+
+    test.lower_range, test.upper_range = 11.0, 16.0
+    assert flips(patients.refresh_test("Hgb")) == {"abnormal": [(1300600, 16.5)], "normal": [(1300500, 12.0)]}
+    assert abnormal_values(patients) == [(1300600, 16.5), (1300700, 18.0)]
+    assert flips(patients.refresh_test("Hgb")) == {"abnormal": [], "normal": []}
+    assert flips(patients.refresh_test("XYZ")) == {"abnormal": [], "normal": []}
+
+
+def test_sharded_range_edits_flip_results_in_patient_order():
+    test = MedicalTest("Hemoglobin", "Hgb", 13.8, 17.2, "g/dL", "00-03-04")
+    with build(ShardedPatientStore(3, 1), test) as sharded:
+        assert abnormal_values(sharded.query(ABNORMAL)) == [(1300500, 12.0), (1300700, 18.0)]
+        test.lower_range, test.upper_range = None, 14.5
+        assert flips(sharded.refresh_test("Hgb")) == {"abnormal": [(1300500, 15.0), (1300600, 16.5)],
+                                                      "normal": [(1300500, 12.0)]}
+        assert abnormal_values(sharded.query(ABNORMAL)) == [(1300500, 15.0), (1300600, 16.5), (1300700, 18.0)]
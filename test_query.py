@@ -0,0 +1,82 @@
+import random
+from datetime import datetime
+import pytest
+from medical_test import MedicalTest
+from patient import Patient, PatientStore
+from query import Query
+from record import Record
+
+TESTS = [MedicalTest("Hemoglobin", "Hgb", 13.8, 17.2, "g/dL", "00-03-04"),
+         MedicalTest("Blood Glucose Test", "BGT", 70, 99, "mg/dL", "00-12-06"),
+         MedicalTest("Lipid Panel", "LP", None, 200, "mg/dL", "01-00-00")]
+STATUSES = ("pending", "completed", "reviewed")
+
+
+def build_store(rng):
+    patients = PatientStore()
+    for patient_id in range(1300500, 1300580):
+        patients[patient_id] = Patient(patient_id)
+        for _ in range(rng.randint(0, 6)):
+            test = rng.choice(TESTS)
+            patients[patient_id].add_record(Record(test, 27000000 + rng.randrange(100000), rng.uniform(0, 250),
+                                                   test.unit, rng.choice(STATUSES)))
+    return patients
+
+
+def random_criterion(rng):
+    kind = rng.choice(("patient_id", "test_name", "abnormal", "date_range", "status", "turnaround"))
+    if kind == "patient_id":
+        return kind, rng.randrange(1300490, 1300590)
+    if kind == "test_name":
+        return kind, rng.choice(TESTS).abbr_name if rng.random() < 0.9 else "XYZ"
+    if kind == "abnormal":
+        return kind,
+    if kind == "date_range":
+        start = datetime(2021, 5, 1) + (datetime(2021, 6, 1) - datetime(2021, 5, 1)) * rng.random()
+        return kind, start, start + (datetime(2021, 7, 1) - datetime(2021, 5, 1)) * rng.random()
+    if kind == "status":
+        return kind, rng.choice(STATUSES).upper() if rng.random() < 0.2 else rng.choice(STATUSES)
+    return kind, rng.choice(("00-00-00", "00-06-00")), rng.choice(("00-12-06", "01-00-00"))
+
+
+def random_query(rng, depth=0):
+    if depth == 2 or rng.random() < 0.3:
+        return Query.where(random_criterion(rng))
+    children = [random_query(rng, depth + 1) for _ in range(rng.randint(1, 3))]
+    query = children[0]
+    for child in children[1:]:
+        query = query & child if rng.random() < 0.5 else query | child
+    return query
+
+
+def matched(patients):
+    return {pid: sorted(map(id, patient.records)) for pid, patient in patients.items()}
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_planned_queries_match_a_plain_scan(seed):
+    rng = random.Random(seed)
+    patients = build_store(rng)
+    plain = dict(patients)
+    for _ in range(60):
+        query = random_query(rng)
+        predicate = query.predicate()
+        expected = {pid: sorted(id(record) for record in patient.records if predicate(pid, record))
+                    for pid, patient in plain.items()}
+        expected = {pid: records for pid, records in expected.items() if records}
+        assert matched(query.execute(patients)) == expected, query
+        assert matched(query.execute(plain)) == expected, query
+        # a second run is answered from the query cache
+        assert matched(query.execute(patients)) == expected, query
+
+
+def test_where_all_and_any_build_the_same_queries_as_the_operators():
+    criteria = [("test_name", "Hgb"), ("status", "pending"), ("abnormal",)]
+    assert Query.all(criteria).key() == (Query.where(criteria[2]) & Query.where(criteria[0]) &
+                                         Query.where(criteria[1])).key()
+    assert Query.any(criteria).key() == (Query.where(criteria[1]) | Query.where(criteria[0]) |
+                                         Query.where(criteria[2])).key()
+    assert [child.criterion[0] for child in Query.all(criteria).planned().children] == \
+        ["test_name", "status", "abnormal"]
+    with pytest.raises(ValueError):
+        Query.where(("colour", "red"))
@@ -0,0 +1,65 @@
+from functions import query_summary_statistics
+from medical_test import MedicalTest
+from patient import Patient, PatientStore
+from query import Query
+from query_cache import QueryCache
+from record import Record
+
+HGB = MedicalTest("Hemoglobin", "Hgb", 13.8, 17.2, "g/dL", "00-03-04")
+PENDING = Query.where(("status", "pending"))
+
+
+def record(value, status="pending"):
+    return Record(HGB, 27000000, value, "g/dL", status)
+
+
+def matched(patients, query=PENDING):
+    return sorted((pid, record['result_value']) for pid, patient in query.execute(patients).items()
+                  for record in patient.records)
+
+
+def test_entries_are_dropped_when_the_version_moves_on():
+    cache = QueryCache(maxsize=2)
+    assert cache.get_or_compute("a", 1, lambda: "first") == "first"
+    assert cache.get_or_compute("a", 1, lambda: "second") == "first"
+    assert cache.get_or_compute("a", 2, lambda: "third") == "third"
+    cache.put("b", 2, "b")
+    cache.put("c", 2, "c")
+    assert cache.get("a", 2) == (False, None)
+    stats = cache.stats()
+    assert (stats["hits"], stats["invalidations"], stats["evictions"], stats["size"]) == (1, 1, 1, 2)
+
+
+def test_cached_queries_follow_store_changes():
+    patients = PatientStore()
+    patients[1300500] = Patient(1300500)
+    patients[1300500].add_record(record(14.0))
+    assert matched(patients) == [(1300500, 14.0)]
+    assert matched(patients) == [(1300500, 14.0)]
+    assert patients.cache.stats()["hits"] == 1
+
+    patients[1300500].add_record(record(15.0))
+    assert matched(patients) == [(1300500, 14.0), (1300500, 15.0)]
+
+    patients[1300500].replace_record(0, record(14.0, "reviewed"))
+    assert matched(patients) == [(1300500, 15.0)]
+
+    patients[1300600] = Patient(1300600)
+    patients[1300600].add_records([record(16.0), record(17.0, "completed")])
+    assert matched(patients) == [(1300500, 15.0), (1300600, 16.0)]
+
+    replacement = Patient(1300500)
+    replacement.add_record(record(18.0))
+    patients[1300500] = replacement
+    assert matched(patients) == [(1300500, 18.0), (1300600, 16.0)]
+
+
+def test_cached_summaries_follow_store_changes():
+    patients = PatientStore()
+    patients[1300500] = Patient(1300500)
+    patients[1300500].add_record(record(14.0))
+    before = query_summary_statistics(patients, PENDING, "test")
+    assert query_summary_statistics(patients, PENDING, "test") == before
+
+    patients[1300500].add_record(record(20.0))
+    assert query_summary_statistics(patients, PENDING, "test") != before
@@ -0,0 +1,57 @@
+import csv
+import pytest
+import record_export
+from medical_test import MedicalTest
+from patient import Patient, PatientStore
+from record import Record
+
+HGB = MedicalTest("Hemoglobin", "Hgb", 13.8, 17.2, "g/dL", "00-03-04")
+
+
+def exported_values(file_path):
+    with open(file_path, newline='') as file:
+        return sorted((int(row[0]), float(row[3])) for row in list(csv.reader(file))[1:])
+
+
+def test_incremental_exports_hold_each_record_once(tmp_path):
+    file_path = str(tmp_path / "export.csv")
+    patients = {1300500: Patient(1300500)}
+    patients[1300500].records.append(Record(HGB, 27000000, 14.0, "g/dL", "pending"))
+    assert record_export.export_records(patients, file_path) == 1
+
+    patients[1300600] = Patient(1300600)
+    patients[1300600].records.append(Record(HGB, 27000000, 15.0, "g/dL", "pending"))
+    assert record_export.export_records(patients, file_path, incremental=True) == 1
+    assert exported_values(file_path) == [(1300500, 14.0), (1300600, 15.0)]
+
+    # a changed record rewrites the file instead of leaving its old row next to the new one
+    patients[1300500].records[0]['result_value'] = 16.0
+    assert record_export.export_records(patients, file_path, incremental=True) == 2
+    assert exported_values(file_path) == [(1300500, 16.0), (1300600, 15.0)]
+    assert record_export.export_records(patients, file_path, incremental=True) == 0
+
+
+def test_incremental_exports_of_a_store_only_format_new_records(tmp_path, monkeypatch):
+    file_path = str(tmp_path / "export.csv")
+    patients = PatientStore()
+    patients[1300500] = Patient(1300500)
+    patients[1300500].add_record(Record(HGB, 27000000, 14.0, "g/dL", "pending"))
+    assert record_export.export_records(patients, file_path) == 1
+
+    formatted = []
+    format_csv_row = record_export.format_csv_row
+    monkeypatch.setattr(record_export, "format_csv_row",
+                        lambda patient_id, record: formatted.append(record) or format_csv_row(patient_id, record))
+    patients[1300500].add_record(Record(HGB, 27000100, 15.0, "g/dL", "pending"))
+    assert record_export.export_records(patients, file_path, incremental=True) == 1
+    assert [record['result_value'] for record in formatted] == [15.0]
+
+    patients[1300500].replace_record(0, Record(HGB, 27000000, 16.0, "g/dL", "pending"))
+    assert record_export.export_records(patients, file_path, incremental=True) == 2
+    assert exported_values(file_path) == [(1300500, 15.0), (1300500, 16.0)]
+
+
+@pytest.mark.parametrize("suffix", [".csv.gz", ".medcols", ".arrow"])
+def test_incremental_needs_plain_csv(tmp_path, suffix):
+    with pytest.raises(ValueError):
+        record_export.export_records({}, str(tmp_path / ("export" + suffix)), incremental=True)
@@ -0,0 +1,33 @@
+import pytest
+from medical_test import MedicalTest
+from patient import Patient, PatientStore
+from query import Query
+from record import Record
+
+HGB = MedicalTest("Hemoglobin", "Hgb", 13.8, 17.2, "g/dL", "00-03-04")
+
+
+def matched(patients, criterion):
+    return sorted((pid, record['result_value']) for pid, patient in Query.where(criterion).execute(patients).items()
+                  for record in patient.records)
+
+
+@pytest.mark.parametrize("field, value", [("test_date", None), ("test_date", "2024-01-01 10:00"),
+                                          ("status", None), ("result_value", None)])
+def test_records_that_cannot_be_indexed_leave_the_index_unchanged(field, value):
+    patients = PatientStore()
+    patients[1300500] = Patient(1300500)
+    patients[1300500].add_record(Record(HGB, 27000000, 12.0, "g/dL", "pending"))
+    bad = Record(HGB, 27000100, 20.0, "g/dL", "pending")
+    bad[field] = value
+
+    with pytest.raises(TypeError):
+        patients[1300500].add_record(bad)
+    with pytest.raises(TypeError):
+        patients[1300500].replace_record(0, bad)
+
+    assert len(patients.index) == len(patients[1300500].records) == 1
+    for criterion in (("test_name", "Hgb"), ("status", "pending"), ("abnormal",)):
+        assert matched(patients, criterion) == [(1300500, 12.0)]
+    patients[1300500].add_record(Record(HGB, 26000000, 15.0, "g/dL", "pending"))
+    assert matched(patients, ("test_name", "Hgb")) == [(1300500, 12.0), (1300500, 15.0)]
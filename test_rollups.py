@@ -0,0 +1,59 @@
+import random
+import pytest
+import rollups
+import stats_engine
+from medical_test import MedicalTest
+from patient import Patient, PatientStore
+from query import Query
+from record import Record
+
+TESTS = [MedicalTest("Hemoglobin", "Hgb", 13.8, 17.2, "g/dL", "00-03-04"),
+         MedicalTest("Blood Glucose Test", "BGT", 70, 99, "mg/dL", "00-12-06")]
+QUERIES = [None, Query.where(("status", "pending")), Query.all([("test_name", "Hgb"), ("status", "completed")])]
+
+
+def random_record(rng):
+    test = rng.choice(TESTS)
+    # few days and statuses, so every cell holds several records
+    return Record(test, 27000000 + rng.randrange(3) * 1440 + rng.randrange(1440), 1e6 + rng.gauss(100, 10),
+                  test.unit, rng.choice(("pending", "completed")))
+
+
+def assert_rollups_match(patients):
+    for query in QUERIES:
+        expected = stats_engine.summarize_patients(patients if query is None else query.execute(patients),
+                                                   use_numpy=False)
+        actual = rollups.summarize(patients.index, rollups.rollup_plan(query))
+        assert actual["count"] == expected["count"]
+        for column in ("result_value", "turnaround_minutes"):
+            for key in ("min", "max"):
+                assert actual[column][key] == expected[column][key]
+            for key in ("mean", "stddev"):
+                assert actual[column][key] == pytest.approx(expected[column][key], rel=1e-9)
+
+
+def test_rollups_follow_adds_replaces_and_removes():
+    rng = random.Random(11)
+    patients = PatientStore()
+    for patient_id in range(1300500, 1300540):
+        patients[patient_id] = Patient(patient_id)
+        patients[patient_id].add_records(random_record(rng) for _ in range(5))
+    assert_rollups_match(patients)
+
+    for patient_id in range(1300500, 1300510):
+        patients[patient_id].add_record(random_record(rng))
+    assert_rollups_match(patients)
+
+    # replacing each cell's smallest and largest result leaves the cells' min and max stale
+    for patient in list(patients.values())[10:20]:
+        ordered = sorted(range(len(patient.records)), key=lambda number: patient.records[number]['result_value'])
+        for record_number in (ordered[0], ordered[-1]):
+            old = patient.records[record_number]
+            patient.replace_record(record_number, Record(old['test'], old['test_date'], old['result_value'],
+                                                         old['unit'], "completed" if old['status'] == "pending"
+                                                         else "pending"))
+    assert_rollups_match(patients)
+
+    for patient_id in range(1300520, 1300530):
+        patients[patient_id] = Patient(patient_id)
+    assert_rollups_match(patients)
@@ -0,0 +1,87 @@
+import asyncio
+import json
+import service
+from batch import BatchSession
+
+TESTS = "Name: Hemoglobin (Hgb); Range: > 13.8, < 17.2; Unit: g/dL, 00-03-04\n"
+RECORDS = "".join(f"{1300500 + pid}: Hgb, 2023-07-07 07:50, {100.0 + pid}, g/dL, reviewed\n" for pid in range(50))
+
+
+class BufferWriter:
+    # StreamWriter stand-in whose drain() yields, like a slow client's
+    def __init__(self):
+        self.data = b""
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        await asyncio.sleep(0)
+
+    def close(self):
+        pass
+
+
+def new_row(pid):
+    return {"patient_id": pid, "test": "Hgb", "test_date": "2024-01-01 10:00", "result_value": 14.0}
+
+
+def test_streamed_query_is_not_cut_off_by_concurrent_writes(tmp_path):
+    (tmp_path / "medicalTest.txt").write_text(TESTS)
+    (tmp_path / "medicalRecord.txt").write_text(RECORDS)
+
+    async def run():
+        with BatchSession(str(tmp_path / "medicalTest.txt"), str(tmp_path / "medicalRecord.txt")) as session:
+            records_service = service.RecordService(session)
+            writer = BufferWriter()
+            # an empty query matches every patient; the stream sends one record per chunk while new patients arrive
+            patient_records = await records_service.query({})
+            stream = asyncio.ensure_future(service.stream_records(writer, patient_records, batch_size=1))
+            added = await asyncio.gather(*(records_service.add_records([new_row(9000000 + n)]) for n in range(5)))
+            await stream
+            return writer.data, added, await records_service.query({})
+
+    data, added, after = asyncio.run(run())
+    assert all(result["added"] == 1 for result in added)
+    assert data.endswith(b"0\r\n\r\n")
+    body = data.split(b"\r\n\r\n", 1)[1]
+    lines = [json.loads(line) for line in body.split(b"\r\n")[1::2] if line and line != b"0"]
+    assert len(lines) == 50
+    assert len(after) == 55
+
+
+def request(records_service, data):
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        await records_service.handle(reader, writer)
+
+    writer = BufferWriter()
+    asyncio.run(run())
+    head, _, body = writer.data.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(body)
+
+
+def post(payload):
+    body = json.dumps(payload).encode()
+    return b"POST /records HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+
+
+def test_bad_requests_get_a_400_and_failures_a_500(tmp_path, monkeypatch):
+    (tmp_path / "medicalTest.txt").write_text(TESTS)
+    (tmp_path / "medicalRecord.txt").write_text(RECORDS)
+    with BatchSession(str(tmp_path / "medicalTest.txt"), str(tmp_path / "medicalRecord.txt")) as session:
+        records_service = service.RecordService(session)
+        assert request(records_service, b"POST /records HTTP/1.1\r\nContent-Length: ten\r\n\r\n")[0] == 400
+        assert request(records_service, b"POST /records HTTP/1.1\r\nContent-Length: 2\r\n\r\n{]")[0] == 400
+
+        status, result = request(records_service, post(dict(new_row(1300500), test_date=None)))
+        assert (status, result["added"], len(result["rejected"])) == (200, 0, 1)
+        status, records = request(records_service, b"GET /records?test=Hgb HTTP/1.1\r\n\r\n")
+        assert (status, len(records)) == (200, 50)
+
+        def broken():
+            raise RuntimeError("broken")
+        monkeypatch.setattr(records_service, "tests", broken)
+        assert request(records_service, b"GET /tests HTTP/1.1\r\n\r\n") == (500, {"error": "internal server error"})
@@ -0,0 +1,94 @@
+import random
+import statistics
+import pytest
+import stats_engine
+from medical_test import MedicalTest
+from patient import Patient, PatientStore
+from query import Query
+from record import Record
+from sharded_store import ShardedPatientStore
+
+TESTS = {
+    "Hgb": MedicalTest("Hemoglobin", "Hgb", 13.8, 17.2, "g/dL", "00-03-04"),
+    "BGT": MedicalTest("Blood Glucose Test", "BGT", 70, 99, "mg/dL", "00-12-06"),
+}
+
+
+def build_patients(num_patients=300):
+    rng = random.Random(7)
+    patients = PatientStore()
+    for patient_id in range(1000000, 1000000 + num_patients):
+        patient = Patient(patient_id)
+        for _ in range(rng.randint(1, 6)):
+            test = rng.choice(list(TESTS.values()))
+            # a large mean with a small spread: sums of squares minus the squared mean cancel here
+            value = 1e8 + rng.gauss(0, 1) if test.abbr_name == "Hgb" else rng.uniform(50, 150)
+            patient.records.append(Record(test, rng.randint(26000000, 27000000), value, test.unit,
+                                          rng.choice(("pending", "completed", "reviewed"))))
+        patients[patient_id] = patient
+    return patients
+
+
+def assert_same(expected, actual):
+    if isinstance(expected, dict):
+        assert expected.keys() == actual.keys()
+        for key in expected:
+            assert_same(expected[key], actual[key])
+    elif isinstance(expected, float):
+        assert actual == pytest.approx(expected, rel=1e-9)
+    else:
+        assert expected == actual
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_sharded_summaries_equal_single_store(workers):
+    patients = build_patients()
+    with ShardedPatientStore.from_patients(patients, 3, workers) as sharded:
+        for query in (None, Query.where(("test_name", "Hgb")), Query.any([("status", "pending"), ("abnormal",)])):
+            single = patients if query is None else query.execute(patients)
+            for group_by in (None, "test", "status"):
+                assert_same(stats_engine.summarize_patients(single, group_by, use_numpy=False),
+                            sharded.summarize(query, group_by, percentiles=True))
+
+        hgb = [record['result_value'] for patient in patients.values() for record in patient.records
+               if record['test'].abbr_name == "Hgb"]
+        summary = sharded.summarize(group_by="test")["groups"]["Hgb"]["result_value"]
+        assert summary["stddev"] == pytest.approx(statistics.pstdev(hgb), rel=1e-6)
+
+
+def test_workers_are_reused_and_sent_changed_shards():
+    patients = build_patients(60)
+    with ShardedPatientStore.from_patients(patients, 3, 3) as sharded:
+        before = sharded.summarize()["count"]
+        executor = sharded.executor
+        patient_id = next(iter(sharded))
+        sharded[patient_id].add_record(Record(TESTS["Hgb"], 27000001, 999.0, "g/dL", "pending"))
+        sharded[9999999] = Patient(9999999)
+
+        assert sharded.summarize()["count"] == before + 1
+        matches = sharded.query(Query.where(("status", "pending")))
+        assert any(record['result_value'] == 999.0 for record in matches[patient_id].records)
+        assert sharded.executor is executor
+
+
+def test_replaced_patients_are_not_answered_from_old_copies():
+    patients = build_patients(60)
+    with ShardedPatientStore.from_patients(patients, 3, 3) as sharded:
+        patient_id = next(iter(sharded))
+        number = sharded.shards.index(sharded.shard_for(patient_id))
+        sharded.query(Query.where(("status", "pending")))
+
+        version = sharded.shard_version(number)
+        sharded[patient_id] = Patient(patient_id)
+        assert sharded.shard_version(number) != version
+        version = sharded.shard_version(number)
+        sharded[patient_id] = Patient(patient_id)
+        assert sharded.shard_version(number) != version
+
+        replacement = Patient(patient_id)
+        for record in patients[patient_id].records:
+            replacement.records.append(Record(record['test'], record['test_date'], 555.0, record['unit'], "pending"))
+        sharded[patient_id] = replacement
+        matches = sharded.query(Query.where(("status", "pending")))
+        assert [record['result_value'] for record in matches[patient_id].records] == \
+            [555.0] * len(patients[patient_id].records)
@@ -0,0 +1,53 @@
+import bisect
+import random
+from sketches import HyperLogLog, KLLSketch
+
+FRACTIONS = [0.01, 0.25, 0.5, 0.75, 0.9, 0.99]
+
+
+def assert_ranks_within_bound(sketch, ordered):
+    for fraction, value in sketch.quantiles(FRACTIONS).items():
+        rank = bisect.bisect_right(ordered, value)
+        assert abs(rank - fraction * len(ordered)) <= sketch.rank_error() * len(ordered)
+
+
+def test_kll_quantiles_stay_within_rank_error():
+    rng = random.Random(3)
+    values = [rng.lognormvariate(4, 1) for _ in range(50000)]
+    sketch = KLLSketch(seed=1)
+    for value in values:
+        sketch.update(value)
+    assert sketch.count == len(values) and sketch.size < len(values) // 20
+    assert_ranks_within_bound(sketch, sorted(values))
+
+
+def test_merged_kll_sketches_stay_within_rank_error():
+    rng = random.Random(4)
+    parts = [[rng.gauss(100, 15) for _ in range(rng.randint(1000, 20000))] for _ in range(6)]
+    merged = KLLSketch(seed=2)
+    for number, part in enumerate(parts):
+        sketch = KLLSketch(seed=number)
+        for value in part:
+            sketch.update(value)
+        merged.merge(KLLSketch.from_dict(sketch.to_dict()))
+    assert_ranks_within_bound(merged, sorted(value for part in parts for value in part))
+
+
+def test_hyperloglog_estimates_stay_within_relative_error():
+    for distinct in (100, 3000, 200000):
+        sketch = HyperLogLog()
+        for patient_id in range(1000000, 1000000 + distinct):
+            sketch.add(patient_id)
+            sketch.add(patient_id)
+        # three standard errors
+        assert abs(sketch.estimate() - distinct) <= 3 * sketch.relative_error() * distinct
+
+
+def test_merged_hyperloglogs_count_the_union():
+    first, second = HyperLogLog(), HyperLogLog()
+    for patient_id in range(1000000, 1060000):
+        first.add(patient_id)
+    for patient_id in range(1040000, 1100000):
+        second.add(patient_id)
+    merged = HyperLogLog.from_dict(first.to_dict()).merge(second)
+    assert abs(merged.estimate() - 100000) <= 3 * merged.relative_error() * 100000
@@ -0,0 +1,28 @@
+import math
+import random
+import pytest
+import stats_engine
+
+np = pytest.importorskip("numpy")
+
+
+def test_numpy_sums_equal_python_fsum():
+    rng = random.Random(5)
+    for _ in range(200):
+        values = [rng.gauss(rng.uniform(-1e6, 1e8), rng.uniform(1e-3, 1e3)) for _ in range(rng.randint(1, 300))]
+        values += rng.sample([1e300, -1e300, 5e-324, -0.0, 1e-310], rng.randint(0, 5))
+        assert stats_engine._fsum_numpy(np.array(values)) == math.fsum(values)
+
+
+def test_numpy_mean_and_stddev_equal_python_path():
+    rng = random.Random(6)
+    values = [1e8 + rng.gauss(0, 1) for _ in range(500)]
+    turnarounds = [rng.uniform(0, 1e5) for _ in range(500)]
+    groups = [rng.choice("abc") for _ in range(500)]
+    with_numpy = stats_engine.summarize(values, turnarounds, groups, use_numpy=True)
+    without = stats_engine.summarize(values, turnarounds, groups, use_numpy=False)
+    for summary, expected in [(with_numpy, without)] + [(with_numpy["groups"][key], without["groups"][key])
+                                                         for key in without["groups"]]:
+        for column in ("result_value", "turnaround_minutes"):
+            for key in ("count", "min", "max", "mean", "stddev"):
+                assert summary[column][key] == expected[column][key]
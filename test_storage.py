@@ -0,0 +1,69 @@
+import random
+from datetime import datetime
+import pytest
+import storage
+from medical_test import MedicalTest
+from patient import Patient, PatientStore
+from query import Query
+from record import Record
+
+STATUSES = ("pending", "completed", "reviewed")
+CRITERIA = [("patient_id", 1300503), ("test_name", "Hgb"), ("test_name", "LP"), ("abnormal",),
+            ("date_range", datetime(2021, 5, 10), datetime(2021, 6, 20, 12, 30)), ("status", "Pending"),
+            ("status", "reviewed"), ("turnaround", "00-00-00", "00-06-00"), ("turnaround", "00-12-00", "02-00-00")]
+
+
+def build_tests():
+    return {test.abbr_name: test for test in (MedicalTest("Hemoglobin", "Hgb", 13.8, 17.2, "g/dL", "00-03-04"),
+                                              MedicalTest("Blood Glucose Test", "BGT", 70, 99, "mg/dL", "00-12-06"),
+                                              MedicalTest("Lipid Panel", "LP", None, 200, "mg/dL", "01-00-00"))}
+
+
+def build_patients(rng, tests):
+    patients = PatientStore()
+    for patient_id in range(1300500, 1300540):
+        patients[patient_id] = Patient(patient_id)
+        for _ in range(rng.randint(0, 6)):
+            test = rng.choice(list(tests.values()))
+            patients[patient_id].add_record(Record(test, 27000000 + rng.randrange(100000), rng.uniform(0, 250),
+                                                   test.unit, rng.choice(STATUSES)))
+    return patients
+
+
+def rows(patients):
+    return [(pid, record['test'].abbr_name, record['test_date'], record['result_value'], record['status'])
+            for pid, patient in patients.items() for record in patient.records]
+
+
+def test_sql_queries_match_the_in_memory_filters(tmp_path):
+    rng = random.Random(8)
+    tests = build_tests()
+    patients = build_patients(rng, tests)
+    records = storage.SqliteStorage(str(tmp_path / "records.db"))
+    try:
+        records.sync_tests(tests)
+        records.insert_patients(patients)
+        queries = [Query.where(criterion) for criterion in CRITERIA]
+        for _ in range(40):
+            picked = rng.sample(CRITERIA, rng.randint(2, 3))
+            queries.append(Query.all(picked) if rng.random() < 0.5 else Query.any(picked))
+        queries.append(Query.where(CRITERIA[1]) & (Query.where(CRITERIA[3]) | Query.where(CRITERIA[5])))
+        for query in queries:
+            assert rows(records.query(query)) == rows(query.execute(patients)), query
+
+        # a range edit is picked up by the next query
+        tests["Hgb"].upper_range = 100
+        patients.refresh_test("Hgb")
+        query = Query.where(("abnormal",))
+        assert rows(records.query(query)) == rows(query.execute(patients))
+    finally:
+        records.close()
+
+
+def test_unknown_criteria_are_rejected(tmp_path):
+    records = storage.SqliteStorage(str(tmp_path / "records.db"))
+    try:
+        with pytest.raises(ValueError):
+            records.build_query([("colour", "red")])
+    finally:
+        records.close()
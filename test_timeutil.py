@@ -0,0 +1,27 @@
+import random
+from datetime import datetime, timedelta
+import pytest
+from timeutil import DATE_FORMAT, datetime_from_minutes, format_minutes, minutes_from_datetime, parse_minutes
+
+
+def test_minutes_round_trip_through_text_and_datetime():
+    rng = random.Random(2)
+    start = datetime(1900, 1, 1)
+    for _ in range(2000):
+        moment = start + timedelta(minutes=rng.randrange(300 * 366 * 24 * 60))
+        text = moment.strftime(DATE_FORMAT)
+        minutes = parse_minutes(text)
+        assert minutes == minutes_from_datetime(moment)
+        assert format_minutes(minutes) == text
+        assert datetime_from_minutes(minutes) == moment
+    assert parse_minutes("1970-01-01 00:00") == 0
+    assert format_minutes(-1) == "1969-12-31 23:59"
+
+
+@pytest.mark.parametrize("text", ["", "2023-07-07", "2023-07-07 7:50", "2023/07/07 07:50", "2023-13-01 07:50",
+                                  "2023-02-30 07:50", "2023-07-07 24:00", "2023-07-07 07:60", "2023-07-07T07:50",
+                                  "2023-0a-07 07:50", "2023-07-07 07:5x", "2023-07-07 07:50 "])
+def test_malformed_dates_are_rejected(text):
+    # fixed width: unlike strptime, unpadded fields are rejected too
+    with pytest.raises(ValueError):
+        parse_minutes(text)
@@ -0,0 +1,72 @@
+from datetime import date, datetime
+
+DATE_FORMAT = "%Y-%m-%d %H:%M"
+MINUTES_PER_DAY = 24 * 60
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+_DIGITS = frozenset("0123456789")
+_day_cache = {}
+_day_str_cache = {}
+
+
+def _bad_format(value):
+    return ValueError(f"time data {value!r} does not match format '{DATE_FORMAT}'")
+
+
+def parse_minutes(value):
+    # fixed-width "YYYY-MM-DD HH:MM" -> minutes since 1970-01-01 00:00
+    if len(value) != 16 or value[4] != '-' or value[7] != '-' or value[10] != ' ' or value[13] != ':':
+        raise _bad_format(value)
+
+    day_part = value[:10]
+    days = _day_cache.get(day_part)
+    if days is None:
+        if not _DIGITS.issuperset(value[0:4] + value[5:7] + value[8:10]):
+            raise _bad_format(value)
+        # date() validates month and day-of-month ranges
+        days = date(int(value[0:4]), int(value[5:7]), int(value[8:10])).toordinal() - _EPOCH_ORDINAL
+        _day_cache[day_part] = days
+
+    hour_part = value[11:13]
+    minute_part = value[14:16]
+    if not _DIGITS.issuperset(hour_part + minute_part):
+        raise _bad_format(value)
+    hours = int(hour_part)
+    minutes = int(minute_part)
+    if hours > 23 or minutes > 59:
+        raise _bad_format(value)
+
+    return days * MINUTES_PER_DAY + hours * 60 + minutes
+
+
+def format_minutes(minutes):
+    days, minute_of_day = divmod(minutes, MINUTES_PER_DAY)
+    day_str = _day_str_cache.get(days)
+    if day_str is None:
+        day = date.fromordinal(days + _EPOCH_ORDINAL)
+        day_str = f"{day.year:04d}-{day.month:02d}-{day.day:02d}"
+        _day_str_cache[days] = day_str
+    hours, minute = divmod(minute_of_day, 60)
+    return f"{day_str} {hours:02d}:{minute:02d}"
+
+
+def turnaround_minutes(value):
+    # "DD-hh-mm" -> minutes
+    days, hours, minutes = map(int, value.split('-'))
+    return (days * 24 + hours) * 60 + minutes
+
+
+def format_turnaround_minutes(minutes):
+    hours, minute = divmod(minutes, 60)
+    days, hour = divmod(hours, 24)
+    return f"{days:02d}-{hour:02d}-{minute:02d}"
+
+
+def minutes_from_datetime(value):
+    return (value.toordinal() - _EPOCH_ORDINAL) * MINUTES_PER_DAY + value.hour * 60 + value.minute
+
+
+def datetime_from_minutes(minutes):
+    days, minute_of_day = divmod(minutes, MINUTES_PER_DAY)
+    day = date.fromordinal(days + _EPOCH_ORDINAL)
+    return datetime(day.year, day.month, day.day, minute_of_day // 60, minute_of_day % 60)
@@ -0,0 +1,154 @@
+from array import array
+from timeutil import MINUTES_PER_DAY
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DEFAULT_WINDOW = 3
+DEFAULT_HORIZON_DAYS = 30
+
+
+def series_points(patients, patient_id, abbr_name):
+    # [(test_date, result_value)] of one patient's results for one test, oldest first
+    index = getattr(patients, 'index', None)
+    if index is not None:
+        return [(test_date, index.rows[row][1]['result_value'])
+                for test_date, row in index.series_rows(patient_id, abbr_name)]
+    patient = patients.get(patient_id)
+    if patient is None:
+        return []
+    return sorted((record['test_date'], record['result_value'])
+                  for record in patient.records if record['test'].abbr_name == abbr_name)
+
+
+def moving_average(values, window=DEFAULT_WINDOW):
+    # mean of each value and the window - 1 before it; shorter at the start of the series
+    averages = []
+    total = 0.0
+    for position, value in enumerate(values):
+        total += value
+        if position >= window:
+            total -= values[position - window]
+        averages.append(total / min(position + 1, window))
+    return averages
+
+
+def rolling(points, window=DEFAULT_WINDOW):
+    # one row per result: the moving average, the delta since the previous result and its rate per day
+    rows = []
+    previous = None
+    averages = moving_average([value for _, value in points], window)
+    for (test_date, value), average in zip(points, averages):
+        delta = rate = None
+        if previous is not None:
+            delta = value - previous[1]
+            days = (test_date - previous[0]) / MINUTES_PER_DAY
+            rate = delta / days if days else None
+        rows.append({"test_date": test_date, "result_value": value, "moving_average": average,
+                     "delta": delta, "rate_per_day": rate})
+        previous = (test_date, value)
+    return rows
+
+
+def series_columns(index):
+    # every (patient, test) series back to back: keys, offsets into the date/value columns, test id per series
+    keys = []
+    test_ids = array('i')
+    test_names = []
+    test_id_of = {}
+    offsets = array('q', [0])
+    dates = array('q')
+    values = array('d')
+    rows = index.rows
+    index.prepare()
+    for key, series in index.series.items():
+        if not series:
+            continue
+        abbr_name = key[1]
+        test_id = test_id_of.get(abbr_name)
+        if test_id is None:
+            test_id = test_id_of[abbr_name] = len(test_names)
+            test_names.append(abbr_name)
+        keys.append(key)
+        test_ids.append(test_id)
+        dates.extend(test_date for test_date, _ in series)
+        values.extend(rows[row][1]['result_value'] for _, row in series)
+        offsets.append(len(dates))
+    return {"keys": keys, "test_ids": test_ids, "test_names": test_names,
+            "offsets": offsets, "dates": dates, "values": values}
+
+
+def _trend_numpy(columns, lowers, uppers, window, horizon_days):
+    offsets = np.frombuffer(columns["offsets"], dtype=np.int64)
+    dates = np.frombuffer(columns["dates"], dtype=np.int64)
+    values = np.frombuffer(columns["values"], dtype=np.float64)
+    test_ids = np.frombuffer(columns["test_ids"], dtype=np.int32)
+
+    ends = offsets[1:] - 1
+    starts = np.maximum(ends - (window - 1), offsets[:-1])
+    days = (dates[ends] - dates[starts]) / MINUTES_PER_DAY
+    slopes = np.divide(values[ends] - values[starts], days, out=np.zeros(len(ends)), where=days > 0)
+    projected = values[ends] + slopes * horizon_days
+    # NaN bounds (no limit on that side) never compare true
+    with np.errstate(invalid='ignore'):
+        rising = (slopes > 0) & (projected > np.asarray(uppers)[test_ids])
+        falling = (slopes < 0) & (projected < np.asarray(lowers)[test_ids])
+    hits = np.flatnonzero(rising | falling)
+    return [(int(series), int(ends[series]), float(slopes[series]), float(projected[series])) for series in hits]
+
+
+def _trend_python(columns, lowers, uppers, window, horizon_days):
+    offsets, dates, values, test_ids = columns["offsets"], columns["dates"], columns["values"], columns["test_ids"]
+    hits = []
+    for series, test_id in enumerate(test_ids):
+        end = offsets[series + 1] - 1
+        start = max(end - (window - 1), offsets[series])
+        days = (dates[end] - dates[start]) / MINUTES_PER_DAY
+        if days <= 0:
+            continue
+        slope = (values[end] - values[start]) / days
+        projected = values[end] + slope * horizon_days
+        if (slope > 0 and projected > uppers[test_id]) or (slope < 0 and projected < lowers[test_id]):
+            hits.append((series, end, slope, projected))
+    return hits
+
+
+def trending_abnormal(patients, tests=None, window=DEFAULT_WINDOW, horizon_days=DEFAULT_HORIZON_DAYS,
+                      use_numpy=None):
+    # series whose slope over the last `window` results carries them outside the test's range within
+    # horizon_days (or further out if they already are); one pass over all series at once
+    index = patients.index
+    cache = getattr(patients, 'cache', None)
+    if cache is None:
+        columns = series_columns(index)
+    else:
+        columns = cache.get_or_compute(("series_columns",), index.version, lambda: series_columns(index))
+    if not columns["keys"]:
+        return []
+
+    tests = tests if tests is not None else index.tests
+    nan = float("nan")
+    lowers = [nan if tests[name].lower_range is None else tests[name].lower_range for name in columns["test_names"]]
+    uppers = [nan if tests[name].upper_range is None else tests[name].upper_range for name in columns["test_names"]]
+    if use_numpy is None:
+        use_numpy = np is not None
+    scan = _trend_numpy if use_numpy else _trend_python
+    hits = scan(columns, lowers, uppers, window, horizon_days)
+
+    trending = []
+    for series, end, slope, projected in hits:
+        patient_id, abbr_name = columns["keys"][series]
+        test = tests[abbr_name]
+        trending.append({
+            "patient_id": patient_id,
+            "test": abbr_name,
+            "test_date": columns["dates"][end],
+            "result_value": columns["values"][end],
+            "rate_per_day": slope,
+            "projected_value": projected,
+            "direction": "rising" if slope > 0 else "falling",
+            "abnormal": not test.is_result_normal(columns["values"][end]),
+        })
+    return trending